@@ -0,0 +1,73 @@
+"""Latency added to an asyncio service by monitoring its memory
+
+A ticker task standing in for the service sleeps for a millisecond at a time and records how late
+each wake up is, with no monitor, with the threaded MemoryMonitor and with AsyncMemoryMonitor
+running in the same process, and reports the percentiles of the lateness of each.
+
+Usage::
+    python benchmarks/bench_async.py --seconds 5 --interval 0.005 --sampler procfs
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from memorytools.asyncmonitor import AsyncMemoryMonitor
+from memorytools.memorymonitor import MemoryMonitor
+
+TICK = 0.001 # Sleep of the ticker task in seconds
+
+
+async def lateness(seconds:float)->np.ndarray:
+    """Lateness of each wake up of a task sleeping TICK at a time for a number of seconds"""
+    loop = asyncio.get_running_loop()
+    late = []
+    end = loop.time() + seconds
+    while loop.time() < end:
+        expected = time.perf_counter() + TICK
+        await asyncio.sleep(TICK)
+        late.append(time.perf_counter() - expected)
+    return np.array(late)
+
+
+async def run(mode:str, directory:str, seconds:float, interval:float, sampler:str)->np.ndarray:
+    data_file = os.path.join(directory, f"{mode}.dat")
+    if mode == "none":
+        return await lateness(seconds)
+    if mode == "thread":
+        mem_monitor = MemoryMonitor(data_file=data_file, time_interval=interval, sampler=sampler)
+        mem_monitor.start_monitoring()
+        try:
+            return await lateness(seconds)
+        finally:
+            mem_monitor.close()
+    async with AsyncMemoryMonitor(data_file=data_file, time_interval=interval, sampler=sampler) as mem_monitor:
+        late = await lateness(seconds)
+    mem_monitor.close()
+    return late
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the event loop latency added by the memory monitors")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Duration of each run")
+    parser.add_argument("--interval", type=float, default=0.005, help="Time interval between snapshots")
+    parser.add_argument("--sampler", default="procfs", help="Sampler of the monitors")
+    args = parser.parse_args(argv)
+    logging.disable(logging.ERROR)
+
+    print(f"{'monitor':<8} {'wake ups':>9} {'p50 ms':>8} {'p99 ms':>8} {'p99.9 ms':>9} {'max ms':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ["none", "thread", "async"]:
+            late = asyncio.run(run(mode, directory, args.seconds, args.interval, args.sampler)) * 1e3
+            p50, p99, p999 = np.percentile(late, [50, 99, 99.9])
+            print(f"{mode:<8} {len(late):>9} {p50:>8.3f} {p99:>8.3f} {p999:>9.3f} {late.max():>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""Compare the run time of the change point detection methods as captures get longer
+
+Times change_points_detection with each method over a synthetic series resampled at
+RESAMPLE_MIN_WIN, flat with noise then leaking from 60% of the way through, and prints the change
+point found nearest the start of the leak. PELT is skipped on series longer than PELT_MAX_POINTS as
+it takes minutes there.
+
+Usage::
+    python benchmarks/bench_cpd.py [lengths...]
+"""
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from memorytools.memoryanalysis import RESAMPLE_MIN_WIN, MemoryAnalysis
+
+DEFAULT_LENGTHS = [1000, 4000, 16000, 64000, 172800] # 172800 points is a day at RESAMPLE_MIN_WIN
+PELT_MAX_POINTS = 16000
+METHODS = [("pelt", "l2"), ("binseg", "linear"), ("decimate", "linear")]
+
+
+def synthetic_series(n, rng):
+    ts = np.arange(n) * RESAMPLE_MIN_WIN
+    ys = 1e8 + rng.normal(0, 1e5, n)
+    start = int(n * 0.6)
+    ys[start:] += np.arange(n - start) * 2e3
+    return ts, ys, start
+
+
+def main(lengths):
+    logging.disable(logging.ERROR)
+    analysis = MemoryAnalysis()
+    rng = np.random.default_rng(0)
+    print(f"{'points':>7} {'method':<9} {'model':<7} {'time s':>8} {'cps':>5} {'leak start':>10} {'nearest cp':>10}")
+    for n in lengths:
+        ts, ys, start = synthetic_series(n, rng)
+        for method, model in METHODS:
+            if method == "pelt" and n > PELT_MAX_POINTS:
+                continue
+            began = time.perf_counter()
+            cps = analysis.change_points_detection(ts, ys, model=model, method=method)
+            elapsed = time.perf_counter() - began
+            nearest = min(cps, key=lambda cp: abs(cp - start)) if len(cps) else "-"
+            print(f"{n:>7} {method:<9} {model:<7} {elapsed:>8.3f} {len(cps):>5} {start:>10} {nearest:>10}")
+
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or DEFAULT_LENGTHS)
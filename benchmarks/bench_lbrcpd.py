@@ -0,0 +1,60 @@
+"""Compare the run time and results of the LBR and LBRCPD leak detection algorithms
+
+Runs both algorithms over the memory captures in data/ and prints the time each takes and the
+processes each reports. The captures are sampled every second, so they are split on gaps and
+resampled at the granularity given by --max-time-diff and --resample rather than the defaults
+of memoryanalysis, which would split them into single samples with no windows to fit.
+
+Usage::
+    python benchmarks/bench_lbrcpd.py [--max-time-diff 5] [--resample 1] [csv files...]
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from memorytools.memorymonitor import MemorySnapper
+from memorytools.sweep import analysis_parameters
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+DEFAULT_CAPTURES = [os.path.join(DATA_DIR, "tdcstst_continuous.csv")] + \
+    sorted(glob.glob(os.path.join(DATA_DIR, "tdcsarv testing", "1s granularity", "csv files", "*.csv")))
+REPEATS = 3
+
+
+def best_time(mem_snap, algo):
+    best = float("inf")
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = mem_snap.detect_leaks(algo=algo)
+        best = min(best, time.perf_counter() - start)
+    return best, set(result[1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the LBR and LBRCPD leak detection algorithms")
+    parser.add_argument("captures", nargs="*", default=DEFAULT_CAPTURES, help="CSV memory captures")
+    parser.add_argument("--max-time-diff", type=float, default=5.0, help="Gap the data is split on, in seconds")
+    parser.add_argument("--resample", type=float, default=1.0, help="Resampling interval, in seconds")
+    args = parser.parse_args(argv)
+    logging.disable(logging.ERROR)
+    print(f"{'capture':<28} {'procs':>5} {'points':>7} {'LBR s':>8} {'LBRCPD s':>9} {'speedup':>8}  agree")
+    with tempfile.TemporaryDirectory() as directory, \
+            analysis_parameters({"MAX_TIME_DIFF": args.max_time_diff, "RESAMPLE_MIN_WIN": args.resample}):
+        for capture in args.captures:
+            mem_snap = MemorySnapper(existing_data_file=os.path.join(directory, os.path.basename(capture) + ".dat"))
+            mem_snap.import_from_csv(capture)
+            lbr_time, lbr_pids = best_time(mem_snap, "LBR")
+            cpd_time, cpd_pids = best_time(mem_snap, "LBRCPD")
+            points = sum(len(ts) for pid in mem_snap.pids for ts, _ in mem_snap.analysis_module.prepare(pid).segments)
+            print(f"{os.path.basename(capture)[:28]:<28} {len(mem_snap.pids):>5} {points:>7} {lbr_time:>8.3f} "
+                  f"{cpd_time:>9.3f} {lbr_time / cpd_time:>7.2f}x  "
+                  f"{'yes' if lbr_pids == cpd_pids else f'LBR {sorted(lbr_pids)} LBRCPD {sorted(cpd_pids)}'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Benchmark suite for the samplers, the data store and the leak detectors
+
+Runs every stage over a grid of synthetic environments (N processes x M snapshots, with leaks,
+sawtooth, gaps and pid churn, see environments.py) and over the captures in data/, and reports
+the best time of each stage, its throughput and the peak memory it allocated. Results are
+written as JSON so runs can be compared, and a previous results file can be given as a baseline
+to flag stages that got slower.
+
+Stages:
+    snapshot: MemorySnapper.take_memory_snapshot replaying a synthetic environment, and with the
+        real samplers over the processes of this machine
+    csv_load, csv_save: MemorySnapper.import_from_csv and export_to_csv
+    log_save, log_load: Appending the data to the snapshot log (flush) and reading it back
+    detect_<algo>: MemorySnapper.detect_leaks with each algorithm, from a cold cache
+
+Peak memory is measured with tracemalloc in a separate run of each stage, so it does not slow
+down the timed runs.
+
+Usage::
+    python benchmarks/bench_suite.py --procs 20 100 --samples 1000 4000 --output results.json
+    python benchmarks/bench_suite.py --baseline results.json
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from environments import SyntheticEnvironment, SyntheticSampler
+from memorytools.memoryanalysis import DETECTORS
+from memorytools.memorymonitor import MemorySnapper
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data")
+DEFAULT_CAPTURES = [os.path.join(DATA_DIR, "tdcstst_continuous.csv")] + \
+    sorted(glob.glob(os.path.join(DATA_DIR, "tdcsarv testing", "1s granularity", "csv files", "*.csv")))
+SNAPSHOT_TICKS = 200 # Snapshots timed per run of the snapshot stages
+REGRESSION_THRESHOLD = 1.2 # Slowdown against the baseline reported as a regression
+
+
+class Stage:
+    """A benchmarked operation
+
+    Args:
+        name: Name of the stage
+        dataset: Name of the data the stage runs over
+        setup: Returns the state the stage runs on, called before every run and not timed
+        run: Runs the stage on the state from setup
+        items: Number of items processed by a run, for the throughput
+        unit: What the items are
+    """
+
+    def __init__(self, name, dataset, setup, run, items, unit):
+        self.name = name
+        self.dataset = dataset
+        self.setup = setup
+        self.run = run
+        self.items = items
+        self.unit = unit
+
+    def measure(self, repeats:int)->dict:
+        """Time the stage, then measure its peak memory in a separate run"""
+        best = float("inf")
+        for _ in range(repeats):
+            state = self.setup()
+            start = time.perf_counter()
+            self.run(state)
+            best = min(best, time.perf_counter() - start)
+        state = self.setup()
+        tracemalloc.start()
+        self.run(state)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {"stage": self.name, "dataset": self.dataset, "seconds": best, "items": self.items,
+                "unit": self.unit, "throughput": self.items / best if best > 0 else float("inf"),
+                "peak_bytes": peak}
+
+
+def snapper_from_csv(directory:str, capture:str, name:str)->MemorySnapper:
+    mem_snap = MemorySnapper(existing_data_file=os.path.join(directory, name + ".dat"))
+    mem_snap.import_from_csv(capture)
+    return mem_snap
+
+
+def data_stages(directory:str, dataset:str, capture:str, algorithms)->list:
+    """Stages loading, saving and analysing the data of a CSV capture"""
+    counter = iter(range(1_000_000))
+    def fresh(kind):
+        return os.path.join(directory, f"{dataset}_{kind}_{next(counter)}")
+
+    loaded = snapper_from_csv(directory, capture, f"{dataset}_loaded")
+    loaded.flush()
+    samples = sum(len(loaded[pid].vmss) for pid in loaded.pids)
+
+    def load_log(path):
+        mem_snap = MemorySnapper(existing_data_file=path)
+        for pid in mem_snap.pids:
+            mem_snap[pid].vmss # Data is read lazily
+    stages = [
+        Stage("csv_load", dataset, lambda: MemorySnapper(existing_data_file=fresh("csv_load") + ".dat"),
+              lambda mem_snap: mem_snap.import_from_csv(capture), samples, "samples"),
+        Stage("log_save", dataset, lambda: snapper_from_csv(directory, capture, os.path.basename(fresh("log_save"))),
+              lambda mem_snap: mem_snap.flush(), samples, "samples"),
+        Stage("log_load", dataset, lambda: os.path.join(directory, f"{dataset}_loaded.dat"),
+              load_log, samples, "samples"),
+        Stage("csv_save", dataset, lambda: fresh("csv_save") + ".csv",
+              lambda path: loaded.export_to_csv(path), samples, "samples"),
+    ]
+    for algo in algorithms:
+        def setup(mem_snap=loaded):
+            mem_snap.analysis_module.clear_cache()
+            return mem_snap
+        stages.append(Stage(f"detect_{algo}", dataset, setup,
+                            lambda mem_snap, algo=algo: mem_snap.detect_leaks(algo=algo), samples, "samples"))
+    return stages
+
+
+def snapshot_stage(directory:str, dataset:str, sampler)->Stage:
+    counter = iter(range(1_000_000))
+    def setup():
+        return MemorySnapper(existing_data_file=os.path.join(directory, f"{dataset}_snapshot_{next(counter)}.dat"),
+                             sampler=sampler() if callable(sampler) else sampler)
+    def run(mem_snap):
+        for _ in range(SNAPSHOT_TICKS):
+            mem_snap.take_memory_snapshot()
+    return Stage("snapshot", dataset, setup, run, SNAPSHOT_TICKS, "snapshots")
+
+
+def compare(results:list, baseline:list):
+    """Print the change in time of each stage against a baseline"""
+    previous = {(result["stage"], result["dataset"]): result for result in baseline}
+    regressions = 0
+    print(f"\n{'stage':<18} {'dataset':<30} {'baseline s':>11} {'now s':>9} {'ratio':>7}")
+    for result in results:
+        before = previous.get((result["stage"], result["dataset"]))
+        if before is None:
+            continue
+        ratio = result["seconds"] / before["seconds"] if before["seconds"] > 0 else float("inf")
+        flag = " REGRESSION" if ratio > REGRESSION_THRESHOLD else ""
+        regressions = regressions + bool(flag)
+        print(f"{result['stage']:<18} {result['dataset'][:30]:<30} {before['seconds']:>11.4f} "
+              f"{result['seconds']:>9.4f} {ratio:>6.2f}x{flag}")
+    print(f"{regressions} regressions over {REGRESSION_THRESHOLD}x")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the samplers, data store and leak detectors")
+    parser.add_argument("--procs", type=int, nargs="+", default=[20, 100], help="Numbers of synthetic processes")
+    parser.add_argument("--samples", type=int, nargs="+", default=[1000, 4000], help="Numbers of synthetic snapshots")
+    parser.add_argument("--captures", nargs="*", default=DEFAULT_CAPTURES, help="CSV captures to replay")
+    parser.add_argument("--algorithms", nargs="+", default=sorted(DETECTORS), help="Leak detection algorithms")
+    parser.add_argument("--samplers", nargs="*", default=["psutil", "procfs"],
+                        help="Real samplers to time snapshots of this machine with")
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs of each stage, the best is reported")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    args = parser.parse_args(argv)
+    logging.disable(logging.ERROR)
+
+    results = []
+    print(f"{'stage':<18} {'dataset':<30} {'seconds':>9} {'throughput':>22} {'peak MiB':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        stages = []
+        for sampler in args.samplers:
+            stages.append(snapshot_stage(directory, f"host-{sampler}", sampler))
+        for n_procs in args.procs:
+            for n_samples in args.samples:
+                environment = SyntheticEnvironment(n_procs=n_procs, n_samples=n_samples)
+                dataset = f"synthetic-{n_procs}x{n_samples}"
+                capture = os.path.join(directory, dataset + ".csv")
+                environment.to_csv(capture)
+                stages.append(snapshot_stage(directory, dataset, lambda environment=environment:
+                                             SyntheticSampler(environment)))
+                stages.extend(data_stages(directory, dataset, capture, args.algorithms))
+        for capture in args.captures:
+            stages.extend(data_stages(directory, os.path.basename(capture), capture, args.algorithms))
+
+        for stage in stages:
+            result = stage.measure(args.repeats)
+            results.append(result)
+            print(f"{result['stage']:<18} {result['dataset'][:30]:<30} {result['seconds']:>9.4f} "
+                  f"{result['throughput']:>12.0f} {result['unit'] + '/s':<11} {result['peak_bytes'] / 2**20:>8.1f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {"time": time.time(), "python": platform.python_version(),
+                                "numpy": np.__version__, "platform": platform.platform(),
+                                "cpus": os.cpu_count(), "repeats": args.repeats},
+                       "results": results}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            return compare(results, json.load(f)["results"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
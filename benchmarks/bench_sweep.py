@@ -0,0 +1,129 @@
+"""Sweep the analysis parameters and report the detection quality and run time of each detector
+
+Runs memorytools.sweep.ParameterSweep over synthetic environments, whose leaking processes are
+known (see environments.py), and over the tdcsarv capture of revision 387927, which the
+Hyperparameters notebook records as not leaking, then prints the precision, recall and run time
+of every configuration of the grid summed over the datasets.
+
+A grid is given as NAME=VALUE,VALUE,... for any of the parameters in
+memorytools.sweep.PREPARATION_PARAMETERS and DETECTION_PARAMETERS.
+
+Usage::
+    python benchmarks/bench_sweep.py --workers 4 --output sweep.json
+    python benchmarks/bench_sweep.py --grid R_SQR_MIN=0.8,0.9,0.95 RESAMPLE_MIN_WIN=0.25,0.5
+    python benchmarks/bench_sweep.py --algorithms LBRCPD --grid CPD_METHOD=pelt,binseg CPD_MODEL=l2,linear
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from environments import SyntheticEnvironment
+from memorytools.memoryanalysis import DETECTORS
+from memorytools.memorymonitor import MemorySnapper
+from memorytools.sweep import LabeledDataset, ParameterSweep, parameter_grid, summarise
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "data", "tdcsarv testing", "1s granularity", "csv files")
+#Captures and the names of their leaking processes
+DEFAULT_CAPTURES = {
+    "tdcsarv_387927.csv": [],
+}
+DEFAULT_GRID = [
+    "RESAMPLE_MIN_WIN=0.25,0.5,1.0",
+    "WIN_MIN_NUM_POINTS_DETECT=10,20,60",
+    "R_SQR_MIN=0.8,0.9,0.95",
+    "CRITICAL_TIME_MAX=3600,86400",
+]
+
+
+def parse_value(value):
+    """A number, or null for None, otherwise the string"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_grid(items):
+    grid = {}
+    for item in items:
+        name, values = item.split("=", 1)
+        grid[name] = [parse_value(value) for value in values.split(",")]
+    return grid
+
+
+def synthetic_datasets(sizes, seed):
+    datasets = []
+    for n_procs, n_samples in sizes:
+        environment = SyntheticEnvironment(n_procs=n_procs, n_samples=n_samples, seed=seed)
+        procs = {}
+        for row, pid in enumerate(environment.pids):
+            present = np.flatnonzero(~np.isnan(environment.values[row]))
+            procs[pid] = (environment.names[pid], environment.times[present], environment.values[row, present])
+        datasets.append(LabeledDataset(f"synthetic-{n_procs}x{n_samples}", procs, environment.leaking))
+    return datasets
+
+
+def capture_datasets(captures):
+    datasets = []
+    with tempfile.TemporaryDirectory() as directory:
+        for filename, leaking_names in captures.items():
+            mem_snap = MemorySnapper(existing_data_file=os.path.join(directory, os.path.basename(filename) + ".dat"))
+            mem_snap.import_from_csv(filename)
+            datasets.append(LabeledDataset.from_memory_data(os.path.basename(filename), mem_snap,
+                                                            leaking_names=leaking_names))
+            mem_snap.close()
+    return datasets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep the analysis parameters of the leak detectors")
+    parser.add_argument("--grid", nargs="+", default=DEFAULT_GRID, help="NAME=VALUE,VALUE,... of each parameter")
+    parser.add_argument("--algorithms", nargs="+", default=sorted(DETECTORS), help="Leak detection algorithms")
+    parser.add_argument("--synthetic", nargs="*", default=["50x2000", "100x4000"],
+                        help="PROCSxSAMPLES of each synthetic environment")
+    parser.add_argument("--captures", nargs="*", default=None,
+                        help="CSV captures with no leaking processes, default is the non-leaking tdcsarv capture")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic environments")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args(argv)
+    logging.disable(logging.ERROR)
+
+    captures = {os.path.join(DATA_DIR, name): leaking for name, leaking in DEFAULT_CAPTURES.items()}
+    if args.captures is not None:
+        captures = {filename: [] for filename in args.captures}
+    sizes = [tuple(int(n) for n in size.split("x")) for size in args.synthetic]
+    datasets = synthetic_datasets(sizes, args.seed) + capture_datasets(captures)
+    configurations = parameter_grid(parse_grid(args.grid))
+
+    start = time.perf_counter()
+    results = ParameterSweep(datasets, args.algorithms, workers=args.workers).run(configurations)
+    elapsed = time.perf_counter() - start
+    summaries = summarise(results)
+
+    names = list(configurations[0]) if configurations else []
+    print(" ".join(f"{name[:12]:>12}" for name in names) +
+          f" {'algorithm':<9} {'tp':>4} {'fp':>4} {'fn':>4} {'precision':>9} {'recall':>6} {'detect s':>9}")
+    for summary in sorted(summaries, key=lambda summary: summary["algorithm"]):
+        print(" ".join(f"{str(summary['configuration'][name]):>12}" for name in names) +
+              f" {summary['algorithm']:<9} {summary['tp']:>4} {summary['fp']:>4} {summary['fn']:>4}"
+              f" {summary['precision']:>9.2f} {summary['recall']:>6.2f} {summary['detect_seconds']:>9.3f}")
+    print(f"\n{len(configurations)} configurations x {len(args.algorithms)} algorithms over "
+          f"{len(datasets)} datasets in {elapsed:.1f} s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"datasets": [{"name": dataset.name, "processes": len(dataset.procs),
+                                     "leaking": len(dataset.leaking)} for dataset in datasets],
+                       "results": results, "summaries": summaries, "seconds": elapsed}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Synthetic process environments for the benchmarks
+
+A SyntheticEnvironment is N processes sampled over M snapshots with known memory behaviour, so
+the benchmarks can scale the data independently of the machine they run on and leak detection
+results can be checked against the processes that really leak.
+"""
+import csv
+import os
+import sys
+from typing import Iterable, List, Set, Tuple
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from memorytools.memoryanalysis import MAX_TIME_DIFF
+from memorytools.memorystore import timestamps_to_isoformat
+
+KINDS = ["flat", "leak", "sawtooth", "step"]
+LEAKING_KINDS = {"leak", "sawtooth"} # A sawtooth whose troughs rise is leaking
+
+
+class SyntheticEnvironment:
+    """Memory usage of a synthetic set of processes
+
+    Each process is one of KINDS:
+        flat: constant usage with noise
+        leak: usage growing linearly
+        sawtooth: usage growing then partially freed every period, with rising troughs
+        step: a single jump in usage part way through, not a leak
+
+    On top of its kind a process may have a gap in its samples longer than MAX_TIME_DIFF, and
+    may exit part way through to be replaced by a new process with a new pid (pid churn).
+
+    Args:
+        n_procs: Number of processes present at any time
+        n_samples: Number of snapshots
+        interval: Time between snapshots in seconds
+        leak_fraction: Fraction of processes that leak
+        sawtooth_fraction: Fraction of processes with a sawtooth leak
+        step_fraction: Fraction of processes with a step in usage
+        gap_fraction: Fraction of processes with a gap in their samples
+        churn_fraction: Fraction of processes replaced by a new process part way through
+        leak_rate: Growth of leaking processes in bytes per second
+        noise: Standard deviation of the noise on the usage in bytes
+        seed: Seed of the random number generator
+        start: POSIX timestamp of the first snapshot
+    """
+
+    def __init__(self, n_procs:int=100, n_samples:int=1000, interval:float=0.1,
+                 leak_fraction:float=0.1, sawtooth_fraction:float=0.05, step_fraction:float=0.05,
+                 gap_fraction:float=0.1, churn_fraction:float=0.1, leak_rate:float=1e6,
+                 noise:float=1e5, seed:int=0, start:float=1.7e9):
+        rng = np.random.default_rng(seed)
+        self.n_samples = n_samples
+        self.interval = interval
+        self.times = start + np.arange(n_samples) * interval
+        self.pids = [] # Every pid, in the order of the rows of values
+        self.names = {} # pid -> name
+        self.kinds = {} # pid -> kind
+        self.spans = {} # pid -> (first, last + 1) snapshot the process is present in
+        rows = []
+
+        fractions = [leak_fraction, sawtooth_fraction, step_fraction]
+        n_kinds = [int(round(fraction * n_procs)) for fraction in fractions]
+        kinds = ["leak"] * n_kinds[0] + ["sawtooth"] * n_kinds[1] + ["step"] * n_kinds[2]
+        kinds = kinds + ["flat"] * (n_procs - len(kinds))
+        rng.shuffle(kinds)
+        churned = set(rng.choice(n_procs, int(round(churn_fraction * n_procs)), replace=False))
+        gapped = set(rng.choice(n_procs, int(round(gap_fraction * n_procs)), replace=False))
+        next_pid = 1000
+        for slot, kind in enumerate(kinds):
+            spans = [(0, n_samples)]
+            if slot in churned and n_samples > 4:
+                exit_at = int(rng.integers(n_samples // 4, 3 * n_samples // 4))
+                spans = [(0, exit_at), (exit_at, n_samples)]
+            for i, (first, last) in enumerate(spans):
+                #The replacement of a churned process is a new, non-leaking process
+                proc_kind = kind if i == 0 else "flat"
+                row = self.__usage(rng, proc_kind, first, last, leak_rate, noise)
+                if slot in gapped and i == len(spans) - 1:
+                    self.__add_gap(rng, row, first, last)
+                pid = next_pid
+                next_pid = next_pid + 1 + int(rng.integers(0, 3))
+                self.pids.append(pid)
+                self.names[pid] = f"{proc_kind}_{slot}"
+                self.kinds[pid] = proc_kind
+                self.spans[pid] = (first, last)
+                rows.append(row)
+        self.values = np.vstack(rows) # (processes, snapshots), NaN where a process is absent
+
+    def __usage(self, rng, kind:str, first:int, last:int, leak_rate:float, noise:float)->np.ndarray:
+        row = np.full(self.n_samples, np.nan)
+        n = last - first
+        elapsed = np.arange(n) * self.interval
+        usage = float(rng.integers(50, 500)) * 2**20 + rng.normal(0, noise, n)
+        if kind == "leak":
+            usage = usage + leak_rate * elapsed
+        elif kind == "sawtooth":
+            period = max(n // 3, 1)
+            phase = np.arange(n) % period
+            usage = usage + leak_rate * (phase * self.interval + 0.5 * (np.arange(n) // period) * period * self.interval)
+        elif kind == "step":
+            usage = usage + np.where(np.arange(n) >= n // 2, 50 * 2**20, 0)
+        row[first:last] = np.round(usage)
+        return row
+
+    def __add_gap(self, rng, row:np.ndarray, first:int, last:int):
+        length = int(np.ceil(4 * MAX_TIME_DIFF / self.interval)) # Several times the largest allowed gap
+        if last - first > 4 * length:
+            gap_start = int(rng.integers(first + length, last - 2 * length))
+            row[gap_start:gap_start + length] = np.nan
+
+    @property
+    def leaking(self)->Set[int]:
+        """Pids of the processes that leak"""
+        return {pid for pid, kind in self.kinds.items() if kind in LEAKING_KINDS}
+
+    @property
+    def n_values(self)->int:
+        """Number of samples taken over every process and snapshot"""
+        return int(np.count_nonzero(~np.isnan(self.values)))
+
+    def samples(self, snapshot:int)->List[Tuple[int, int]]:
+        """(pid, memory usage) of each process present in a snapshot"""
+        column = self.values[:, snapshot]
+        present = np.flatnonzero(~np.isnan(column))
+        return [(self.pids[row], int(column[row])) for row in present]
+
+    def to_csv(self, filename:str):
+        """Write the environment as a CSV file MemorySnapper.import_from_csv can read"""
+        with open(filename, "w", newline="") as csvfile:
+            csv.writer(csvfile).writerow(["Process ID", "Process Name", "Time", "Memory Usage"])
+            for row, pid in enumerate(self.pids):
+                present = np.flatnonzero(~np.isnan(self.values[row]))
+                if len(present) == 0:
+                    continue
+                prefix = f"{pid},{self.names[pid]},"
+                rows = np.char.add(np.char.add(prefix, timestamps_to_isoformat(self.times[present])),
+                                   np.char.add(",", self.values[row, present].astype(np.int64).astype(str)))
+                csvfile.write("\r\n".join(rows.tolist()) + "\r\n")
+
+
+class SyntheticSampler:
+    """Sampler replaying a SyntheticEnvironment one snapshot per tick, see memorytools.samplers
+
+    After the last snapshot of the environment the replay starts again from the first.
+    """
+
+    def __init__(self, environment:SyntheticEnvironment):
+        self.environment = environment
+        self.errors = []
+        self.started = set()
+        self.__tick = 0
+        self.__present = set()
+
+    def sample(self, pids:Iterable[int]=None)->List[Tuple[int, int]]:
+        snapshot = self.__tick % self.environment.n_samples
+        self.__tick = self.__tick + 1
+        samples = self.environment.samples(snapshot)
+        if pids is not None:
+            samples = [(pid, vms) for pid, vms in samples if pid in pids]
+        present = {pid for pid, _ in samples}
+        self.started = present - self.__present
+        self.__present = present
+        return samples
+
+    def name(self, pid:int)->str:
+        return self.environment.names[pid]
+
+    def create_time(self, pid:int)->float:
+        return float(self.environment.times[self.environment.spans[pid][0]])
+
+    def close(self):
+        pass
@@ -0,0 +1,255 @@
+import asyncio
+import time
+import weakref
+from typing import Dict, List, Tuple
+
+from .filters import ProcessFilter
+from .memorymonitor import MemorySnapper
+from .memorystore import RetentionPolicy
+
+try:
+    import ccs
+    CCSENV=True
+except ImportError:
+    CCSENV=False
+
+
+class Snapshot:
+    """Samples of one snapshot, as streamed by AsyncMemoryMonitor.snapshots
+
+    Args:
+        time: POSIX timestamp of the snapshot
+        samples: (pid, virtual memory size) of each process sampled
+        total: Total memory usage of the processes recorded
+    """
+
+    def __init__(self, time:float, samples:List[Tuple[int, int]], total:int):
+        self.time = time
+        self.samples = samples
+        self.total = total
+
+    def __repr__(self):
+        return f"Snapshot(time={self.time}, processes={len(self.samples)}, total={self.total})"
+
+
+class SnapshotStream:
+    """Asynchronous iterator over the snapshots taken by an AsyncMemoryMonitor, as returned by
+    AsyncMemoryMonitor.snapshots
+
+    The stream receives every snapshot taken from its creation, not from the first time it is
+    iterated. A stream that is no longer referenced stops receiving snapshots, close can be used
+    to stop it sooner.
+
+    Args:
+        queue_size: Number of snapshots buffered before the oldest are dropped
+    """
+
+    def __init__(self, queue_size:int):
+        self._queue = asyncio.Queue(maxsize=queue_size + 1) # One extra place for the end of the stream
+        self.closed = False # True once the stream receives no more snapshots
+        self.__ended = False # True once the end of the stream has been read
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self)->Snapshot:
+        if self.__ended:
+            raise StopAsyncIteration
+        snapshot = await self._queue.get()
+        if snapshot is None:
+            self.__ended = True
+            raise StopAsyncIteration
+        return snapshot
+
+    def close(self):
+        """Stop receiving snapshots, the stream ends after the snapshots already buffered"""
+        if not self.closed:
+            self.closed = True
+            if self._queue.full():
+                self._queue.get_nowait()
+            self._queue.put_nowait(None)
+
+
+class AsyncMemoryMonitor(MemorySnapper):
+    """Continuous monitoring of processes memory usage as a task of a running asyncio event loop
+
+    Unlike MemoryMonitor no thread is started, snapshots are taken by a task of the loop the
+    monitor is started in, so the monitor never competes for the GIL with the code it observes.
+    The processes of a snapshot are read batch_size at a time and the task yields to the loop
+    between batches, so other tasks of the loop are never held up by more than one batch. Reading
+    process memory is a system call on files of procfs that does not wait for I/O, the "procfs"
+    sampler keeps the batches cheapest.
+
+    Snapshots are taken at fixed deadlines of the loop's clock, deadlines that have already passed
+    when a snapshot completes are skipped and counted in stats.missed_ticks. Snapshots are
+    appended to the data file every flush_interval, and when the monitor is stopped, by a thread
+    of the loop's default executor so the loop is not blocked on the file.
+
+    Args:
+        data_file: Path to the data file for persistence across instances
+        time_interval: Time interval between snapshots in seconds
+        flush_interval: Time interval between appending new snapshots to the data file in seconds
+        sampler: Sampler used to read process memory, see MemoryMonitor
+        env_refresh_interval: Time interval between refreshing the list of CCS environment
+            processes in seconds
+        detector: OnlineLeakDetector updated with every snapshot, see MemoryMonitor
+        retention: RetentionPolicy bounding the data held in memory, see MemoryMonitor
+        process_filter: ProcessFilter selecting the processes sampled, see MemoryMonitor
+        metrics: Metrics sampled besides vms with their intervals, see MemoryMonitor
+        batch_size: Number of processes read before yielding to the event loop
+        queue_size: Number of snapshots buffered for each consumer of snapshots, when a consumer
+            falls further behind its oldest snapshots are dropped and counted in dropped_snapshots
+
+    Example usage::
+        >>> async with AsyncMemoryMonitor(data_file="memory_data.dat", time_interval=0.1) as mem_monitor:
+        ...     async for snapshot in mem_monitor.snapshots():
+        ...         print(snapshot.time, snapshot.total)
+    """
+
+    def __init__(self, data_file=None, time_interval:float=0.005, flush_interval:float=10.0,
+                 sampler=None, env_refresh_interval:float=1.0, detector=None,
+                 retention:RetentionPolicy=None, process_filter:ProcessFilter=None,
+                 metrics:Dict[str, float]=None, batch_size:int=64, queue_size:int=1024):
+        super().__init__(existing_data_file=data_file, sampler=sampler,
+                         env_refresh_interval=env_refresh_interval, retention=retention,
+                         process_filter=process_filter, metrics=metrics)
+        self.detector = detector
+        self.time_interval = time_interval
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.dropped_snapshots = 0 # Snapshots dropped because a consumer fell behind
+        self.stats.requested_interval = time_interval
+        self.stats.interval = time_interval
+        self.__streams = weakref.WeakSet() # SnapshotStream of each consumer of snapshots
+        self.__task = None
+        self.__sleeping = False # True while the monitor task waits for its next deadline
+        self.__monitoring = False
+
+    async def take_memory_snapshot_async(self)->Snapshot:
+        """Take a snapshot as take_memory_snapshot, yielding to the event loop between batches of processes
+
+        Returns:
+            The snapshot taken, as sent to the consumers of snapshots
+        """
+        start = time.monotonic()
+        env_pids = self._environment_pids() if CCSENV else None
+        snapshot, timestamp = self._begin_snapshot()
+        samples = []
+        total_mem = 0
+        pids = self._pids_to_sample(env_pids)
+        metrics = self._due_metrics(start)
+        sample_batches = getattr(self.sampler, "sample_batches", None)
+        if sample_batches is not None:
+            batches = sample_batches(pids, self.batch_size, metrics=metrics) if metrics else \
+                sample_batches(pids, self.batch_size)
+        else:
+            batches = [self.sampler.sample(pids, metrics=metrics) if metrics else self.sampler.sample(pids)]
+        for batch in batches:
+            samples.extend(batch)
+            total_mem = total_mem + self._add_samples(snapshot, batch, env_pids)
+            await asyncio.sleep(0)
+        if metrics:
+            self._add_metric_values(snapshot, self.sampler.values)
+        self._end_snapshot(snapshot, timestamp, samples, total_mem, start)
+        result = Snapshot(timestamp, samples, total_mem)
+        self.__publish(result)
+        return result
+
+    def __publish(self, snapshot):
+        for stream in list(self.__streams):
+            if stream.closed:
+                continue
+            queue = stream._queue
+            if queue.full():
+                queue.get_nowait()
+                self.dropped_snapshots = self.dropped_snapshots + 1
+            queue.put_nowait(snapshot)
+
+    def snapshots(self)->SnapshotStream:
+        """Stream the snapshots taken from now on until the monitor is stopped
+
+        Each call is a separate consumer receiving every snapshot, buffered up to queue_size. The
+        consumer is registered by this call, so snapshots taken before the stream is first
+        iterated are not missed.
+
+        Example usage::
+            >>> async for snapshot in mem_monitor.snapshots():
+            ...     if snapshot.total > limit:
+            ...         break
+        """
+        stream = SnapshotStream(self.queue_size)
+        self.__streams.add(stream)
+        return stream
+
+    async def start(self):
+        """Start taking snapshots in a task of the running event loop"""
+        if self.__monitoring:
+            raise RuntimeError("Monitor is already running")
+        self.__monitoring = True
+        self.__task = asyncio.get_running_loop().create_task(self.__monitor_loop())
+
+    async def stop(self):
+        """Stop taking snapshots, append the snapshots taken to the data file and end every stream of snapshots
+
+        A snapshot being taken is completed first.
+        """
+        if self.__task is None:
+            self.logger().error("Cannot stop monitor as it is not running.")
+            return
+        self.__monitoring = False
+        if self.__sleeping:
+            self.__task.cancel()
+        try:
+            await self.__task
+        except asyncio.CancelledError:
+            if not self.__task.cancelled():
+                raise
+        self.__task = None
+        #Writing the data file blocks, keep it off the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self.flush)
+        for stream in list(self.__streams):
+            stream.close()
+
+    def is_monitoring(self)->bool:
+        return self.__monitoring
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+
+    async def __monitor_loop(self):
+        loop = asyncio.get_running_loop()
+        last_flush = loop.time()
+        deadline = loop.time()
+        while self.__monitoring:
+            await self.take_memory_snapshot_async()
+            if loop.time() - last_flush >= self.flush_interval:
+                await loop.run_in_executor(None, self.flush)
+                last_flush = loop.time()
+            deadline = deadline + self.time_interval
+            now = loop.time()
+            if now >= deadline:
+                #Skip the deadlines that have already passed rather than bunching snapshots up
+                missed = int((now - deadline) // self.time_interval) + 1
+                self.stats.missed_ticks = self.stats.missed_ticks + missed
+                deadline = deadline + missed * self.time_interval
+            if not self.__monitoring:
+                break
+            self.__sleeping = True
+            try:
+                await asyncio.sleep(deadline - now)
+            except asyncio.CancelledError:
+                if self.__monitoring:
+                    raise
+                break
+            finally:
+                self.__sleeping = False
+
+    def close(self):
+        if self.__task is not None:
+            raise RuntimeError("Stop the monitor with await stop() before closing it")
+        super().close()
@@ -0,0 +1,212 @@
+import fnmatch
+import os
+import time
+from typing import Dict, Iterable, List, Set
+
+import psutil as ps
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+class ProcessFilter:
+    """Selects the processes a snapper samples, so only they are read each tick
+
+    A process is sampled when it matches any include criterion and no exclude criterion. With no
+    include criteria every process not excluded is sampled.
+
+    The whole process table is only walked every refresh_interval seconds to resolve the criteria
+    to pids. In between, the cgroups are re-read and new children of the processes of the
+    included and excluded trees are found from /proc/<pid>/task/*/children (Linux), so
+    children of tracked processes, and processes moved into an included or excluded cgroup, are
+    picked up on the next tick. Processes that start in between otherwise, matching a name or,
+    with only exclude criteria, any new process, are picked up at the next refresh, as are
+    processes moved out of a cgroup.
+
+    Args:
+        pids: Pids of processes to include
+        names: Glob patterns of names of processes to include, e.g. "python*"
+        trees: Pids of processes included with all their descendants
+        cgroups: cgroup paths, relative to /sys/fs/cgroup or absolute, whose processes (and those
+            of their child cgroups) are included
+        exclude_pids: Pids of processes to exclude
+        exclude_names: Glob patterns of names of processes to exclude
+        exclude_trees: Pids of processes excluded with all their descendants
+        exclude_cgroups: cgroup paths whose processes are excluded
+        refresh_interval: Time interval between walking the process table in seconds
+
+    Example usage::
+        >>> process_filter = ProcessFilter(names=["tdcs*"], trees=[os.getpid()], exclude_names=["bash"])
+        >>> mem_monitor = MemoryMonitor(process_filter=process_filter)
+    """
+
+    def __init__(self, pids:Iterable[int]=(), names:Iterable[str]=(), trees:Iterable[int]=(),
+                 cgroups:Iterable[str]=(), exclude_pids:Iterable[int]=(), exclude_names:Iterable[str]=(),
+                 exclude_trees:Iterable[int]=(), exclude_cgroups:Iterable[str]=(),
+                 refresh_interval:float=5.0):
+        self.pids = set(pids)
+        self.names = list(names)
+        self.trees = set(trees)
+        self.cgroups = [self.cgroup_dir(cgroup) for cgroup in cgroups]
+        self.exclude_pids = set(exclude_pids)
+        self.exclude_names = list(exclude_names)
+        self.exclude_trees = set(exclude_trees)
+        self.exclude_cgroups = [self.cgroup_dir(cgroup) for cgroup in exclude_cgroups]
+        self.refresh_interval = refresh_interval
+        self.__refreshed = None
+        self.__selected = None # Pids to sample
+        self.__tree_pids = set() # Pids in the included trees
+        self.__excluded_tree_pids = set() # Pids in the excluded trees
+        self.__cgroup_files = [] # cgroup.procs of the included cgroups and their children
+        self.__excluded_cgroup_files = []
+
+    @staticmethod
+    def cgroup_dir(cgroup:str)->str:
+        """Directory of a cgroup given by its path, as in /proc/<pid>/cgroup, or its directory"""
+        if cgroup.startswith(CGROUP_ROOT):
+            return cgroup
+        return os.path.join(CGROUP_ROOT, cgroup.lstrip("/"))
+
+    @property
+    def includes(self)->bool:
+        """True if any include criterion is given"""
+        return bool(self.pids or self.names or self.trees or self.cgroups)
+
+    @property
+    def excludes(self)->bool:
+        """True if any exclude criterion is given"""
+        return bool(self.exclude_pids or self.exclude_names or self.exclude_trees or self.exclude_cgroups)
+
+    def __getstate__(self):
+        #Resolved each time from scratch by a sampler process the filter is sent to
+        state = self.__dict__.copy()
+        state["_ProcessFilter__refreshed"] = None
+        return state
+
+    def resolve(self)->Set[int]:
+        """Pids of the processes to sample this tick, or None to sample every process"""
+        if not self.includes and not self.excludes:
+            return None
+        now = time.monotonic()
+        if self.__refreshed is None or now - self.__refreshed >= self.refresh_interval:
+            self.__refresh()
+            self.__refreshed = now
+        else:
+            self.__update()
+        return self.__selected
+
+    def forget(self, pids:Iterable[int]):
+        """Stop sampling processes that have exited, until the next refresh finds them again"""
+        if self.__selected is None:
+            return
+        for pid in pids:
+            self.__selected.discard(pid)
+            self.__tree_pids.discard(pid)
+            self.__excluded_tree_pids.discard(pid)
+
+    def __refresh(self):
+        """Resolve every criterion from a walk of the process table"""
+        names = {} # pid -> name
+        children = {} # pid -> pids of its children
+        for p in ps.process_iter(["name", "ppid"]):
+            names[p.pid] = p.info["name"] or ""
+            children.setdefault(p.info["ppid"], []).append(p.pid)
+        self.__tree_pids = self.__descendants(self.trees & set(names), children)
+        self.__excluded_tree_pids = self.__descendants(self.exclude_trees & set(names), children)
+        self.__cgroup_files = self.__procs_files(self.cgroups)
+        self.__excluded_cgroup_files = self.__procs_files(self.exclude_cgroups)
+
+        if self.includes:
+            selected = (self.pids & set(names)) | self.__tree_pids | self.__read_procs(self.__cgroup_files)
+            selected.update(pid for pid, name in names.items() if self.__matches(name, self.names))
+        else:
+            selected = set(names)
+        excluded = self.exclude_pids | self.__excluded_tree_pids | self.__read_procs(self.__excluded_cgroup_files)
+        excluded.update(pid for pid, name in names.items() if self.__matches(name, self.exclude_names))
+        self.__selected = selected - excluded
+
+    def __update(self):
+        """Add the processes that joined the trees and cgroups since the last tick, and drop those
+        that joined the excluded cgroups"""
+        excluded_cgroup_pids = self.__read_procs(self.__excluded_cgroup_files)
+        for pid in self.__new_children(self.__excluded_tree_pids):
+            self.__excluded_tree_pids.add(pid)
+            self.__selected.discard(pid)
+        new_pids = self.__read_procs(self.__cgroup_files) - self.__selected
+        for pid in self.__new_children(self.__tree_pids):
+            self.__tree_pids.add(pid)
+            new_pids.add(pid)
+        for pid in new_pids:
+            if pid in self.exclude_pids or pid in self.__excluded_tree_pids or pid in excluded_cgroup_pids:
+                continue
+            if self.exclude_names:
+                try:
+                    if self.__matches(ps.Process(pid).name(), self.exclude_names):
+                        continue
+                except ps.Error:
+                    continue
+            self.__selected.add(pid)
+        self.__selected.difference_update(excluded_cgroup_pids)
+
+    @staticmethod
+    def __matches(name:str, patterns:List[str])->bool:
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    @staticmethod
+    def __descendants(roots:Set[int], children:Dict[int, List[int]])->Set[int]:
+        found = set()
+        stack = list(roots)
+        while stack:
+            pid = stack.pop()
+            if pid not in found:
+                found.add(pid)
+                stack.extend(children.get(pid, []))
+        return found
+
+    @staticmethod
+    def __children(pid:int)->List[int]:
+        """Children of a process, forked by any of its threads"""
+        children = []
+        try:
+            tids = os.listdir(f"/proc/{pid}/task")
+        except OSError:
+            return children # The process has exited
+        for tid in tids:
+            try:
+                with open(f"/proc/{pid}/task/{tid}/children", "rb") as f:
+                    children.extend(int(child) for child in f.read().split())
+            except (OSError, ValueError):
+                continue # The thread has exited
+        return children
+
+    @staticmethod
+    def __new_children(tree_pids:Set[int])->Set[int]:
+        """Children of processes in a tree that are not in it yet, and all their descendants"""
+        new = set()
+        stack = list(tree_pids)
+        while stack:
+            pid = stack.pop()
+            for child in ProcessFilter.__children(pid):
+                if child not in tree_pids and child not in new:
+                    new.add(child)
+                    stack.append(child)
+        return new
+
+    @staticmethod
+    def __procs_files(cgroup_dirs:List[str])->List[str]:
+        files = []
+        for cgroup_dir in cgroup_dirs:
+            for directory, _, filenames in os.walk(cgroup_dir):
+                if "cgroup.procs" in filenames:
+                    files.append(os.path.join(directory, "cgroup.procs"))
+        return files
+
+    @staticmethod
+    def __read_procs(files:List[str])->Set[int]:
+        pids = set()
+        for filename in files:
+            try:
+                with open(filename, "rb") as f:
+                    pids.update(int(pid) for pid in f.read().split())
+            except OSError:
+                continue # The cgroup has been removed
+        return pids
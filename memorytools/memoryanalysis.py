@@ -1,10 +1,13 @@
+import collections
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
 import datetime
+import heapq
 import logging
-from typing import List, Tuple
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable, Dict, List, Set, Tuple
 
 from matplotlib import pyplot as plt
-from matplotlib.dates import date2num
 import numpy as np
 import psutil as ps
 import scipy
@@ -12,6 +15,9 @@ import ruptures as rpt
 import ruptures.show
 import scipy.interpolate
 import scipy.stats
+import time
+
+from .memorystore import GrowableArray
 
 
 try:
@@ -29,14 +35,30 @@ R_SQR_MIN = 0.9 #Require an increased confidence from the papers default of 0.8
 CRITICAL_TIME_MAX = 60*60*1 # 1 hours
 CRITICAL_MEMORY_USAGE = ps.virtual_memory().total
 MAX_TIME_DIFF = 0.5
+SECONDS_PER_DAY = timedelta(days=1).total_seconds()
 
 CPD_THRESHOLD = 3 # 3 times the standard deviation, from paper
+CPD_METHOD = "pelt" # Change point search used by LBRCPD, "pelt", "binseg" or "decimate"
+CPD_MODEL = "l2" # Cost model used by LBRCPD, "l2" or "linear" for binseg and decimate
+CPD_TIME_BUDGET = None # Seconds the binseg and decimate searches may take per series, None is unbounded
+CPD_MIN_SIZE = 5 # Minimum number of points between change points for binseg and decimate
+CPD_MAX_POINTS = 4096 # Points a series is decimated to before the decimate search
+BATCH_MAX_ELEMENTS = 2**22 # Elements of the (processes x time) matrix regressed at once by LBRBATCH
+PREPARED_CACHE_MAX_BYTES = 256 * 2**20 # Bytes of prepared series a MemoryAnalysis keeps between detect_leaks calls
         
 class MemoryAnalysis():
-    """Class to analyse memory data to be used in conjunction with MemorySnapper/MemoryMonitor"""
+    """Class to analyse memory data to be used in conjunction with MemorySnapper/MemoryMonitor
+
+    Args:
+        memory_data: MemorySnapper, or other mapping of pids to the memory data of processes
+        cache_max_bytes: Bytes of prepared series kept between detect_leaks calls, the least
+            recently used are discarded first
+    """
 
-    def __init__(self, memory_data=None) -> None:
+    def __init__(self, memory_data=None, cache_max_bytes:int=PREPARED_CACHE_MAX_BYTES) -> None:
         self.__memory_data = memory_data
+        self.cache_max_bytes = cache_max_bytes
+        self.__prepared = collections.OrderedDict() # pid -> PreparedSeries, least recently used first
 
     def resample_data(self, times, vmss):
         """Resample the memory data to a fixed time interval"""
@@ -53,27 +75,91 @@ class MemoryAnalysis():
 
         return ts_new, vmss_new
 
-    def detect_leaks(self,algo="linefit")->Tuple[List[str],List[int]]:
+    def _algorithm(self, algo:str):
+        """The function running a leak detection algorithm over a list of pids"""
+        if algo not in DETECTORS:
+            raise NotImplementedError(algo)
+        return lambda pids=None: self.run_detector(algo, pids)
+
+    def prepare(self, pid:int)->"PreparedSeries":
+        """The memory data of a process prepared for the leak detectors
+
+        Prepared series are cached, so detectors run over the same data share the gap splitting
+        and resampling. A cached series is reused while the process has the same number of
+        samples, and extended when samples have been added after its last sample. It is prepared
+        again when earlier samples have changed, as when they are discarded by a retention policy.
+        """
+        input_data = self.__memory_data[pid]
+        times = input_data.times
+        n = len(times)
+        series = self.__prepared.get(pid)
+        if series is not None:
+            self.__prepared.move_to_end(pid)
+            prepared = len(series.times)
+            if prepared == 0 or prepared > n or series.times[0] != times[0] or \
+                    series.times[-1] != times[prepared - 1]:
+                series = None
+            elif prepared < n:
+                series.extend(times[prepared:], input_data.vmss[prepared:])
+        if series is None:
+            series = PreparedSeries(pid, input_data.name, times, input_data.vmss, self.resample_data)
+            self.__prepared[pid] = series
+        return series
+
+    def clear_cache(self):
+        """Discard every prepared series"""
+        self.__prepared.clear()
+
+    @property
+    def cache_nbytes(self)->int:
+        """Number of bytes allocated to the cached prepared series"""
+        return sum(series.nbytes for series in self.__prepared.values())
+
+    def __evict_prepared(self):
+        """Discard the least recently used prepared series until the cache fits cache_max_bytes"""
+        nbytes = self.cache_nbytes
+        while nbytes > self.cache_max_bytes and self.__prepared:
+            _, series = self.__prepared.popitem(last=False)
+            nbytes = nbytes - series.nbytes
+
+    def run_detector(self, algo:str, pids:List[int]=None)->Tuple[List[str],List[int]]:
+        """Run a leak detector from DETECTORS over the prepared data of each process
+
+        Args:
+            algo: Name the detector is registered under
+            pids: Process ids to analyse, default is None which analyses all processes
+
+        Returns:
+            A set of names and pids of processes that are abnormally using memory
+        """
+        if algo not in DETECTORS:
+            raise NotImplementedError(algo)
+        detector = DETECTORS[algo](self)
+        leaking = detector.detect([self.prepare(pid) for pid in self._pids(pids)])
+        #The cache may go over its limit while a detector runs, as every series is held until then
+        self.__evict_prepared()
+        return ({series.name for series in leaking}, {series.pid for series in leaking})
+
+    def detect_leaks(self,algo="linefit", pids:List[int]=None, workers:int=None)->Tuple[List[str],List[int]]:
         """ Detect memory leaks using a given algorithm
 
         Args:
             algo: Algorithm to use to detect memory leaks
+            pids: Process ids to analyse, default is None which analyses all processes
+            workers: Number of worker processes to analyse processes in parallel, default is None
+                which analyses every process in this process
 
         Returns:
-            A set of names and pids of processes that are abnormally using memory
+            The names and pids of processes that are abnormally using memory, each sorted so the
+            result does not depend on whether the processes were analysed in parallel
         """
-        if algo=="linefit":
-            __algo = self.detect_leaks_line_fit
-        elif algo=="LBR":
-            __algo = self.detect_leaks_linear_backward_regression
-        elif algo=="LBRCPD":
-            __algo = self.linear_backward_regression_with_change_points    
+        __algo = self._algorithm(algo)
+        if workers is not None and workers > 1:
+            abnorm_names, abnorm_pids = self._detect_leaks_parallel(algo, self._pids(pids), workers)
         else:
-            raise NotImplementedError()
-
-        abnorm_names, abnorm_pids = __algo()
-        abnorm_names = list(abnorm_names)
-        abnorm_pids = list(abnorm_pids)
+            abnorm_names, abnorm_pids = __algo(pids)
+        abnorm_names = sorted(abnorm_names)
+        abnorm_pids = sorted(abnorm_pids)
 
         for pid in abnorm_pids:
             self.logger().warning(f"Abnormal memory usage detected in process: {self.__memory_data[pid].name}"
@@ -88,7 +174,62 @@ class MemoryAnalysis():
             return logging.getLogger(__name__)
 
 
-    def detect_leaks_line_fit(self)->Tuple[List[str],List[int]]:
+    def _detect_leaks_parallel(self, algo:str, pids:List[int], workers:int)->Tuple[Set[str],Set[int]]:
+        """Detect memory leaks by fanning processes out to a pool of worker processes
+
+        The times and memory usage of every process are copied once into two shared memory
+        blocks that workers read in place. Processes are split, in pid order, into contiguous
+        chunks and the results and log records of each chunk are merged in that order, so the
+        outcome does not depend on which worker finishes first.
+        """
+        pids = sorted(pids)
+        if len(pids) == 0:
+            return set(), set()
+        procs = [self.__memory_data[pid] for pid in pids]
+        lengths = np.array([len(proc.times) for proc in procs], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        table = [(pid, proc.name, int(end - length), int(end))
+                 for pid, proc, length, end in zip(pids, procs, lengths, ends)]
+        total = int(ends[-1])
+
+        times_shm = SharedMemory(create=True, size=max(total, 1) * 8)
+        vmss_shm = SharedMemory(create=True, size=max(total, 1) * 8)
+        try:
+            times = np.ndarray((total,), dtype=np.float64, buffer=times_shm.buf)
+            vmss = np.ndarray((total,), dtype=np.float64, buffer=vmss_shm.buf)
+            for (pid, name, start, end), proc in zip(table, procs):
+                times[start:end] = proc.times
+                vmss[start:end] = proc.vmss
+            del times, vmss, procs
+
+            chunks = [chunk for chunk in np.array_split(np.arange(len(table)), workers * 4)
+                      if len(chunk) != 0]
+            level = self.logger().getEffectiveLevel()
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_detect_leaks_worker, algo, times_shm.name, vmss_shm.name,
+                                       total, [table[i] for i in chunk], level)
+                           for chunk in chunks]
+                results = [future.result() for future in futures]
+        finally:
+            times_shm.close()
+            times_shm.unlink()
+            vmss_shm.close()
+            vmss_shm.unlink()
+
+        abnorm_pids = set()
+        logger = self.logger()
+        for chunk_names, chunk_pids, records in results:
+            for record in records:
+                logger.handle(record)
+            abnorm_pids.update(chunk_pids)
+        names = {pid: name for pid, name, *_ in table}
+        return {names[pid] for pid in abnorm_pids}, abnorm_pids
+
+    def _pids(self, pids:List[int]=None)->List[int]:
+        """The pids to analyse, all processes in the memory data when pids is None"""
+        return self.__memory_data.pids if pids is None else pids
+
+    def detect_leaks_line_fit(self, pids:List[int]=None)->Tuple[List[str],List[int]]:
         """
         Fit a line to the avalible memory data, assuming a 'nice' fit and if it has a particuarly 
         large gradient then suggest it as a memory leaking process.
@@ -96,129 +237,224 @@ class MemoryAnalysis():
         Returns:
             A set of names and pids of processes that are abnormally using memory
         """
-        abnorm_names = set()
-        abnorm_pids = set()
-        for proc in self.__memory_data.pids:
-            m,c  = np.polyfit(date2num(self.__memory_data[proc].times),
-                                self.__memory_data[proc].vmss,
-                                1) #Fit a straight line to the data
-            if m>0.1:
-                abnorm_names.add(self.__memory_data[proc].name)
-                abnorm_pids.add(proc)
-        return (abnorm_names, abnorm_pids)
+        return self.run_detector("linefit", pids)
 
-    def detect_leaks_linear_backward_regression(self)->Tuple[List[str],List[int]]:
+    def detect_leaks_linear_backward_regression(self, pids:List[int]=None)->Tuple[List[str],List[int]]:
         """Detect memory leaks using the linear backward regression algorithm
+
+        Args:
+            pids: Process ids to analyse, default is None which analyses all processes
         """
-        anomalus_names = set()
-        anomalus_pids = set()
-        #Init counters for how well we have been able to process a dataset
-        unable_to_process = 0
-        attempts_to_process = 0
-
-        for pid in self.__memory_data.pids:
-            self.logger().info(f"Processing {self.__memory_data[pid].name}-{pid}")
-            # DEBUG INFO COUNTERS
-            attempts_to_process = attempts_to_process + 1 
-            attempts_to_resample = 0 # Local number of resamplings we have attempted
-            unable_to_resample = 0 # Local number of resamplings we have been unable to do
-            processed = False #Flag to indicate if we have processed this PID
-            
-            ##PREPROCESSING
-
-            #Storing locally data
-            input_data = self.__memory_data[pid]
-            #Get time as a float, only care about number at this point
-            ts_full = list(map(datetime.datetime.timestamp, input_data.times))
-            vmss_full = input_data.vmss
-            
-            ## GAP ANALYSIS AND FILTERING ##
-            #We need to ensure that we are not creating windows which includes a large gap in input_data.times
-            # data with such gaps is not reliable when resampled and should be considered a separate data set in the below case
-            # We will do this by finding gaps above a threshold in the data and splitting the data into separate data sets on these
-            # gaps
-            ts_diff = np.diff(ts_full)
-            ts_diff = np.insert(ts_diff,0,0) #Insert a 0 at the start to keep the array the same length
-
-            #Find the gaps
-            gaps = np.where(ts_diff>MAX_TIME_DIFF)[0]
-            self.logger().debug(f"{input_data.name}-{pid}: Found {len(gaps)} gaps in data")
-            if len(gaps) != 0:
-                #We have gaps, we need to split the data
-                ts_splits = np.split(ts_full,gaps)
-                vmss_splits = np.split(vmss_full,gaps)
-            else:
-                ts_splits = [ts_full]
-                vmss_splits = [vmss_full]
-
-            ## RESAMPLING ##
-            for i in range(len(ts_splits)):
-                ts = ts_splits[i]
-                ys = vmss_splits[i]
-                
-                #Now we need to resample the data   
-                try:
-                    attempts_to_resample = attempts_to_resample + 1
-                    ts_rsampl, vmss_rsampl = self.resample_data(ts, ys)
-                except ValueError:
-                    unable_to_resample = unable_to_resample + 1
-                    continue
-                processed = True 
-
-                ###LINEAR REGRESSION ###
-                # Now we do the linear regression
-                i = WIN_MIN_NUM_POINTS_DETECT
-                window_max = len(ts_rsampl)
-                n = len(ts_rsampl)
-                while(i<= n and i<=window_max):
-                    self.logger().debug(f"{input_data.name}-{pid}: Processing window {n-i}/{n}")
-                    ts = ts_rsampl[n-i:n]
-                    ys = vmss_rsampl[n-i:n]
-                        
-                    m,c,r_pcc,*_ =scipy.stats.linregress(ts,ys) #Gives us Pearson correlation coeff unlike np.polyfit
-                    #Now we do some more inteligent stuff compared to linefit
-                    r2 = r_pcc**2 #Rsquare is the square of the pearson correlation coefficient
-                    if m == 0:
-                        t_crit = np.inf # No memory leak, gradient flat
-                    else:
-                        t_crit = (CRITICAL_MEMORY_USAGE - c)/m
-
-                    if (r2>=R_SQR_MIN and t_crit > CRITICAL_TIME_MAX):
-                        
-                        if (DEBUG_PLOTTING):
-                            plt.scatter(input_data.times,input_data.vmss, label="Recorded data", marker="x")
-                            plt.scatter(list(map(datetime.datetime.fromtimestamp,ts)),ys, label="Resampled leaking window",marker="x")
-                            plt.xticks(rotation = 40) 
-                            plt.xlabel("Time stamp")
-                            plt.ylabel("Memory usage (Bytes)")
-                            #Add a label with the gradient and intercept and r2
-                            plt.title(f"{input_data.name}-{pid}:\n $R^2$: {r2:.2f}")
-                            plt.legend()
-                            plt.show()
-                        anomalus_names.add(self.__memory_data[pid].name)
-                        anomalus_pids.add(pid)
-                        break #Proc has issues, escape    
-
-                    i = i+1
-            if (processed  == False):
-                #We were unable to process this PID due to it not being well formed enough, report this
-                unable_to_process = unable_to_process + 1
-                self.logger().warning(f"{input_data.name}-{pid}: Insufficient data for process {input_data.name} with pid {pid}")
-                self.logger().warning(f"{input_data.name}-{pid}: Unable to resample {unable_to_resample}/{attempts_to_resample}")
-            else:
-                self.logger().info(f"{input_data.name}-{pid}: Unable to resample {unable_to_resample}/{attempts_to_resample}")
-        if (unable_to_process > 0 and attempts_to_process > 0):
-            self.logger().warning("Unable to process %d/%d",unable_to_process, attempts_to_process)
-        return (anomalus_names, anomalus_pids)
+        return self.run_detector("LBR", pids)
+
 
+    def backward_regression(self, ts, ys) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Fit a line to every backward window of a series in a single vectorized pass
 
-    def change_points_detection(self, times, values, model="l2")->List[int]:
-        """Calculate change points for the data set provided using the ruptures package
+        Windows all end at the last sample and grow backwards one point at a time, from
+        WIN_MIN_NUM_POINTS_DETECT points up to the full series. Rather than refitting each window,
+        running sums of t, y, t^2, t*y and y^2 are accumulated from the end of the series so every
+        window's fit is available in O(n). Times and values are taken relative to the last sample
+        to limit the cancellation error in the sums.
+
+        Args:
+            ts: Sample times, in seconds
+            ys: Sample values
+
+        Returns:
+            Window sizes and the gradient, intercept and R^2 of the fit over each window
+        """
+        ts = np.asarray(ts, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        n = len(ts)
+        windows = np.arange(WIN_MIN_NUM_POINTS_DETECT, n + 1)
+        if len(windows) == 0:
+            empty = np.empty(0)
+            return windows, empty, empty, empty
+
+        t0 = ts[-1]
+        y0 = ys[-1]
+        t_rev = ts[::-1] - t0
+        y_rev = ys[::-1] - y0
+        sums = [np.cumsum(values)[windows - 1]
+                for values in (t_rev, y_rev, t_rev * t_rev, t_rev * y_rev, y_rev * y_rev)]
+        return (windows,) + self.__fit_sums(windows.astype(float), t0, y0, *sums)
+
+    def backward_regression_windows(self, ts, ys, windows) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Fit a line to some backward windows of a series only, as backward_regression
+
+        The sums of each window are accumulated from the sums over the pieces of the series
+        between consecutive window starts, so only the samples within the largest window are read
+        and only len(windows) fits are made.
+
+        Args:
+            ts: Sample times, in seconds
+            ys: Sample values
+            windows: Number of points of each window, ending at the last sample
+
+        Returns:
+            The gradient, intercept and R^2 of the fit over each window, in the order of windows
+        """
+        windows = np.asarray(windows, dtype=np.int64)
+        if len(windows) == 0:
+            empty = np.empty(0)
+            return empty, empty, empty
+        ts = np.asarray(ts, dtype=float)
+        ys = np.asarray(ys, dtype=float)
+        sizes, order = np.unique(windows, return_inverse=True)
+        t0 = ts[-1]
+        y0 = ys[-1]
+        t_rev = ts[:-sizes[-1] - 1:-1] - t0
+        y_rev = ys[:-sizes[-1] - 1:-1] - y0
+        pieces = np.concatenate(([0], sizes[:-1]))
+        sums = [np.cumsum(np.add.reduceat(values, pieces))[order]
+                for values in (t_rev, y_rev, t_rev * t_rev, t_rev * y_rev, y_rev * y_rev)]
+        return self.__fit_sums(windows.astype(float), t0, y0, *sums)
+
+    @staticmethod
+    def __fit_sums(k, t0, y0, sum_t, sum_y, sum_tt, sum_ty, sum_yy) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Gradient, intercept and R^2 of windows of k points from their sums, relative to (t0, y0)"""
+        #Sums of squares about the window means, as used by scipy.stats.linregress
+        ss_tt = sum_tt - sum_t * sum_t / k
+        ss_ty = sum_ty - sum_t * sum_y / k
+        ss_yy = np.maximum(sum_yy - sum_y * sum_y / k, 0)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ms = ss_ty / ss_tt
+            r_den = np.sqrt(ss_tt * ss_yy)
+            r_pcc = np.where(r_den == 0, 0.0, ss_ty / r_den)
+        r2s = np.minimum(r_pcc**2, 1.0)
+        cs = (y0 + sum_y / k) - ms * (t0 + sum_t / k)
+        return ms, cs, r2s
+
+    def resample_matrix(self, pids:List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Resampled segments of processes side by side in a matrix, one row per process
+
+        Each row holds the segments of a process, as resampled for
+        detect_leaks_linear_backward_regression on a grid starting at the first sample of each
+        segment, one after the other and separated by a NaN. The windows of each row are then
+        those of the segments. Rows are padded with NaN to the longest row.
+
+        Args:
+            pids: Process ids, in row order
+
+        Returns:
+            (len(pids), width) arrays of the resampled times and memory usage, NaN past the end of
+            each segment
+        """
+        segments = [self.prepare(pid).segments for pid in pids]
+        width = max((sum(len(ts) + 1 for ts, _ in row) for row in segments), default=1)
+        times = np.full((len(pids), width), np.nan)
+        matrix = np.full((len(pids), width), np.nan)
+        for row, row_segments in enumerate(segments):
+            column = 0
+            for ts, ys in row_segments:
+                times[row, column:column + len(ts)] = ts
+                matrix[row, column:column + len(ts)] = ys
+                column = column + len(ts) + 1
+        return times, matrix
+
+    def backward_regression_matrix(self, times:np.ndarray, matrix:np.ndarray
+                                   ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Fit a line to every backward window of every row of a resampled matrix at once
+
+        The batched form of backward_regression. Each run of non-NaN values in a row is a
+        separate series whose windows end at the last value of the run. Rows are reversed so
+        each run starts at its last value, then cumulative sums that reset at the start of every
+        run give the sums over every window, taken relative to the last sample of the run as in
+        backward_regression.
+
+        Args:
+            times: Times of the values in seconds, shaped like matrix or a single row of times
+                shared by every row
+            matrix: Values, NaN where a process has no data
+
+        Returns:
+            Window sizes, gradients, intercepts and R^2 shaped like matrix, element [i, j]
+            describing the window from column j to the end of its run. Window sizes are 0 and the
+            fits NaN where there are fewer than WIN_MIN_NUM_POINTS_DETECT points in the window
+        """
+        n_rows, n_cols = matrix.shape
+        rev = matrix[:, ::-1]
+        rev_times = np.broadcast_to(times, matrix.shape)[:, ::-1]
+        mask = ~np.isnan(rev)
+        positions = np.broadcast_to(np.arange(n_cols), rev.shape)
+
+        #Position of the start of the run (the last sample of the series) each element is in
+        starts = mask.copy()
+        starts[:, 1:] &= ~mask[:, :-1]
+        run_start = np.maximum.accumulate(np.where(starts, positions, 0), axis=1)
+        rows = np.arange(n_rows)[:, None]
+        k = (positions - run_start + 1).astype(float) # Number of points in the window
+        t0 = rev_times[rows, run_start]
+        y0 = rev[rows, run_start]
+        t = np.where(mask, rev_times - t0, 0.0)
+        y = np.where(mask, rev - y0, 0.0)
+
+        def run_cumsum(values):
+            cumsum = np.cumsum(values, axis=1)
+            return cumsum - (cumsum - values)[rows, run_start]
+
+        sum_t = run_cumsum(t)
+        sum_y = run_cumsum(y)
+        sum_tt = run_cumsum(t * t)
+        sum_ty = run_cumsum(t * y)
+        sum_yy = run_cumsum(y * y)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ss_tt = sum_tt - sum_t * sum_t / k
+            ss_ty = sum_ty - sum_t * sum_y / k
+            ss_yy = np.maximum(sum_yy - sum_y * sum_y / k, 0)
+            ms = ss_ty / ss_tt
+            r_den = np.sqrt(ss_tt * ss_yy)
+            r_pcc = np.where(r_den == 0, 0.0, ss_ty / r_den)
+            r2s = np.minimum(r_pcc**2, 1.0)
+            cs = (y0 + sum_y / k) - ms * (t0 + sum_t / k)
+
+        valid = mask & (k >= WIN_MIN_NUM_POINTS_DETECT)
+        windows = np.where(valid, k, 0).astype(np.int64)
+        ms = np.where(valid, ms, np.nan)
+        cs = np.where(valid, cs, np.nan)
+        r2s = np.where(valid, r2s, np.nan)
+        return windows[:, ::-1], ms[:, ::-1], cs[:, ::-1], r2s[:, ::-1]
+
+    def detect_leaks_batched_backward_regression(self, pids:List[int]=None)->Tuple[List[str],List[int]]:
+        """Detect memory leaks with linear backward regression over every process at once
+
+        The resampled segments of the processes are laid out as rows of a matrix by
+        resample_matrix and regressed together by backward_regression_matrix, in blocks of rows
+        of at most BATCH_MAX_ELEMENTS elements.
+
+        Args:
+            pids: Process ids to analyse, default is None which analyses all processes
+        """
+        return self.run_detector("LBRBATCH", pids)
+
+    def time_to_critical(self, ms, cs) -> np.ndarray:
+        """Time at which fitted lines reach CRITICAL_MEMORY_USAGE, infinite for flat lines
+
+        Args:
+            ms: Gradients of the fitted lines
+            cs: Intercepts of the fitted lines
+        """
+        ms = np.asarray(ms, dtype=float)
+        cs = np.asarray(cs, dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(ms == 0, np.inf, (CRITICAL_MEMORY_USAGE - cs) / ms)
+
+    def change_points_detection(self, times, values, model="l2", method="pelt", time_budget:float=None)->List[int]:
+        """Calculate change points for the data set provided
 
         Parameters:
             times (list): List of timestamps.
             values (list): List of corresponding values.
-            model (str): Name of the model for detecting changes. Options are "l1", "l2", "rbf", "linear", "normal", "ar".
+            model (str): Name of the model for detecting changes. Options are "l1", "l2", "rbf", "linear", "normal", "ar"
+                for "pelt", and "l2" (shifts in mean) or "linear" (changes of gradient) otherwise.
+            method (str): "pelt" searches the stacked (time, value) data with the ruptures package. "binseg" does a
+                binary segmentation of the values only, and "decimate" does the binary segmentation on a copy of the
+                values decimated to CPD_MAX_POINTS points, then refines each change point at full resolution.
+            time_budget (float): Seconds the "binseg" and "decimate" searches may take, after which the change points
+                found so far are returned. Default is None which is unbounded, ignored by "pelt".
 
         Uses Ruptures, cite Truong, L. Oudre, N. Vayatis. Selective review of offline change 
         point detection methods. Signal Processing, 167:107299, 2020. [journal] [pdf]
@@ -226,8 +462,15 @@ class MemoryAnalysis():
     
         
         Returns:
-            list: List of timestamps at which a change is detected.
+            list: List of indices at which a change is detected.
     """
+        if method == "binseg":
+            return self.binary_segmentation(values, model=model, time_budget=time_budget)
+        elif method == "decimate":
+            return self.decimated_binary_segmentation(values, model=model, time_budget=time_budget)
+        elif method != "pelt":
+            raise NotImplementedError(method)
+
         # Combine times and values into a 2D array
         data = np.column_stack((times, values))
         try:
@@ -241,62 +484,595 @@ class MemoryAnalysis():
 
         return change_points[:-1] 
 
-    def linear_backward_regression_with_change_points(self) -> Tuple[List[str],List[int]]:
+    def _segment_costs(self, values:np.ndarray, model:str):
+        """Cost function of the segments of values, built on cumulative sums
+
+        Returns:
+            A function of arrays of segment starts and ends (exclusive) returning the sum of squared
+            residuals of each segment about its mean ("l2") or about its fitted line ("linear")
+        """
+        ys = np.asarray(values, dtype=float)
+        ys = ys - np.mean(ys) # Reduces the rounding errors of the sums of squares
+        def prefix(xs):
+            return np.concatenate(([0.0], np.cumsum(xs)))
+        sum_y = prefix(ys)
+        sum_yy = prefix(ys * ys)
+        if model == "l2":
+            def cost(starts, ends):
+                k = ends - starts
+                s_y = sum_y[ends] - sum_y[starts]
+                return np.maximum((sum_yy[ends] - sum_yy[starts]) - s_y * s_y / k, 0)
+            return cost
+        elif model == "linear":
+            js = np.arange(len(ys), dtype=float)
+            sum_j = prefix(js)
+            sum_jj = prefix(js * js)
+            sum_jy = prefix(js * ys)
+            def cost(starts, ends):
+                k = ends - starts
+                s_j = sum_j[ends] - sum_j[starts]
+                s_y = sum_y[ends] - sum_y[starts]
+                ss_jj = (sum_jj[ends] - sum_jj[starts]) - s_j * s_j / k
+                ss_jy = (sum_jy[ends] - sum_jy[starts]) - s_j * s_y / k
+                ss_yy = (sum_yy[ends] - sum_yy[starts]) - s_y * s_y / k
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    return np.maximum(ss_yy - np.where(ss_jj > 0, ss_jy * ss_jy / ss_jj, 0), 0)
+            return cost
+        else:
+            raise NotImplementedError(model)
+
+    def _best_split(self, cost, start:int, end:int, min_size:int, first:int=None, last:int=None)->Tuple[float, int]:
+        """Split of [start, end) reducing the cost the most, searching split indices first to last only
+
+        Returns:
+            The reduction in cost and the split index, (0, None) when the segment cannot be split
+        """
+        first = start + min_size if first is None else max(first, start + min_size)
+        last = end - min_size if last is None else min(last, end - min_size)
+        if last < first:
+            return 0.0, None
+        splits = np.arange(first, last + 1)
+        total = cost(np.array([start]), np.array([end]))[0]
+        gains = total - cost(np.full(len(splits), start), splits) - cost(splits, np.full(len(splits), end))
+        best = int(np.argmax(gains))
+        return float(gains[best]), int(splits[best])
+
+    def _penalty(self, values:np.ndarray)->float:
+        """Reduction in cost a change point must achieve, CPD_THRESHOLD * sigma^2 * log(n)
+
+        The noise sigma is estimated from the median absolute deviation of the first differences, so
+        is not inflated by trends or steps in the values.
+        """
+        ys = np.asarray(values, dtype=float)
+        diffs = np.diff(ys)
+        sigma = 1.4826 * np.median(np.abs(diffs - np.median(diffs))) / np.sqrt(2)
+        #Noiseless data, only rounding errors are below the floor
+        sigma = max(sigma, 1e-6 * max(np.max(np.abs(ys)), 1.0))
+        return CPD_THRESHOLD * sigma**2 * np.log(len(ys))
+
+    def binary_segmentation(self, values, model="linear", min_size:int=CPD_MIN_SIZE, time_budget:float=None)->List[int]:
+        """Change points of the values found by binary segmentation
+
+        Segments are split where the split reduces the cost the most, best split first, for as long
+        as the reduction is above the penalty of _penalty. Costs come from cumulative sums so each
+        split costs O(n) and the search grows linearly with the number of points times the depth of
+        the segmentation, rather than quadratically as for PELT on long series.
+
+        Args:
+            values: Values of a uniformly sampled series
+            model: "l2" for shifts in mean or "linear" for changes of gradient
+            min_size: Minimum number of points between change points
+            time_budget: Seconds the search may take, after which the change points found so far are
+                returned. Default is None which is unbounded
+
+        Returns:
+            Sorted indices at which a change is detected
+        """
+        n = len(values)
+        if n < 2 * min_size:
+            return []
+        started = time.perf_counter()
+        cost = self._segment_costs(values, model)
+        penalty = self._penalty(values)
+        change_points = []
+        gain, split = self._best_split(cost, 0, n, min_size)
+        queue = [(-gain, split, 0, n)]
+        while queue:
+            gain, split, start, end = heapq.heappop(queue)
+            if split is None or -gain <= penalty:
+                break
+            change_points.append(split)
+            if time_budget is not None and time.perf_counter() - started > time_budget:
+                self.logger().debug(f"Change point search stopped after {len(change_points)} change points, "
+                                    f"over the time budget of {time_budget}s")
+                break
+            for child_start, child_end in ((start, split), (split, end)):
+                child_gain, child_split = self._best_split(cost, child_start, child_end, min_size)
+                if child_split is not None:
+                    heapq.heappush(queue, (-child_gain, child_split, child_start, child_end))
+        return sorted(change_points)
+
+    def decimated_binary_segmentation(self, values, model="linear", min_size:int=CPD_MIN_SIZE,
+                                      time_budget:float=None)->List[int]:
+        """Change points of the values found by binary segmentation of a decimated copy, then refined
+
+        The values are averaged over blocks so at most CPD_MAX_POINTS points are searched, and each
+        change point found is then moved to the best split at full resolution within a block either
+        side of it. The time budget applies to the search of the decimated values.
+
+        Args:
+            values: Values of a uniformly sampled series
+            model: "l2" for shifts in mean or "linear" for changes of gradient
+            min_size: Minimum number of points between change points, at full resolution
+            time_budget: Seconds the search may take. Default is None which is unbounded
+
+        Returns:
+            Sorted indices at which a change is detected
+        """
+        ys = np.asarray(values, dtype=float)
+        n = len(ys)
+        factor = int(np.ceil(n / CPD_MAX_POINTS))
+        if factor <= 1:
+            return self.binary_segmentation(ys, model=model, min_size=min_size, time_budget=time_budget)
+        blocks = n // factor
+        decimated = ys[:blocks * factor].reshape(blocks, factor).mean(axis=1)
+        coarse = self.binary_segmentation(decimated, model=model, min_size=max(2, int(np.ceil(min_size / factor))),
+                                          time_budget=time_budget)
+
+        #Refine each change point between its refined predecessor and the next coarse change point
+        cost = self._segment_costs(ys, model)
+        bounds = [block * factor for block in coarse] + [n]
+        change_points = []
+        start = 0
+        for i, block in enumerate(coarse):
+            centre = block * factor
+            _, split = self._best_split(cost, start, bounds[i + 1], min_size,
+                                        first=centre - factor, last=centre + factor)
+            if split is not None:
+                change_points.append(split)
+                start = split
+        return change_points
+
+    def linear_backward_regression_with_change_points(self, pids:List[int]=None) -> Tuple[List[str],List[int]]:
         """ 
         More efficient version of linear_backward_regression, which uses the change points to reduce
         the number of iterations overwhich to do the linear regression.
-        
+
+        Args:
+            pids: Process ids to analyse, default is None which analyses all processes
+        """
+        return self.run_detector("LBRCPD", pids)
+
+
+class PreparedSeries:
+    """Memory data of a process prepared for the leak detectors
+
+    Times and memory usage are converted to float arrays and split on gaps larger than
+    MAX_TIME_DIFF once. Each part is resampled onto a RESAMPLE_MIN_WIN grid the first time a
+    detector asks for the segments, and kept for every later detector.
+
+    Samples taken after the last one can be added with extend. Parts before the new samples keep
+    their segments and the last part is only resampled from its last resampled point onwards,
+    giving the same grid and values as resampling the whole part again.
+
+    Args:
+        pid: Process id
+        name: Process name
+        times: POSIX timestamps of the samples
+        vmss: Memory usage of the samples
+        resample: Function resampling (times, vmss), raising ValueError when there are too few
+            points, as MemoryAnalysis.resample_data
+    """
+
+    def __init__(self, pid:int, name:str, times, vmss, resample:Callable):
+        self.pid = pid
+        self.name = name
+        self.unable_to_resample = 0 # Parts with too few points to resample
+        self.__times = GrowableArray(np.float64, len(times))
+        self.__vmss = GrowableArray(np.float64, len(times))
+        self.__starts = [] # Index of the first sample of each part
+        self.__resample = resample
+        self.__segments = None # (part, resampled times, resampled memory usage) of each part resampled
+        self.extend(times, vmss)
+
+    @property
+    def times(self)->np.ndarray:
+        return self.__times.view()
+
+    @property
+    def vmss(self)->np.ndarray:
+        return self.__vmss.view()
+
+    @property
+    def bounds(self)->np.ndarray:
+        """Index of the first sample of each part between gaps, followed by the number of samples"""
+        return np.array((self.__starts or [0]) + [len(self.__times)])
+
+    @property
+    def gaps(self)->int:
+        """Number of gaps the data is split on"""
+        return max(len(self.__starts) - 1, 0)
+
+    @property
+    def parts(self)->List[Tuple[np.ndarray, np.ndarray]]:
+        """Times and memory usage of each part of the data between gaps"""
+        bounds = self.bounds
+        return [(self.times[start:end], self.vmss[start:end])
+                for start, end in zip(bounds[:-1], bounds[1:])]
+
+    @property
+    def segments(self)->List[Tuple[np.ndarray, np.ndarray]]:
+        """Resampled times and memory usage of each part with enough points to resample"""
+        if self.__segments is None:
+            self.__segments = []
+            self.unable_to_resample = 0
+            bounds = self.bounds
+            times, vmss = self.times, self.vmss
+            for part in range(len(bounds) - 1):
+                self.__resample_part(part, times[bounds[part]:bounds[part + 1]], vmss[bounds[part]:bounds[part + 1]])
+        return [(ts[:], ys[:]) for _, ts, ys in self.__segments]
+
+    @property
+    def nbytes(self)->int:
+        """Number of bytes allocated to the arrays of the series"""
+        nbytes = self.__times.nbytes + self.__vmss.nbytes
+        for _, ts, ys in self.__segments or []:
+            nbytes = nbytes + ts.nbytes + ys.nbytes
+        return nbytes
+
+    @property
+    def datetimes(self)->List[datetime.datetime]:
+        return [datetime.datetime.fromtimestamp(t) for t in self.times]
+
+    def __resample_part(self, part:int, times:np.ndarray, vmss:np.ndarray):
+        try:
+            ts, ys = self.__resample(times, vmss)
+        except ValueError:
+            self.unable_to_resample = self.unable_to_resample + 1
+            return
+        self.__segments.append((part, ts, ys))
+
+    def extend(self, times, vmss):
+        """Add samples taken after the last sample of the series
+
+        Args:
+            times: POSIX timestamps of the samples, in order
+            vmss: Memory usage of the samples
         """
-        anomalus_names = set()
-        anomalus_pids = set()
+        times = np.asarray(times, dtype=float)
+        vmss = np.asarray(vmss, dtype=float)
+        if len(times) == 0:
+            return
+        n = len(self.__times)
+        if n == 0:
+            new_starts = [0] + list(np.flatnonzero(np.diff(times) > MAX_TIME_DIFF) + 1)
+        else:
+            new_starts = list(n + np.flatnonzero(np.diff(times, prepend=self.__times[n - 1]) > MAX_TIME_DIFF))
+        last_part = len(self.__starts) - 1
+        self.__times.extend(times)
+        self.__vmss.extend(vmss)
+        self.__starts.extend(int(start) for start in new_starts)
+        if self.__segments is None:
+            return
+        bounds = self.bounds
+        times, vmss = self.times, self.vmss
+        if last_part >= 0:
+            if self.__segments and self.__segments[-1][0] == last_part:
+                self.__extend_segment(bounds[last_part], bounds[last_part + 1], n)
+            else:
+                #The last part may now have enough points to resample
+                self.unable_to_resample = self.unable_to_resample - 1
+                self.__resample_part(last_part, times[bounds[last_part]:bounds[last_part + 1]],
+                                     vmss[bounds[last_part]:bounds[last_part + 1]])
+        for part in range(last_part + 1, len(self.__starts)):
+            self.__resample_part(part, times[bounds[part]:bounds[part + 1]], vmss[bounds[part]:bounds[part + 1]])
+
+    def __extend_segment(self, start:int, end:int, extended_from:int):
+        """Resample the samples added to the last part of the series onto the end of its segment"""
+        part, resampled_ts, resampled_ys = self.__segments[-1]
+        if not isinstance(resampled_ts, GrowableArray):
+            #Only the last segment grows, so it is moved to growable columns once it is extended
+            columns = []
+            for values in (resampled_ts, resampled_ys):
+                column = GrowableArray(np.float64, len(values))
+                column.extend(values)
+                columns.append(column)
+            resampled_ts, resampled_ys = columns
+            self.__segments[-1] = (part, resampled_ts, resampled_ys)
+        #Grid points after the existing segment are not before the previous last sample, so only
+        #the samples from it onwards are needed to interpolate them
+        ts = np.arange(self.times[start], self.times[end - 1], RESAMPLE_MIN_WIN)[len(resampled_ts):]
+        resampled_ts.extend(ts)
+        resampled_ys.extend(np.interp(ts, self.times[extended_from - 1:end], self.vmss[extended_from - 1:end]))
+
+
+DETECTORS = {} # Name -> LeakDetector subclass, the algorithms MemoryAnalysis.detect_leaks can run
+
+
+def register_detector(name:str):
+    """Class decorator adding a LeakDetector subclass to DETECTORS under a name
+
+    Example usage::
+        >>> @register_detector("growth")
+        ... class GrowthDetector(LeakDetector):
+        ...     def detect_series(self, series):
+        ...         return series.vmss[-1] > 2 * series.vmss[0]
+        >>> MemoryAnalysis(mem_snap).detect_leaks("growth")
+    """
+    def register(cls):
+        cls.name = name
+        DETECTORS[name] = cls
+        return cls
+    return register
+
+
+class LeakDetector:
+    """Base class of the leak detection algorithms
+
+    Detectors are given the processes as PreparedSeries, so the conversion, gap splitting and
+    resampling of the data are shared by every detector run by the same MemoryAnalysis.
+    Subclasses implement detect_series to decide on one process at a time, or detect to decide
+    on every process at once.
+
+    Args:
+        analysis: MemoryAnalysis running the detector, for its regression functions
+    """
+    name = None
 
+    def __init__(self, analysis:MemoryAnalysis):
+        self.analysis = analysis
 
-        attempts_to_process = 0 
+    def logger(self):
+        return self.analysis.logger()
+
+    def detect(self, series:List[PreparedSeries])->List[PreparedSeries]:
+        """Detect memory leaks in a set of processes
+
+        Returns:
+            The series of the processes that are abnormally using memory
+        """
+        leaking = []
         unable_to_process = 0
-        for pid in self.__memory_data.pids:
-
-            attempts_to_process = attempts_to_process + 1
-            
-            #Resample data
-            input_data = self.__memory_data[pid]
-            try:
-                ts_f, ys_f = self.resample_data(input_data.times, input_data.vmss)
-                # if (self.__memory_data[pid].name == "python3"):
-                #     # plt.scatter(input_data.times,input_data.vmss, label="Original")
-                #     # plt.scatter(list(map(datetime.datetime.fromtimestamp,ts_full)),vmss_full, label="Resampled")
-                #     # plt.legend()
-                #     # plt.show()
-            except ValueError:
-                self.logger().warning(f"Insufficient data to resample for process {input_data.name} with pid {pid}")
+        for proc in series:
+            result = self.detect_series(proc)
+            if result is None:
                 unable_to_process = unable_to_process + 1
-                continue
-            
+            elif result:
+                leaking.append(proc)
+        if unable_to_process > 0:
+            self.logger().warning("Unable to process %d/%d", unable_to_process, len(series))
+        return leaking
+
+    def detect_series(self, series:PreparedSeries)->bool:
+        """Whether a process is abnormally using memory, None when it cannot be analysed"""
+        raise NotImplementedError()
 
-            change_points = self.change_points_detection(ts_f,ys_f)
-            if(change_points==[]):
-                #No change points so presumably no memory leak
+
+@register_detector("linefit")
+class LineFitDetector(LeakDetector):
+    """Fit a line to all of the memory data, leaking when the gradient is above 0.1 bytes per day"""
+
+    def detect_series(self, series:PreparedSeries)->bool:
+        m,c  = np.polyfit(series.times / SECONDS_PER_DAY,
+                            series.vmss,
+                            1) #Fit a straight line to the data, gradient per day
+        return m>0.1
+
+
+@register_detector("LBR")
+class BackwardRegressionDetector(LeakDetector):
+    """Linear backward regression
+
+    Lines are fitted to every backward window of each resampled segment, and a process is leaking
+    when a window meets the R_SQR_MIN and CRITICAL_TIME_MAX criteria.
+    """
+
+    def detect_series(self, series:PreparedSeries)->bool:
+        self.logger().info(f"Processing {series.name}-{series.pid}")
+        self.logger().debug(f"{series.name}-{series.pid}: Found {series.gaps} gaps in data")
+        leaking = False
+        for ts_rsampl, vmss_rsampl in series.segments:
+            ###LINEAR REGRESSION ###
+            # Regress every backward window at once, smallest window first
+            windows, ms, cs, r2s = self.analysis.backward_regression(ts_rsampl, vmss_rsampl)
+            t_crits = self.analysis.time_to_critical(ms, cs)
+            anomalous_windows = np.flatnonzero((r2s >= R_SQR_MIN) & (t_crits > CRITICAL_TIME_MAX))
+            if len(anomalous_windows) != 0:
+                window = windows[anomalous_windows[0]]
+                n = len(ts_rsampl)
+                self.logger().debug(f"{series.name}-{series.pid}: Anomalous window {n-window}/{n}")
+                if (DEBUG_PLOTTING):
+                    ts = ts_rsampl[n-window:n]
+                    ys = vmss_rsampl[n-window:n]
+                    r2 = r2s[anomalous_windows[0]]
+                    plt.scatter(series.datetimes,series.vmss, label="Recorded data", marker="x")
+                    plt.scatter(list(map(datetime.datetime.fromtimestamp,ts)),ys, label="Resampled leaking window",marker="x")
+                    plt.xticks(rotation = 40) 
+                    plt.xlabel("Time stamp")
+                    plt.ylabel("Memory usage (Bytes)")
+                    #Add a label with the gradient and intercept and r2
+                    plt.title(f"{series.name}-{series.pid}:\n $R^2$: {r2:.2f}")
+                    plt.legend()
+                    plt.show()
+                leaking = True
+        attempts = len(series.bounds) - 1
+        if len(series.segments) == 0:
+            #We were unable to process this PID due to it not being well formed enough, report this
+            self.logger().warning(f"{series.name}-{series.pid}: Insufficient data for process {series.name} with pid {series.pid}")
+            self.logger().warning(f"{series.name}-{series.pid}: Unable to resample {series.unable_to_resample}/{attempts}")
+            return None
+        self.logger().info(f"{series.name}-{series.pid}: Unable to resample {series.unable_to_resample}/{attempts}")
+        return leaking
+
+
+@register_detector("LBRCPD")
+class ChangePointDetector(LeakDetector):
+    """Linear backward regression over the windows starting at change points
+
+    Rather than every backward window only the windows starting at a change point of each
+    resampled segment are fitted, latest change point first, followed by the whole segment. A
+    segment without change points is assumed not to be leaking, unless CPD_MODEL is "linear".
+    The sums of the candidate windows are accumulated by
+    MemoryAnalysis.backward_regression_windows, which is several times faster than fitting every
+    window on long segments, but the change point search costs more than LBR's fit of every
+    window, so LBRCPD is slower than LBR overall.
+
+    The change point search is chosen by CPD_METHOD, CPD_MODEL and CPD_TIME_BUDGET, see
+    MemoryAnalysis.change_points_detection.
+    """
+
+    def detect_series(self, series:PreparedSeries)->bool:
+        if len(series.segments) == 0:
+            self.logger().warning(f"Insufficient data to resample for process {series.name} with pid {series.pid}")
+            return None
+        for ts_f, ys_f in series.segments:
+            #Change points are the indices at which each new segment starts
+            change_points = self.analysis.change_points_detection(ts_f, ys_f, model=CPD_MODEL, method=CPD_METHOD,
+                                                                  time_budget=CPD_TIME_BUDGET)
+            if len(change_points) == 0 and CPD_MODEL != "linear":
+                #No change points so presumably no memory leak. A linear model without change points
+                #has found a single line, so the whole segment is still fitted
+                continue
+            n = len(ts_f)
+            if n < WIN_MIN_NUM_POINTS_DETECT:
                 continue
-            num_change_points = len(change_points)
-            i = 0
-            while (i <= num_change_points):
-                
-            # for i in range(num_change_points):
-                p1 = np.where(ts_f==change_points[num_change_points-i])
-                p2 = np.where(ts_f==change_points[num_change_points])
-                ts = ts_f[p1:p2]
-                ys = ys_f[p1:p2]
-
-                #Do typical linear analysis
-                m,c,r_pcc,*_ =scipy.stats.linregress(ts,ys)
-                r2 = r_pcc**2 #Rsquare is the square of the pearson correlation coefficient
-                if m == 0:
-                    t_crit = np.inf # No memory leak, gradient flat
-                else:
-                    t_crit = (CRITICAL_MEMORY_USAGE - c)/m
-
-                if (r2>=R_SQR_MIN and t_crit > CRITICAL_TIME_MAX):
-                    anomalus_names.add(self.__memory_data[pid].name)
-                    anomalus_pids.add(pid)
-                    break #Proc has issues, escape
-
-                i = i+1
+            #Window sizes, latest change point first then the whole segment. A change point within
+            #the last WIN_MIN_NUM_POINTS_DETECT points is fitted over the smallest window LBR fits,
+            #so growth that has only just started is not skipped
+            candidates = n - np.concatenate((np.unique(np.asarray(change_points, dtype=int))[::-1], [0]))
+            candidates = np.unique(np.maximum(candidates, WIN_MIN_NUM_POINTS_DETECT))
+
+            #Do typical linear analysis, on the candidate windows only
+            ms, cs, r2s = self.analysis.backward_regression_windows(ts_f, ys_f, candidates)
+            t_crits = self.analysis.time_to_critical(ms, cs)
+            anomalous = np.flatnonzero((r2s >= R_SQR_MIN) & (t_crits > CRITICAL_TIME_MAX))
+            if len(anomalous) != 0:
+                self.logger().debug(f"{series.name}-{series.pid}: Anomalous window "
+                                    f"{n - candidates[anomalous[0]]}/{n}")
+                return True #Proc has issues, escape
+        return False
+
+
+@register_detector("LBRBATCH")
+class BatchedBackwardRegressionDetector(LeakDetector):
+    """Linear backward regression over every process at once
+
+    The resampled segments of each process are laid out as a row of a matrix by
+    MemoryAnalysis.resample_matrix, so the windows fitted are those of LBR, and the rows are
+    regressed together by MemoryAnalysis.backward_regression_matrix in blocks of at most
+    BATCH_MAX_ELEMENTS elements.
+    """
+
+    def detect(self, series:List[PreparedSeries])->List[PreparedSeries]:
+        leaking = []
+        #Order processes by their number of resampled points so the rows of a block need little padding
+        widths = {proc.pid: sum(len(ts) + 1 for ts, _ in proc.segments) for proc in series}
+        series = sorted(series, key=lambda proc: widths[proc.pid])
+
+        unable_to_process = 0
+        block_start = 0
+        while block_start < len(series):
+            #Grow the block while the matrix stays within BATCH_MAX_ELEMENTS
+            block_end = block_start + 1
+            while block_end < len(series) and \
+                    (block_end + 1 - block_start) * widths[series[block_end].pid] <= BATCH_MAX_ELEMENTS:
+                block_end = block_end + 1
+            block = series[block_start:block_end]
+            times, matrix = self.analysis.resample_matrix([proc.pid for proc in block])
+            windows, ms, cs, r2s = self.analysis.backward_regression_matrix(times, matrix)
+            t_crits = self.analysis.time_to_critical(ms, cs)
+            anomalous = np.any((r2s >= R_SQR_MIN) & (t_crits > CRITICAL_TIME_MAX), axis=1)
+            for row, proc in enumerate(block):
+                if len(proc.segments) == 0:
+                    unable_to_process = unable_to_process + 1
+                    self.logger().warning(f"{proc.name}-{proc.pid}: Insufficient data for process {proc.name} with pid {proc.pid}")
+                elif anomalous[row]:
+                    self.logger().debug(f"{proc.name}-{proc.pid}: Anomalous window found")
+                    leaking.append(proc)
+            block_start = block_end
+        if unable_to_process > 0:
+            self.logger().warning("Unable to process %d/%d", unable_to_process, len(series))
+        return leaking
+
+
+class _RecordCollector(logging.Handler):
+    """Logging handler keeping the records of a worker so they can be replayed by the parent"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record:logging.LogRecord):
+        #Format the message now, the arguments may not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+class _SharedProcData:
+    """Memory data of a single process, as read by a worker from shared memory"""
+
+    def __init__(self, pid:int, name:str, times:np.ndarray, vmss:np.ndarray):
+        self.pid = pid
+        self.name = name
+        self.times = times
+        self.vmss = vmss
+
+    @property
+    def datetimes(self)->List[datetime.datetime]:
+        return [datetime.datetime.fromtimestamp(t) for t in self.times]
+
+
+class _SharedMemoryData:
+    """The processes given to a worker, in place of a MemorySnapper"""
+
+    def __init__(self, procs:Dict[int, _SharedProcData]):
+        self.__procs = procs
+
+    @property
+    def pids(self)->List[int]:
+        return list(self.__procs)
+
+    def __getitem__(self, pid:int)->_SharedProcData:
+        return self.__procs[pid]
+
+
+def _detect_leaks_worker(algo:str, times_name:str, vmss_name:str, total:int,
+                         table:List[Tuple[int, str, int, int]], level:int):
+    """Run a leak detection algorithm over a chunk of processes in a worker process
+
+    Args:
+        algo: Algorithm to use to detect memory leaks
+        times_name: Name of the shared memory block holding the times of every process
+        vmss_name: Name of the shared memory block holding the memory usage of every process
+        total: Number of samples in each shared memory block
+        table: (pid, name, start, end) of each process to analyse, start and end index the blocks
+        level: Logging level of the parent's logger
+
+    Returns:
+        The names and pids of processes that are abnormally using memory, and the log records
+    """
+    times_shm = SharedMemory(name=times_name)
+    vmss_shm = SharedMemory(name=vmss_name)
+    collector = _RecordCollector()
+    try:
+        times = np.ndarray((total,), dtype=np.float64, buffer=times_shm.buf)
+        vmss = np.ndarray((total,), dtype=np.float64, buffer=vmss_shm.buf)
+        analysis = MemoryAnalysis(_SharedMemoryData(
+            {pid: _SharedProcData(pid, name, times[start:end], vmss[start:end])
+             for pid, name, start, end in table}))
+        logger = analysis.logger()
+        handlers, propagate, old_level = logger.handlers, logger.propagate, logger.level
+        logger.handlers, logger.propagate = [collector], False
+        logger.setLevel(level)
+        try:
+            names, pids = analysis._algorithm(algo)()
+        finally:
+            logger.handlers, logger.propagate = handlers, propagate
+            logger.setLevel(old_level)
+        del analysis, times, vmss
+    finally:
+        times_shm.close()
+        vmss_shm.close()
+    return set(names), set(pids), collector.records
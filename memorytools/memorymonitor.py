@@ -1,14 +1,25 @@
 import csv
+import io
 import logging
+import os
 import pickle
 import time
 import matplotlib.pyplot as plt
 import datetime
+import multiprocessing
 import numpy as np
 import psutil as ps
 import threading
-from typing import List, Tuple
+import warnings
+from typing import Dict, Iterable, List, Tuple
 from .memoryanalysis import MemoryAnalysis
+from .filters import ProcessFilter
+from .memorystore import (DownsampledSeries, IndexedSeries, LogChunk, LogSeries, RetentionPolicy,
+                          SnapshotAxis, SnapshotLog, isoformat_to_timestamps,
+                          timestamps_to_isoformat)
+from .samplers import make_sampler
+from .shmring import SampleRing, sample_into_ring
+from .stats import SnapshotStats
 
 try:
     import ccs
@@ -16,6 +27,13 @@ try:
 except ImportError:
     CCSENV=False
 
+def _to_timestamp(time)->float:
+    """Convert a datetime.datetime, or a number of seconds, to a POSIX timestamp"""
+    if isinstance(time, datetime.datetime):
+        return time.timestamp()
+    return float(time)
+
+
 class MemorySnapper:
     """Environment process memory information recorder
     
@@ -29,9 +47,15 @@ class MemorySnapper:
     """
 
     class ProcMemData:
-        """Class to store memory data for a single process"""
+        """Class to store memory data for a single process
 
-        def __init__(self, pid, name=None):
+        Virtual memory sizes are held as an int64 numpy column against the snapshots of the
+        owning store's SnapshotAxis, so the time of each sample is only recorded once for all
+        processes. Other metrics (see MemorySnapper metrics) are held the same way, each in its
+        own column against the snapshots it was sampled in.
+        """
+
+        def __init__(self, pid, name=None, axis:SnapshotAxis=None):
             """
             Base monitoring used to collect data that can be used to calculate the stdev of the memory usage for the entire environment
             """
@@ -40,49 +64,239 @@ class MemorySnapper:
                 self.name = ps.Process(pid).name()
             else:
                 self.name = name
-            self._vmss = {}
+            if axis is None:
+                axis = SnapshotAxis() # Standalone process, not part of a MemorySnapper
+            self._vmss = IndexedSeries(axis, np.int64)
+            self.tiers = [] # DownsampledSeries of data older than the retention policy keeps in full
+            self._metrics = {} # metric -> IndexedSeries of the metrics other than vms
+            self.metric_tiers = {} # metric -> DownsampledSeries of the other metrics, as tiers
+
+        def __len__(self):
+            return len(self._vmss)
 
         def __getitem__(self, time):
-            return self._vmss[time]
+            snapshot = self._vmss.axis.index_of(_to_timestamp(time))
+            if snapshot is None:
+                raise KeyError(time)
+            try:
+                return int(self._vmss.get(snapshot))
+            except KeyError:
+                raise KeyError(time)
 
         def __setitem__(self, time, full_memory):
-            if(isinstance(full_memory,int)):
-                self._vmss[time] = full_memory
+            self.add_sample(self._vmss.axis.index(_to_timestamp(time)), full_memory)
+
+        def add_sample(self, snapshot:int, full_memory):
+            """Record the memory usage of the process in a snapshot of the owning store"""
+            if(isinstance(full_memory,(int,np.integer))):
+                self._vmss.append(snapshot, full_memory)
             else:
-                self._vmss[time] = full_memory.vms
+                self._vmss.append(snapshot, full_memory.vms)
+
+        def __setstate__(self, state):
+            #Data pickled before the shared snapshot axis held the times of each process, either
+            #as a Dict[datetime.datetime, int] or as a column of timestamps
+            state.setdefault("tiers", [])
+            state.setdefault("_metrics", {})
+            state.setdefault("metric_tiers", {})
+            if isinstance(state.get("_vmss"), dict):
+                legacy = state.pop("_vmss")
+                times = [_to_timestamp(t) for t in legacy.keys()]
+                vmss = list(legacy.values())
+            elif "_times" in state:
+                times = state.pop("_times").view()
+                vmss = state.pop("_vmss").view()
+            else:
+                self.__dict__.update(state)
+                return
+            self.__dict__.update(state)
+            self._vmss = IndexedSeries(SnapshotAxis(), np.int64)
+            for time, memory in zip(times, vmss):
+                self[time] = memory
+
+        def _move_to_axis(self, axis:SnapshotAxis):
+            """Re-index the samples of the process against a different (shared) axis"""
+            if self._vmss.axis is axis:
+                return
+            times = self.times
+            vmss = self.vmss
+            self._vmss = IndexedSeries(axis, np.int64)
+            for time, memory in zip(times, vmss):
+                self[time] = memory
+
+        def add_metric_sample(self, metric:str, snapshot:int, value:int):
+            """Record the value of a metric other than vms in a snapshot of the owning store"""
+            series = self._metrics.get(metric)
+            if series is None:
+                series = self._metrics[metric] = IndexedSeries(self._vmss.axis, np.int64)
+            series.append(snapshot, value)
+
+        def _metric_series(self, metric:str, create:bool=False)->IndexedSeries:
+            if metric == "vms":
+                return self._vmss
+            if create and metric not in self._metrics:
+                self._metrics[metric] = IndexedSeries(self._vmss.axis, np.int64)
+            return self._metrics[metric]
 
         @property
-        def vmss(self) ->List[int]:
-            """Returns a List[int] of virtual memory sizes for a process over time"""
-            return list(self._vmss.values())
+        def metrics(self)->List[str]:
+            """Metrics recorded for the process, vms first"""
+            return ["vms"] + list(self._metrics)
+
+        def values(self, metric:str="vms")->np.ndarray:
+            """Returns a zero-copy np.ndarray[int64] view of the values of a metric over time, see metric_times"""
+            return self._metric_series(metric).values
+
+        def metric_times(self, metric:str="vms")->np.ndarray:
+            """Returns a np.ndarray[float64] of the POSIX timestamps at which a metric was sampled"""
+            return self._metric_series(metric).times
 
         @property
-        def times(self)->List[datetime.datetime]:
+        def vmss(self) ->np.ndarray:
+            """Returns a zero-copy np.ndarray[int64] view of virtual memory sizes for a process over time"""
+            return self._vmss.values
+
+        @property
+        def times(self)->np.ndarray:
+            """Returns a np.ndarray[float64] of the POSIX timestamps at which a memory snapshot was taken
+
+            This is a zero-copy view of the shared snapshot axis when the process was present in
+            consecutive snapshots.
+            """
+            return self._vmss.times
+
+        def between(self, start, end)->Tuple[np.ndarray, np.ndarray]:
+            """Returns the times and virtual memory sizes of the samples taken between start and end
+
+            For a process loaded from a data file only the part of the file covering the time range
+            is read.
+
+            Args:
+                start: Start of the time range, as a datetime.datetime or POSIX timestamp
+                end: End of the time range (inclusive), as a datetime.datetime or POSIX timestamp
+            """
+            return self._vmss.between(_to_timestamp(start), _to_timestamp(end))
+
+        @property
+        def snapshots(self)->np.ndarray:
+            """Returns the index on the snapshot axis of each sample"""
+            return self._vmss.indices
+
+        @property
+        def datetimes(self)->List[datetime.datetime]:
             """Returns a List[datetime.datetime] of times at which a memory snapshot was taken"""
-            return list(self._vmss.keys())
+            return list(map(datetime.datetime.fromtimestamp, self.times))
 
-    def __init__(self, existing_data_file=None):
+    def __init__(self, existing_data_file=None, sampler=None, env_refresh_interval:float=1.0,
+                 retention:RetentionPolicy=None, process_filter:ProcessFilter=None,
+                 metrics:Dict[str, float]=None, persist:bool=True):
         self.__proc_names = set()
-        self.totals = {}
+        self.persist = persist # False holds the data in memory only, the data file is neither read nor written
+        self.metrics = {} if metrics is None else dict(metrics) # Metric sampled besides vms -> interval in seconds
+        for metric in self.metrics:
+            if metric not in SnapshotLog.METRICS:
+                raise ValueError(f"Unknown metric {metric}, expected one of {list(SnapshotLog.METRICS)}")
+        self.__metrics_sampled = {} # metric -> time.monotonic() it was last sampled
+        self.__metric_analyses = {} # metric -> MemoryAnalysis of the metric
+        self.retention = retention
+        self.process_filter = process_filter # Processes sampled, default is None which samples every process
+        self.total_tiers = [] # DownsampledSeries of the totals older than retention keeps in full
+        self.sampler = make_sampler(sampler)
+        self.stats = SnapshotStats() # Overhead of taking snapshots
+        self.detector = None # OnlineLeakDetector fed with every snapshot, if any
+        self.__identities = {} # pid -> (name, create time) of processes sampled by this snapper
+        self.__env_refresh_interval = env_refresh_interval
+        self.__env_pids = None # CCS pid -> name of the environment processes
+        self.__env_refreshed = None
+        self.__data = {}
+        self.__retired = [] # ProcMemData of processes whose pid was reused, until flushed
+        self._axis = SnapshotAxis()
+        self.totals = IndexedSeries(self._axis, np.int64)
+        self.__store_lock = threading.RLock()
+        self.__flushed_snapshots = 0 # Number of snapshots already appended to the data file
+        self.__log_repaired = False # Whether the data file has been repaired before appending to it
         if existing_data_file is None:
             self.__data_file = "memory_data_tmp.dat"
         else:
             self.__data_file = existing_data_file
-        self.logger().debug("MEMORY DATA FILE: " + self.__data_file)
-        # Check if file exists, if it does load it as a pickle file into a dictionary
-        # If it doesn't, create an empty dictionary
-        try:
-            with open(self.__data_file, "rb") as f:
-                loaded_data = pickle.load(f)
-                self.__dict__.update(loaded_data)
-                self.logger().debug("LOADING MEMORY DATA FROM FILE")
-
-        except FileNotFoundError as err:
-            self.__data = {}
+        self.__log = SnapshotLog(self.__data_file)
+        # Check if file exists, if it does load the snapshot log, migrating data files written by
+        # older versions as a pickle
+        if persist and SnapshotLog.is_log(self.__data_file):
+            self.logger().debug("LOADING MEMORY DATA FROM FILE")
+            self.__load_log()
+        elif persist and os.path.exists(self.__data_file):
+            self.__migrate_pickle()
+        elif persist:
             self.logger().error("NO MEMORY DATA FILE FOUND")
+        if persist:
+            self.logger().debug("MEMORY DATA FILE: " + self.__data_file)
 
         self.analysis_module = MemoryAnalysis(self)
 
+    def __load_log(self):
+        """Load the data file lazily
+
+        Only the snapshot times and the table of processes are read, the memory data of each
+        process is read through a memory map of the file when the process is first accessed.
+        """
+        log_index = self.__log.index()
+        self._axis.extend(log_index.times)
+        table = log_index.table
+        rows = np.argsort(table["pid"], kind="stable")
+        pids, starts = np.unique(table["pid"][rows], return_index=True)
+        for pid, pid_rows in zip(pids, np.split(rows, starts[1:])):
+            pid = int(pid)
+            totals = pid_rows[table["metric"][pid_rows] == SnapshotLog.METRIC_TOTAL]
+            if len(totals) != 0:
+                self.totals.defer(log_index, totals)
+            for metric, metric_id in SnapshotLog.METRICS.items():
+                metric_rows = pid_rows[table["metric"][pid_rows] == metric_id]
+                if len(metric_rows) == 0:
+                    continue
+                if pid not in self.__data:
+                    #A pid reused by several processes is loaded as one, under the latest name
+                    name = log_index.name(metric_rows[-1])
+                    self.__data[pid] = self.ProcMemData(pid, name=name, axis=self._axis)
+                    self.__proc_names.add(name)
+                self.__data[pid]._metric_series(metric, create=True).defer(log_index, metric_rows)
+        self.__mark_flushed()
+
+    def __migrate_pickle(self):
+        """Convert a data file pickled by an older version into a snapshot log, in place"""
+        self.logger().warning(f"MIGRATING PICKLED MEMORY DATA FILE {self.__data_file} TO A SNAPSHOT LOG")
+        with open(self.__data_file, "rb") as f:
+            loaded_data = pickle.load(f)
+        self.__data = loaded_data["_MemorySnapper__data"]
+        self.__proc_names = loaded_data["_MemorySnapper__proc_names"]
+        self.totals = loaded_data["totals"]
+        if isinstance(self.totals, IndexedSeries):
+            self._axis = self.totals.axis
+        else:
+            self.__migrate_to_shared_axis()
+
+        #Write the log next to the pickle so the pickle is only replaced once fully converted
+        migrated_file = self.__data_file + ".migrating"
+        self.__log = SnapshotLog(migrated_file)
+        self.__log.create()
+        self.flush()
+        os.replace(migrated_file, self.__data_file)
+        self.__log = SnapshotLog(self.__data_file)
+
+    def __migrate_to_shared_axis(self):
+        """Move data saved before snapshots had a shared time axis onto one"""
+        self.logger().debug("MIGRATING MEMORY DATA TO A SHARED SNAPSHOT AXIS")
+        legacy_totals = self.totals
+        times = [proc.times for proc in self.__data.values()]
+        times.append(np.array([_to_timestamp(t) for t in legacy_totals.keys()], dtype=np.float64))
+        self._axis = SnapshotAxis()
+        self._axis.extend(np.unique(np.concatenate(times)))
+        for proc in self.__data.values():
+            proc._move_to_axis(self._axis)
+        self.totals = IndexedSeries(self._axis, np.int64)
+        for time, total in legacy_totals.items():
+            self.totals.append(self._axis.index(_to_timestamp(time)), total)
+
     def procs_by_name(self, name):
         """
         Return a list of Dict[datetime.datetime, int] of process data that match the passed name
@@ -108,6 +322,30 @@ class MemorySnapper:
     def pids(self)->List[int]:
         """List of processes ids for which memory data has been collected"""
         return self.__data.keys()
+
+    @property
+    def snapshot_times(self)->np.ndarray:
+        """POSIX timestamps of every snapshot held, each recorded once for all processes"""
+        return self._axis.times
+
+    def memory_matrix(self, pids:List[int]=None)->Tuple[np.ndarray, List[int], np.ndarray]:
+        """Align the memory usage of processes onto the shared snapshot axis
+
+        Args:
+            pids: Process ids to include, default is None which includes all processes
+
+        Returns:
+            The snapshot times in time order, the pids of the rows and a (processes x snapshots)
+            float64 matrix of virtual memory sizes, NaN where a process was not sampled
+        """
+        pids = list(self.pids) if pids is None else list(pids)
+        order = self._axis.order()
+        column_of = np.empty(len(order), dtype=np.int64)
+        column_of[order] = np.arange(len(order))
+        matrix = np.full((len(pids), len(order)), np.nan)
+        for row, pid in enumerate(pids):
+            matrix[row, column_of[self.__data[pid].snapshots]] = self.__data[pid].vmss
+        return self._axis.times[order], pids, matrix
     
     def logger(self):
         if CCSENV:
@@ -115,65 +353,366 @@ class MemorySnapper:
         else:
             return logging.getLogger(__name__)
 
-    def close(self):
-        """Close the memory monitoring object, saving the collected data as a pickle"""
-        with open(self.__data_file, "wb") as fp:
-            pickle.dump(self.__dict__, fp)
+    def flush(self):
+        """Append the snapshots taken since the last flush to the data file
 
-    def take_memory_snapshot(self):
-        """Create an entry in the data structure for memory processes in the environment at the
-        current time.
+        Data already in the file is never rewritten, so the cost of a flush only depends on the
+        amount of new data. A snapper that does not persist its data keeps all of it in memory, as
+        the retention policy only removes data that has been written.
         """
+        if not self._writes_chunks():
+            return
+        with self.__store_lock:
+            first_snapshot = self.__flushed_snapshots
+            times = self._axis.times[first_snapshot:]
+            series = []
+            for proc in self.__retired + list(self.__data.values()):
+                for metric in proc.metrics:
+                    snapshots, values = proc._metric_series(metric).unflushed()
+                    if len(snapshots) != 0:
+                        series.append(LogSeries(proc.pid, SnapshotLog.METRICS[metric], proc.name, snapshots, values))
+            snapshots, values = self.totals.unflushed()
+            if len(snapshots) != 0:
+                series.append(LogSeries(-1, SnapshotLog.METRIC_TOTAL, "", snapshots, values))
+            if len(times) == 0 and len(series) == 0:
+                return
+            self._write_chunk(LogChunk(first_snapshot, times, series))
+            self.__retired = []
+            self.__mark_flushed()
+            self.apply_retention()
 
-        # SETUP TIME
-        if CCSENV:
-            total = 0
+    def _writes_chunks(self)->bool:
+        """Whether flushed snapshots are written anywhere by _write_chunk"""
+        return self.persist
+
+    def _write_chunk(self, chunk:LogChunk):
+        """Write the snapshots taken since the last flush, raising OSError if they could not be
+        written so they are kept for the next flush"""
+        if not SnapshotLog.is_log(self.__log.path):
+            self.__log.create()
+        elif not self.__log_repaired:
+            self.__log.repair() # Drop a chunk torn by a crash before appending after it
+        self.__log_repaired = True
+        self.__log.append(chunk)
+
+    def merge_chunk(self, chunk:LogChunk, identities:List[Tuple[str, float]]=None):
+        """Add the snapshots of a chunk written by another snapper, such as a remote agent
+
+        Snapshots are placed on this snapper's time axis by their times, so chunks from the same
+        snapper can be merged in any order and chunks from different snappers interleave.
+
+        Args:
+            chunk: Chunk, as from SnapshotLog.decode_chunk, snapshot numbers in it are those of
+                the snapper that wrote it
+            identities: (name, creation time) of the process of each series of the chunk, or None
+                for a series. A process whose pid was identified with a different creation time
+                replaces it, as when a snapshot is taken
+        """
+        with self.__store_lock:
+            snapshots = self._axis.indices(chunk.times)
+            for i, series in enumerate(chunk.series):
+                if identities is not None and identities[i] is not None:
+                    self.__track(series.pid, identities[i])
+                rows = snapshots[np.asarray(series.snapshots, dtype=np.int64) - chunk.first_snapshot]
+                if series.metric == SnapshotLog.METRIC_TOTAL:
+                    self.totals.merge(rows, series.values)
+                    continue
+                metric = _METRIC_NAMES.get(series.metric)
+                if metric is None:
+                    continue # Written by a newer version
+                if series.pid not in self.__data:
+                    self.__data[series.pid] = self.ProcMemData(series.pid, name=series.name, axis=self._axis)
+                    self.__proc_names.add(series.name)
+                self.__data[series.pid]._metric_series(metric, create=True).merge(rows, series.values)
+
+    def __mark_flushed(self):
+        for proc in self.__data.values():
+            proc._vmss.mark_flushed()
+            for series in proc._metrics.values():
+                series.mark_flushed()
+        self.totals.mark_flushed()
+        self.__flushed_snapshots = len(self._axis)
+
+    @property
+    def nbytes(self)->int:
+        """Number of bytes of memory allocated to the data held, excluding data not read from the
+        data file yet"""
+        with self.__store_lock:
+            return self._axis.nbytes + sum(series.nbytes + sum(tier.nbytes for tier in tiers)
+                                           for series, tiers in self.__series_tiers())
+
+    def __series_tiers(self)->List[Tuple[IndexedSeries, List[DownsampledSeries]]]:
+        """Each full resolution series held, with the tiers its older data is moved into"""
+        pairs = [(proc._vmss, proc.tiers) for proc in self.__data.values()]
+        pairs.extend((series, proc.metric_tiers.setdefault(metric, []))
+                     for proc in self.__data.values() for metric, series in proc._metrics.items())
+        pairs.append((self.totals, self.total_tiers))
+        return pairs
+
+    def __downsample(self, cutoff:float)->int:
+        """Move the full resolution data from before cutoff that is in the data file to the first
+        tier, returning the number of values moved"""
+        moved = 0
+        for series, tiers in self.__series_tiers():
+            times, values = series.discard_before(cutoff)
+            if len(times) == 0:
+                continue
+            if len(self.retention.tiers) != 0:
+                if len(tiers) == 0:
+                    tiers.extend(DownsampledSeries(bucket) for bucket, _ in self.retention.tiers)
+                tiers[0].add(times, values)
+            moved = moved + len(times)
+        return moved
+
+    def __age_tiers(self, now:float):
+        """Move buckets older than each tier keeps into the next tier, or drop them from the last"""
+        for _, tiers in self.__series_tiers():
+            for level, (_, keep) in enumerate(self.retention.tiers):
+                if keep is None or level >= len(tiers):
+                    continue
+                removed = tiers[level].discard_before(now - keep)
+                if level + 1 < len(tiers) and len(removed[0]) != 0:
+                    tiers[level + 1].add(*removed)
+
+    def __enforce_memory_cap(self, now:float):
+        """Move data down the tiers early, then drop the oldest buckets of the coarsest tiers,
+        until the data held fits the retention policy's max_bytes"""
+        max_bytes = self.retention.max_bytes
+        for _ in range(64):
+            if self.nbytes <= max_bytes:
+                return
+            pairs = self.__series_tiers()
+            oldest = min((series.times[0] for series, _ in pairs if series.loaded and len(series) != 0),
+                         default=None)
+            if oldest is not None and \
+                    self.__downsample(max((oldest + now) / 2, np.nextafter(oldest, np.inf))) != 0:
+                continue
+            #Nothing more can leave full resolution, drop the older half of the coarsest tier
+            dropped = False
+            for level in reversed(range(len(self.retention.tiers))):
+                starts = [tiers[level].starts for _, tiers in pairs if len(tiers) > level and len(tiers[level]) != 0]
+                if len(starts) == 0:
+                    continue
+                first = min(tier_starts[0] for tier_starts in starts)
+                last = max(tier_starts[-1] for tier_starts in starts)
+                cutoff = (first + last) / 2 + self.retention.tiers[level][0]
+                for _, tiers in pairs:
+                    if len(tiers) > level:
+                        tiers[level].discard_before(cutoff)
+                dropped = True
+                break
+            if not dropped:
+                break
+        if self.nbytes > max_bytes:
+            self.logger().warning(f"Memory data of {self.nbytes} bytes exceeds the retention cap of "
+                                  f"{max_bytes} bytes, the rest is snapshot times or not yet in the data file")
+
+    def apply_retention(self):
+        """Move data out of full resolution, down the tiers and out of memory according to the
+        retention policy. Ages are measured from the latest snapshot.
+
+        This is done after every flush, as only data already in the data file is removed.
+        """
+        if self.retention is None:
+            return
+        with self.__store_lock:
+            now = self._axis.latest
+            if now is None:
+                return
+            self.__downsample(now - self.retention.recent)
+            self.__age_tiers(now)
+            if self.retention.max_bytes is not None:
+                self.__enforce_memory_cap(now)
+
+    def close(self):
+        """Close the memory monitoring object, appending any unsaved data to the data file"""
+        self.flush()
+        self.sampler.close()
+
+    def __name_of(self, pid:int)->str:
+        proc = self.__data.get(pid)
+        return str(pid) if proc is None else proc.name
+
+    def _environment_pids(self)->dict:
+        """Pids and CCS names of the environment processes, refreshed every env_refresh_interval
+        seconds rather than every snapshot"""
+        now = time.monotonic()
+        if self.__env_pids is None or now - self.__env_refreshed >= self.__env_refresh_interval:
             env_procs = ccs.GetEnvProcs(
                 full_report=True
             )  # Whilst process_iter might thread safe this ccs.GetEnvProcs is not
             if ccs.procName in env_procs:
                 del env_procs[ccs.procName]
-            env_pids = {v["pid"]: k for k, v in env_procs.items()}
-
-        # MEASURE TIME
-        current_time = datetime.datetime.now()
-        total_mem = 0 # Total memory usage for all processes
-        for p in ps.process_iter():
-            if CCSENV:
-                #CCS Make CCS related changes
-                #Only interested in the current environment
-                if p.pid not in env_pids:
+            self.__env_pids = {v["pid"]: k for k, v in env_procs.items()}
+            self.__env_refreshed = now
+        return self.__env_pids
+
+    def __identify(self, pid:int, env_pids:dict=None)->bool:
+        """Cache the name and creation time of a process the first time it is sampled
+
+        A pid that is already cached with a different creation time has been reused by a new
+        process. The data of the previous process is retired, it is appended to the data file at
+        the next flush and then dropped from memory, and the new process starts a fresh series
+        under its own name, so no detector fits a line across the two processes.
+
+        Returns:
+            False if the process could not be identified, e.g. because it has exited
+        """
+        try:
+            name = env_pids[pid] if CCSENV else self.sampler.name(pid) # Make use of ccs names
+            identity = (name, self.sampler.create_time(pid))
+        except Exception as e:
+            # Do not raise error just skip this process and report a warning
+            self.logger().warning(f"Error taking memory snapshot for process with pid {pid}: {e}")
+            self.stats.record_error(e)
+            return False
+        self.__track(pid, identity)
+        return True
+
+    def __track(self, pid:int, identity:Tuple[str, float]):
+        """Record the (name, creation time) of the process with pid, retiring the data of a
+        previous process with the same pid"""
+        name = identity[0]
+        previous = self.__identities.get(pid)
+        if previous is not None and previous != identity and pid in self.__data:
+            self.logger().debug(f"Pid {pid} reused by {name}, previously {previous[0]}")
+            self.__retired.append(self.__data.pop(pid))
+            if self.detector is not None:
+                self.detector.forget(pid)
+        self.__identities[pid] = identity
+        if pid not in self.__data:
+            self.__data[pid] = self.ProcMemData(pid, name=name, axis=self._axis)
+        self.__proc_names.add(name)
+
+    def take_memory_snapshot(self):
+        """Create an entry in the data structure for memory processes in the environment at the
+        current time.
+        """
+
+        # SETUP TIME
+        start = time.monotonic()
+        env_pids = self._environment_pids() if CCSENV else None
+
+        with self.__store_lock:
+            # MEASURE TIME
+            snapshot, timestamp = self._begin_snapshot()
+            #CCS Only interested in the current environment
+            metrics = self._due_metrics(start)
+            pids = self._pids_to_sample(env_pids)
+            samples = self.sampler.sample(pids, metrics=metrics) if metrics else self.sampler.sample(pids)
+            total_mem = self._add_samples(snapshot, samples, env_pids)
+            if metrics:
+                self._add_metric_values(snapshot, self.sampler.values)
+            self._end_snapshot(snapshot, timestamp, samples, total_mem, start)
+
+    def _due_metrics(self, now:float)->List[str]:
+        """Metrics other than vms to sample in a snapshot started at time.monotonic() now, each at its interval"""
+        due = []
+        for metric, interval in self.metrics.items():
+            last = self.__metrics_sampled.get(metric)
+            if metric != "vms" and (last is None or now - last >= (interval or 0)):
+                due.append(metric)
+                self.__metrics_sampled[metric] = now
+        return due
+
+    def _add_metric_values(self, snapshot:int, values:Dict[str, List[Tuple[int, int]]]):
+        """Record the values of metrics other than vms read by the sampler, for the processes recorded in the snapshot"""
+        with self.__store_lock:
+            for metric, metric_values in values.items():
+                for p_pid, value in metric_values:
+                    proc = self.__data.get(p_pid)
+                    if proc is not None:
+                        proc.add_metric_sample(metric, snapshot, value)
+
+    def _pids_to_sample(self, env_pids:dict=None)->Iterable[int]:
+        """Pids the sampler reads this tick, those of process_filter within the CCS environment,
+        or None to read every process"""
+        if self.process_filter is None:
+            return env_pids
+        pids = self.process_filter.resolve()
+        if pids is None or env_pids is None:
+            return env_pids if pids is None else pids
+        return {pid for pid in pids if pid in env_pids}
+
+    def _begin_snapshot(self)->Tuple[int, float]:
+        """Add the current time to the snapshot axis
+
+        Returns:
+            Index of the new snapshot and its POSIX timestamp
+        """
+        with self.__store_lock:
+            timestamp = datetime.datetime.now().timestamp()
+            return self._axis.append(timestamp), timestamp
+
+    def _add_samples(self, snapshot:int, samples:List[Tuple[int, int]], env_pids:dict=None)->int:
+        """Record samples read by the sampler in a snapshot, identifying the processes sampled for the first time
+
+        Returns:
+            Total memory usage of the processes recorded
+        """
+        with self.__store_lock:
+            total_mem = 0 # Total memory usage for all processes
+            started = self.sampler.started
+            for p_pid, vms in samples:
+                #'New' procs, and pids reused by a new process, are identified once
+                if (p_pid in started or p_pid not in self.__identities) and \
+                        not self.__identify(p_pid, env_pids):
                     continue
-                p_name = env_pids[p.pid]  # Make use of ccs names
-            else:
-                p_name = p.name()
-            p_pid = p.pid
-            #'New' procs will be missing from stored info
-            if p_pid not in self.__data.keys():
-                self.__data[p_pid] = self.ProcMemData(p_pid)
-                self.__proc_names.add(p_name)
-            try:
-                with p.oneshot():
-                    # Update memory usage
-                    self[p_pid][current_time] = p.memory_info()
-                    total_mem = total_mem + self[p_pid][current_time]
-            except Exception as e:
-                # Do not raise error just skip this loop and report a warning
-                self.logger().warning(f"Error taking memory snapshot for process {p_name} with pid \
-                                      {p_pid}: {e}")
-        self.logger().debug(f"Total memory usage: {total_mem}")
-        self.totals[current_time]=total_mem
-
-    def detect_leaks(self,algo="LBR")->Tuple[List[str],List[int]]:
+                self.__data[p_pid].add_sample(snapshot, vms)
+                total_mem = total_mem + vms
+            return total_mem
+
+    def _end_snapshot(self, snapshot:int, timestamp:float, samples:List[Tuple[int, int]], total_mem:int,
+                      start:float):
+        """Record the errors, total and overhead of a snapshot and update the detector
+
+        Args:
+            snapshot: Index of the snapshot
+            timestamp: POSIX timestamp of the snapshot
+            samples: Every sample of the snapshot
+            total_mem: Total memory usage of the snapshot
+            start: time.monotonic() when the snapshot was started
+        """
+        with self.__store_lock:
+            for p_pid, e in self.sampler.errors:
+                self.logger().warning(f"Error taking memory snapshot for process with pid {p_pid}: {e}")
+                self.stats.record_error(e)
+            if self.process_filter is not None:
+                self.process_filter.forget(p_pid for p_pid, _ in self.sampler.errors)
+            self.logger().debug(f"Total memory usage: {total_mem}")
+            self.totals.append(snapshot, total_mem)
+            if self.detector is not None:
+                self.detector.update(timestamp, samples, self.__name_of)
+            self.stats.record(start, time.monotonic() - start, len(samples))
+
+    def detect_leaks(self,algo="LBR", names:List[str]=None, workers:int=None,
+                     metric:str="vms")->Tuple[List[str],List[int]]:
         """Detect memory leaks using a given algorithm
         
         Args:
             algo: Algorithm to use to detect memory leaks
+            names: Names of the processes to analyse, default is None which analyses all processes
+            workers: Number of worker processes to analyse processes in parallel, default is None
+                which analyses every process in this process
+            metric: Metric to analyse, "vms" (default) or any other metric sampled
 
         Returns:
             A set of names and pids of processes that are abnormally using memory
         """
-        return self.analysis_module.detect_leaks(algo)
+        pids = None
+        if names is not None:
+            pids = [proc.pid for name in names for proc in self.procs_by_name(name)]
+        return self.analysis_of(metric).detect_leaks(algo, pids=pids, workers=workers)
+
+    def analysis_of(self, metric:str="vms")->MemoryAnalysis:
+        """MemoryAnalysis of a metric, each metric keeps its own cache of prepared series"""
+        if metric == "vms":
+            return self.analysis_module
+        if metric not in SnapshotLog.METRICS:
+            raise ValueError(f"Unknown metric {metric}, expected one of {list(SnapshotLog.METRICS)}")
+        if metric not in self.__metric_analyses:
+            self.__metric_analyses[metric] = MemoryAnalysis(_MetricData(self, metric))
+        return self.__metric_analyses[metric]
 
     def _plot_data(self, proc_pids:List[int]=None):
         """
@@ -184,7 +723,7 @@ class MemorySnapper:
         """
         procs_to_plot = self.pids if proc_pids is [] else proc_pids
         for proc in procs_to_plot:
-            plt.scatter(self[proc].times, np.array(self[proc].vmss) / 1e6, label=(self.__data[proc].name,proc))
+            plt.scatter(self[proc].datetimes, self[proc].vmss / 1e6, label=(self.__data[proc].name,proc))
 
         plt.legend()
         plt.xlabel("Time stamp")
@@ -229,45 +768,144 @@ class MemorySnapper:
         plt.show(block=block)
         return plt
 
-    def export_to_csv(self, filename):
+    def export_to_csv(self, filename, name_table:bool=False):
         """
         Export the memory usage data to a CSV file.
 
+        Each process is written a column at a time, processes loaded lazily from a data file are
+        streamed from it without being read into memory.
+
         Args:
             filename: The name of the file where the data will be saved
+            name_table: If True, the process names are written once per process to a separate
+                names file (see names_file_for) instead of on every row
         """
         with open(filename, 'a', newline='') as csvfile:
-            fieldnames = ['Process ID', 'Process Name', 'Time', 'Memory Usage']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            writer.writeheader()
+            writer = csv.writer(csvfile)
+            if name_table:
+                writer.writerow(['Process ID', 'Time', 'Memory Usage'])
+            else:
+                writer.writerow(['Process ID', 'Process Name', 'Time', 'Memory Usage'])
             for proc in self.pids:
-                for time, memory in zip(self[proc].times, self[proc].vmss):
-                    writer.writerow({
-                        'Process ID': proc, 
-                        'Process Name': self.__data[proc].name,
-                        'Time': time, 
-                        'Memory Usage': memory
-                    })
-
-    def import_from_csv(self, filename):
+                #Only the name needs csv quoting, build the start of each row once per process
+                prefix = io.StringIO()
+                csv.writer(prefix, lineterminator="").writerow(
+                    [proc] if name_table else [proc, self.__data[proc].name])
+                prefix = prefix.getvalue() + ","
+                for times, vmss in self.__data[proc]._vmss.blocks():
+                    if len(times) == 0:
+                        continue
+                    rows = np.char.add(np.char.add(prefix, timestamps_to_isoformat(times)),
+                                       np.char.add(",", np.asarray(vmss).astype(str)))
+                    csvfile.write("\r\n".join(rows.tolist()) + "\r\n")
+
+        if name_table:
+            with open(self.names_file_for(filename), 'w', newline='') as namesfile:
+                writer = csv.writer(namesfile)
+                writer.writerow(['Process ID', 'Process Name'])
+                writer.writerows((proc, self.__data[proc].name) for proc in self.pids)
+
+    @staticmethod
+    def names_file_for(filename:str)->str:
+        """Path of the process name table written alongside a CSV export with name_table=True"""
+        return os.path.splitext(filename)[0] + "_names.csv"
+
+    def import_from_csv(self, filename, names_file:str=None, chunk_rows:int=1000000):
         """
         Import memory usage data from a CSV file.
 
+        The file is read chunk_rows rows at a time, each chunk is parsed straight into numpy columns
+        and flushed to the data file before the next one is read, so with a retention policy files
+        larger than memory can be imported.
+
         Args:
             filename: The name of the file to import data from
+            names_file: Process name table for a file exported with name_table=True, defaults to
+                the one written alongside it
+            chunk_rows: Number of rows to parse at once
         """
-        with open(filename, 'r') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                proc_id = int(row['Process ID'])
-                proc_name = row['Process Name']
-                time = datetime.datetime.fromisoformat(row['Time'])  
-                memory = int(row['Memory Usage'])
-                if proc_id not in self.__data.keys():
-                    self.__data[proc_id] = self.ProcMemData(proc_id, name=proc_name)
-                    self.__proc_names.add(proc_name)
-                self.__data[proc_id][time] = memory
+        with open(filename, 'r', newline='') as csvfile:
+            header = next(csv.reader([csvfile.readline()]), None)
+            if header is None:
+                return
+            columns = [header.index('Process ID'), header.index('Time'), header.index('Memory Usage')]
+            names = None
+            if 'Process Name' in header:
+                columns.append(header.index('Process Name'))
+            else:
+                with open(names_file or self.names_file_for(filename), 'r', newline='') as namesfile:
+                    names = {int(row['Process ID']): row['Process Name']
+                             for row in csv.DictReader(namesfile)}
+
+            while True:
+                #Parse the next chunk straight from the file into a column per field
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore", UserWarning) # The end of the file has no data
+                    chunk = np.loadtxt(csvfile, dtype=str, delimiter=',', quotechar='"', usecols=columns,
+                                       max_rows=chunk_rows, ndmin=2, encoding=None)
+                if len(chunk) == 0:
+                    break
+                pids = chunk[:, 0].astype(np.int64)
+                vmss = chunk[:, 2].astype(np.int64)
+                #Rows from the same snapshot share a time, find (or record) each time once on the axis
+                snapshots = self._axis.indices(isoformat_to_timestamps(chunk[:, 1]))
+
+                #Group the rows by process, keeping each process' rows in snapshot order
+                order = np.lexsort((snapshots, pids))
+                pids = pids[order]
+                unique_pids, starts = np.unique(pids, return_index=True)
+                for proc_id, rows_of_proc in zip(unique_pids, np.split(order, starts[1:])):
+                    proc_id = int(proc_id)
+                    if proc_id not in self.__data.keys():
+                        if names is None:
+                            proc_name = str(chunk[rows_of_proc[0], 3])
+                        else:
+                            proc_name = names[proc_id]
+                        self.__data[proc_id] = self.ProcMemData(proc_id, name=proc_name, axis=self._axis)
+                        self.__proc_names.add(proc_name)
+                    self.__data[proc_id]._vmss.merge(snapshots[rows_of_proc], vmss[rows_of_proc])
+                #Write the chunk out and apply the retention policy so only the retained data stays in memory
+                self.flush()
+
+_METRIC_NAMES = {metric_id: metric for metric, metric_id in SnapshotLog.METRICS.items()}
+
+
+class _MetricData:
+    """Memory data of the processes for one metric, in the form MemoryAnalysis reads"""
+
+    def __init__(self, memory_data:MemorySnapper, metric:str):
+        self.memory_data = memory_data
+        self.metric = metric
+
+    @property
+    def pids(self)->List[int]:
+        return [pid for pid in self.memory_data.pids if self.metric in self.memory_data[pid]._metrics]
+
+    def __getitem__(self, pid:int)->"_MetricProcData":
+        return _MetricProcData(self.memory_data[pid], self.metric)
+
+
+class _MetricProcData:
+    """One metric of a process, as ProcMemData reads vms"""
+
+    def __init__(self, proc:MemorySnapper.ProcMemData, metric:str):
+        self.pid = proc.pid
+        self.name = proc.name
+        self.__proc = proc
+        self.__metric = metric
+
+    @property
+    def times(self)->np.ndarray:
+        return self.__proc.metric_times(self.__metric)
+
+    @property
+    def vmss(self)->np.ndarray:
+        return self.__proc.values(self.__metric)
+
+    @property
+    def datetimes(self)->List[datetime.datetime]:
+        return list(map(datetime.datetime.fromtimestamp, self.times))
+
 
 class MemoryMonitor(MemorySnapper):
     """Class for continuous monitoring of processes memory usage
@@ -275,7 +913,43 @@ class MemoryMonitor(MemorySnapper):
     Args:
         data_file: Path to the data file for persistence across instances
         time_interval: Time interval between snapshots monitoring in seconds
-    
+        flush_interval: Time interval between appending new snapshots to the data file in seconds
+        sampler: Sampler used to read process memory, "psutil" (default), "procfs" for the
+            lower overhead Linux sampler, or a sampler instance
+        env_refresh_interval: Time interval between refreshing the list of CCS environment
+            processes in seconds
+        cpu_budget: Fraction of each interval the monitor thread may spend in CPU time taking a
+            snapshot, when snapshots cost more the interval is lengthened until they fit and
+            shortened again, down to time_interval, when they get cheaper. Default is None which
+            keeps the interval fixed
+        detector: OnlineLeakDetector updated with every snapshot to report leaks while monitoring,
+            default is None which only detects leaks when detect_leaks is called
+        retention: RetentionPolicy bounding the data held in memory, older data is downsampled
+            after each flush. Default is None which keeps everything at full resolution
+        process_filter: ProcessFilter selecting the processes sampled, default is None which
+            samples every process
+        metrics: Metrics sampled besides vms, see samplers.METRICS, each with the interval it is
+            sampled at in seconds (0 samples it in every snapshot). The smaps metrics (uss, pss
+            and swap) cost far more than vms, rss and shared and should be sampled less often.
+            Default is None which only samples vms
+        out_of_process: Take snapshots in a separate sampler process, see below. Default is False
+            which takes them in a thread of this process
+        ring_capacity: Number of samples the shared memory of the sampler process holds, it
+            must hold the samples of flush_interval seconds of snapshots
+        persist: False holds the data in memory only, data_file is neither loaded nor written
+            and flushes only apply the retention policy. Default is True
+
+    Snapshots are taken at fixed deadlines of a monotonic clock, so the time taken by a snapshot
+    does not stretch the interval. Deadlines that have already passed when a snapshot completes
+    are skipped and counted in stats.missed_ticks.
+
+    Out of process, start_monitoring starts a sampler process writing the snapshots into a
+    SampleRing in shared memory, so sampling never holds the GIL of this process and the data
+    held by the monitor does not grow with every snapshot. The monitor thread only wakes every
+    flush_interval to move the snapshots from the ring into the store, and snapshots are also
+    moved when monitoring stops and when detect_leaks is called. The ring is fixed in size,
+    snapshots that do not fit before they are moved are dropped and logged. cpu_budget,
+    detector and metrics are not supported out of process.
 
     Example usage::
         >>> mem_monitor = MemoryMonitor() #Create a memory monitor object
@@ -283,13 +957,36 @@ class MemoryMonitor(MemorySnapper):
         >>> <Do some stuff while monitoring memory usage>
         >>> mem_monitor.stop_monitoring() #Stop monitoring memory usage
     """
-    def __init__(self, data_file=None, time_interval:float=0.005):
-        super().__init__(existing_data_file=data_file)
+    def __init__(self, data_file=None, time_interval:float=0.005, flush_interval:float=10.0,
+                 sampler=None, env_refresh_interval:float=1.0, cpu_budget:float=None,
+                 detector=None, retention:RetentionPolicy=None, process_filter:ProcessFilter=None,
+                 metrics:Dict[str, float]=None, out_of_process:bool=False, ring_capacity:int=2**20,
+                 persist:bool=True):
+        if out_of_process and (cpu_budget is not None or detector is not None or metrics):
+            raise ValueError("cpu_budget, detector and metrics are not supported out of process")
+        super().__init__(existing_data_file=data_file, sampler=sampler,
+                         env_refresh_interval=env_refresh_interval, retention=retention,
+                         process_filter=process_filter, metrics=metrics, persist=persist)
+        self.detector = detector
+        self.out_of_process = out_of_process
+        self.__ring_capacity = ring_capacity
+        self.__env_refresh_interval = env_refresh_interval
+        self.__ring = None # SampleRing written by the sampler process while monitoring out of process
+        self.__sampler_process = None
+        self.__sampler_stop = None
+        self.__ring_lock = threading.Lock()
+        self.__dropped = 0 # Snapshots dropped by the sampler process, as already logged
 
         self.__time_interval = time_interval
+        self.__interval = time_interval # Current interval, longer than time_interval when backed off
+        self.__flush_interval = flush_interval
+        self.__cpu_budget = cpu_budget
+        self.stats.requested_interval = time_interval
+        self.stats.interval = time_interval
         #Setup but do not start monitoring thread
         self.__monitoring=False
-        self.__monitor_thread = threading.Thread(target=self.__monitor_loop)
+        self.__monitor_thread = threading.Thread(
+            target=self.__drain_loop if self.out_of_process else self.__monitor_loop)
     
     def start_monitoring(self):
             """
@@ -303,15 +1000,79 @@ class MemoryMonitor(MemorySnapper):
             try:
                 self.__monitor_thread.name
             except AttributeError:
-                self.__monitor_thread = threading.Thread(target=self.__monitor_loop)
+                self.__monitor_thread = threading.Thread(
+                    target=self.__drain_loop if self.out_of_process else self.__monitor_loop)
 
             self.__monitoring=True
+            if self.out_of_process:
+                self.__start_sampler_process()
             self.__monitor_thread.start()
 
+    def __start_sampler_process(self):
+        self.__ring = SampleRing(self.__ring_capacity)
+        self.__sampler_stop = multiprocessing.Event()
+        self.__sampler_process = multiprocessing.Process(
+            target=sample_into_ring, name="memorytools-sampler", daemon=True,
+            args=(self.__ring, self.sampler, self.__time_interval, self.__env_refresh_interval,
+                  self.__sampler_stop, self.process_filter))
+        self.__sampler_process.start()
+        self.logger().debug(f"Sampler process started with pid {self.__sampler_process.pid}")
+
+    def __drain(self):
+        """Move the snapshots the sampler process has written to the ring into the store"""
+        with self.__ring_lock:
+            if self.__ring is None:
+                return
+            chunk, snapshots, identities = self.__ring.read_chunk()
+            self.merge_chunk(chunk, identities)
+            for snapshot in snapshots:
+                self.stats.record(float(snapshot["start"]), float(snapshot["latency"]), int(snapshot["processes"]))
+            self.stats.missed_ticks = self.__ring.missed
+            if self.__ring.dropped > self.__dropped:
+                self.logger().warning(f"{self.__ring.dropped - self.__dropped} snapshots dropped as the "
+                                      f"sampler process ring was full, increase ring_capacity")
+                self.__dropped = self.__ring.dropped
+
+    def __drain_loop(self):
+        while not self.__sampler_stop.wait(self.__flush_interval):
+            self.__drain()
+            self.flush()
+
+    @property
+    def interval(self)->float:
+        """Current time interval between snapshots in seconds"""
+        return self.__interval
+
+    def __adapt_interval(self, cpu_cost:float):
+        """Fit the interval to the CPU budget given the smoothed CPU cost of a snapshot"""
+        interval = max(self.__time_interval, cpu_cost / self.__cpu_budget)
+        if interval != self.__interval:
+            self.logger().debug(f"Snapshot interval changed to {interval}s")
+        self.__interval = interval
+        self.stats.interval = interval
+
     def __monitor_loop(self):
+        last_flush = time.monotonic()
+        deadline = time.monotonic()
+        cpu_cost = None # Moving average of the thread CPU time taken by a snapshot
         while self.__monitoring:
+            cpu_start = time.thread_time()
             self.take_memory_snapshot()
-            time.sleep(self.__time_interval)
+            if self.__cpu_budget:
+                cost = time.thread_time() - cpu_start
+                cpu_cost = cost if cpu_cost is None else 0.8 * cpu_cost + 0.2 * cost
+                self.__adapt_interval(cpu_cost)
+            if time.monotonic() - last_flush >= self.__flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+            deadline = deadline + self.__interval
+            now = time.monotonic()
+            if now >= deadline:
+                #Skip the deadlines that have already passed rather than bunching snapshots up
+                missed = int((now - deadline) // self.__interval) + 1
+                self.stats.missed_ticks = self.stats.missed_ticks + missed
+                deadline = deadline + missed * self.__interval
+            time.sleep(deadline - now)
 
     def stop_monitoring(self):
             """
@@ -323,11 +1084,28 @@ class MemoryMonitor(MemorySnapper):
 
             """
             self.__monitoring = False
-            if self.__monitor_thread.is_alive():
+            if self.__sampler_process is not None:
+                #The monitor thread ends as soon as the sampler process is told to stop
+                self.__sampler_stop.set()
+                self.__sampler_process.join()
+                self.__sampler_process = None
+                self.__monitor_thread.join()
+            elif self.__monitor_thread.is_alive():
                 self.__monitor_thread.join()
             else: 
                 self.logger().error("Cannot stop thread as it is not running.")
             del self.__monitor_thread
+            if self.__ring is not None:
+                self.__drain()
+                with self.__ring_lock:
+                    self.__ring.close()
+                    self.__ring.unlink()
+                    self.__ring = None
+
+    def detect_leaks(self, algo="LBR", names:List[str]=None, workers:int=None,
+                     metric:str="vms")->Tuple[List[str],List[int]]:
+        self.__drain()
+        return super().detect_leaks(algo=algo, names=names, workers=workers, metric=metric)
 
     def is_monitoring(self):
         return self.__monitoring
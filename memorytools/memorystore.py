@@ -0,0 +1,922 @@
+import datetime
+import os
+import struct
+import zlib
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+OFFSET_BUCKET = 900 # Seconds over which the local UTC offset is assumed constant when converting
+
+
+def _local_offset(timestamp:float)->float:
+    """Offset of local time from UTC at a POSIX timestamp, in seconds"""
+    return datetime.datetime.fromtimestamp(timestamp).astimezone().utcoffset().total_seconds()
+
+
+def _naive_offset(seconds:float)->float:
+    """Offset to add to a naive local time, in seconds since 1970-01-01, to get a POSIX timestamp"""
+    naive = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=seconds)
+    return naive.timestamp() - seconds
+
+
+def _bucketed_offsets(seconds:np.ndarray, offset_at)->np.ndarray:
+    """Evaluate offset_at for every element of seconds, calling it once per OFFSET_BUCKET except in
+    buckets where the offset changes (e.g. a daylight saving change)"""
+    buckets = np.floor(seconds / OFFSET_BUCKET)
+    unique_buckets, inverse = np.unique(buckets, return_inverse=True)
+    starts = np.array([offset_at(bucket * OFFSET_BUCKET) for bucket in unique_buckets])
+    ends = np.array([offset_at((bucket + 1) * OFFSET_BUCKET) for bucket in unique_buckets])
+    offsets = starts[inverse]
+    changing = (starts != ends)[inverse]
+    if np.any(changing):
+        offsets[changing] = [offset_at(second) for second in seconds[changing]]
+    return offsets
+
+
+def timestamps_to_isoformat(timestamps)->np.ndarray:
+    """Format POSIX timestamps as naive local ISO 8601 strings, as str(datetime.datetime) does"""
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    if len(timestamps) == 0:
+        return np.empty(0, dtype=str)
+    local = timestamps + _bucketed_offsets(timestamps, _local_offset)
+    microseconds = np.round(local * 1e6).astype(np.int64).astype("datetime64[us]")
+    return np.char.replace(np.datetime_as_string(microseconds, unit="us"), "T", " ")
+
+
+def isoformat_to_timestamps(strings)->np.ndarray:
+    """Parse naive local ISO 8601 strings into POSIX timestamps, the inverse of
+    timestamps_to_isoformat"""
+    if len(strings) == 0:
+        return np.empty(0, dtype=np.float64)
+    if datetime.datetime.fromisoformat(strings[0]).tzinfo is not None:
+        #Times with a UTC offset, numpy only parses naive times
+        return np.array([datetime.datetime.fromisoformat(string).timestamp() for string in strings],
+                        dtype=np.float64)
+    microseconds = np.array(strings, dtype="datetime64[us]").astype(np.int64)
+    seconds = microseconds / 1e6
+    return seconds + _bucketed_offsets(seconds, _naive_offset)
+
+
+class GrowableArray:
+    """Append-only numpy column with amortised O(1) appends
+
+    Values are kept in a preallocated numpy buffer which doubles in size whenever it fills, so
+    that a column of n samples costs n*itemsize bytes rather than a Python object per sample.
+
+    Example usage::
+        >>> column = GrowableArray(np.int64)
+        >>> column.append(10)
+        >>> column.view()
+        array([10])
+    """
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, dtype, capacity:int=INITIAL_CAPACITY):
+        self._buffer = np.empty(max(int(capacity), 1), dtype=dtype)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, index):
+        return self.view()[index]
+
+    def __setitem__(self, index, value):
+        self._buffer[:self._size][index] = value
+
+    @property
+    def dtype(self):
+        return self._buffer.dtype
+
+    @property
+    def nbytes(self)->int:
+        """Number of bytes allocated to the column"""
+        return self._buffer.nbytes
+
+    def _reserve(self, size:int):
+        """Grow the buffer geometrically so it can hold at least size values"""
+        capacity = len(self._buffer)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity = capacity * 2
+        buffer = np.empty(capacity, dtype=self._buffer.dtype)
+        buffer[:self._size] = self._buffer[:self._size]
+        self._buffer = buffer
+
+    def append(self, value):
+        """Add a single value to the end of the column"""
+        if self._size == len(self._buffer):
+            self._reserve(self._size + 1)
+        self._buffer[self._size] = value
+        self._size = self._size + 1
+
+    def extend(self, values):
+        """Add an array of values to the end of the column"""
+        values = np.asarray(values, dtype=self._buffer.dtype)
+        self._reserve(self._size + len(values))
+        self._buffer[self._size:self._size + len(values)] = values
+        self._size = self._size + len(values)
+
+    def discard(self, n:int):
+        """Remove the first n values, releasing the memory they used"""
+        n = min(max(int(n), 0), self._size)
+        if n == 0:
+            return
+        remaining = self._size - n
+        buffer = np.empty(max(remaining, self.INITIAL_CAPACITY), dtype=self._buffer.dtype)
+        buffer[:remaining] = self._buffer[n:self._size]
+        self._buffer = buffer
+        self._size = remaining
+
+    def view(self)->np.ndarray:
+        """Zero-copy, read-only view of the values in the column
+
+        The view is a snapshot of the column's length, values appended afterwards are not seen
+        by it.
+        """
+        view = self._buffer[:self._size]
+        view.flags.writeable = False
+        return view
+
+    def __getstate__(self):
+        #Only persist the used part of the buffer
+        return {"dtype": self._buffer.dtype.str, "values": self._buffer[:self._size].copy()}
+
+    def __setstate__(self, state):
+        self._buffer = np.array(state["values"], dtype=np.dtype(state["dtype"]))
+        self._size = len(self._buffer)
+        if self._size == 0:
+            self._buffer = np.empty(self.INITIAL_CAPACITY, dtype=np.dtype(state["dtype"]))
+
+
+class SnapshotAxis:
+    """Timestamps of the snapshots held by a store, recorded once per snapshot
+
+    Everything sampled in a snapshot refers to it by its index on the axis rather than repeating
+    its timestamp.
+    """
+
+    def __init__(self):
+        self._times = GrowableArray(np.float64)
+        self._sorted = True
+
+    def __len__(self):
+        return len(self._times)
+
+    @property
+    def times(self)->np.ndarray:
+        """Zero-copy np.ndarray[float64] view of the POSIX timestamp of each snapshot"""
+        return self._times.view()
+
+    @property
+    def nbytes(self)->int:
+        return self._times.nbytes
+
+    @property
+    def latest(self)->float:
+        """Time of the latest snapshot, None if there are no snapshots"""
+        if len(self._times) == 0:
+            return None
+        if self._sorted:
+            return float(self._times[len(self._times) - 1])
+        return float(self._times.view().max())
+
+    def append(self, time:float)->int:
+        """Record a new snapshot taken at time, returning its index"""
+        n = len(self._times)
+        if n != 0 and time < self._times[n-1]:
+            self._sorted = False
+        self._times.append(time)
+        return n
+
+    def extend(self, times)->np.ndarray:
+        """Record several new snapshots, returning their indices"""
+        times = np.asarray(times, dtype=np.float64)
+        n = len(self._times)
+        if len(times) != 0:
+            if (n != 0 and times[0] < self._times[n-1]) or np.any(np.diff(times) < 0):
+                self._sorted = False
+        self._times.extend(times)
+        return np.arange(n, n + len(times))
+
+    def index_of(self, time:float):
+        """Index of the snapshot taken at time, or None if there is no such snapshot"""
+        times = self._times.view()
+        n = len(times)
+        if n == 0 or (self._sorted and time > times[n-1]):
+            return None
+        if time == times[n-1]:
+            return n-1
+        if self._sorted:
+            index = np.searchsorted(times, time)
+            return int(index) if index < n and times[index] == time else None
+        matches = np.flatnonzero(times == time)
+        return int(matches[0]) if len(matches) != 0 else None
+
+    def index(self, time:float)->int:
+        """Index of the snapshot taken at time, recording a new snapshot if there is none"""
+        index = self.index_of(time)
+        if index is None:
+            index = self.append(time)
+        return index
+
+    def indices(self, times)->np.ndarray:
+        """Index of the snapshot taken at each of times, recording new snapshots for times not seen
+        before"""
+        times = np.asarray(times, dtype=np.float64)
+        unique_times, inverse = np.unique(times, return_inverse=True)
+        order = self.order()
+        sorted_times = self._times.view()[order]
+        positions = np.searchsorted(sorted_times, unique_times)
+        found = positions < len(sorted_times)
+        found[found] = sorted_times[positions[found]] == unique_times[found]
+        indices = np.empty(len(unique_times), dtype=np.int64)
+        indices[found] = order[positions[found]]
+        indices[~found] = self.extend(unique_times[~found])
+        return indices[inverse]
+
+    def order(self)->np.ndarray:
+        """Snapshot indices in time order"""
+        if self._sorted:
+            return np.arange(len(self._times))
+        return np.argsort(self._times.view(), kind="stable")
+
+
+class IndexedSeries:
+    """Values of a quantity present in some of the snapshots of a SnapshotAxis
+
+    Rather than a timestamp per value, the snapshots a value belongs to are stored as runs of
+    consecutive snapshot indices, a process that is seen in every snapshot from when it starts
+    costs a single run however many values it holds.
+    """
+
+    def __init__(self, axis:SnapshotAxis, dtype=np.int64):
+        self._axis = axis
+        self._values = GrowableArray(dtype)
+        self._runs = [] # [first snapshot index, first value index, number of values]
+        self._end = 0 # One past the latest snapshot with a value
+        self._flushed = 0 # Number of values already written to a SnapshotLog
+        self._rewritten = set() # Snapshots whose value changed after being written
+        self._pending = None # (LogIndex, rows) of values in a log file not read yet
+
+    def __len__(self):
+        self._load()
+        return len(self._values)
+
+    def __setstate__(self, state):
+        #Series pickled before they could be written to a SnapshotLog
+        state.setdefault("_end", max((first + length for first, _, length in state["_runs"]), default=0))
+        state.setdefault("_flushed", 0)
+        state.setdefault("_rewritten", set())
+        state.setdefault("_pending", None)
+        self.__dict__.update(state)
+
+    def defer(self, log_index:"LogIndex", rows:np.ndarray):
+        """Attach values held in a log file without reading them
+
+        The values are read from the file, through its memory map, the first time the series is
+        accessed.
+        """
+        self._pending = (log_index, rows)
+
+    @property
+    def loaded(self)->bool:
+        """Whether all the values of the series are in memory"""
+        return self._pending is None
+
+    def _load(self):
+        if self._pending is None:
+            return
+        log_index, rows = self._pending
+        self._pending = None
+        for row in rows:
+            self.merge(log_index.snapshots(row), log_index.values(row))
+        self._flushed = len(self._values) # Everything read is already in the log
+
+    def between(self, start:float, end:float)->Tuple[np.ndarray, np.ndarray]:
+        """Times and values of the snapshots taken between start and end inclusive
+
+        Values still in a log file are read only for the parts of the file covering the range, only
+        the (small) runs of each chunk are read to find them.
+        """
+        axis_times = self._axis.times
+        if self._pending is None:
+            times = self.times
+            mask = (times >= start) & (times <= end)
+            return times[mask], self.values[mask]
+        log_index, rows = self._pending
+        times = []
+        values = []
+        for row in rows:
+            row_times = axis_times[log_index.snapshots(row)]
+            selected = np.flatnonzero((row_times >= start) & (row_times <= end))
+            if len(selected) == 0:
+                continue
+            lo, hi = selected[0], selected[-1] + 1
+            mask = (row_times[lo:hi] >= start) & (row_times[lo:hi] <= end)
+            times.append(row_times[lo:hi][mask])
+            values.append(np.asarray(log_index.values(row)[lo:hi])[mask])
+        if len(times) == 0:
+            return np.empty(0), np.empty(0, dtype=self._values.dtype)
+        return np.concatenate(times), np.concatenate(values)
+
+    @property
+    def axis(self)->SnapshotAxis:
+        return self._axis
+
+    @property
+    def nbytes(self)->int:
+        """Number of bytes of memory allocated to the series, excluding values not read yet"""
+        return self._values.nbytes + len(self._runs) * 3 * 8
+
+    def position(self, snapshot:int):
+        """Position in the values of the value for a snapshot, or None if it has no value"""
+        self._load()
+        for first, start, length in reversed(self._runs):
+            if first <= snapshot < first + length:
+                return start + snapshot - first
+        return None
+
+    def append(self, snapshot:int, value):
+        """Set the value for a snapshot, the snapshot is usually the latest on the axis"""
+        self._load()
+        if len(self._runs) != 0:
+            run = self._runs[-1]
+            if snapshot == run[0] + run[2] and snapshot >= self._end:
+                run[2] = run[2] + 1
+                self._values.append(value)
+                self._end = snapshot + 1
+                return
+            position = self.position(snapshot)
+            if position is not None:
+                self._values[position] = value
+                if position < self._flushed:
+                    self._rewritten.add(snapshot)
+                return
+        self._runs.append([snapshot, len(self._values), 1])
+        self._values.append(value)
+        self._end = max(self._end, snapshot + 1)
+
+    def extend(self, snapshots, values):
+        """Add values for several snapshots that do not have a value yet"""
+        self._load()
+        snapshots = np.asarray(snapshots, dtype=np.int64)
+        if len(snapshots) == 0:
+            return
+        start = len(self._values)
+        self._end = max(self._end, int(snapshots.max()) + 1)
+        breaks = np.flatnonzero(np.diff(snapshots) != 1) + 1
+        starts = np.concatenate(([0], breaks))
+        lengths = np.diff(np.concatenate((starts, [len(snapshots)])))
+        runs = np.column_stack((snapshots[starts], start + starts, lengths)).tolist()
+        if len(self._runs) != 0 and self._runs[-1][0] + self._runs[-1][2] == runs[0][0]:
+            self._runs[-1][2] = self._runs[-1][2] + runs[0][2]
+            runs = runs[1:]
+        self._runs.extend(runs)
+        self._values.extend(values)
+
+    def merge(self, snapshots, values):
+        """Set the values for several snapshots, some of which may already have a value"""
+        snapshots = np.asarray(snapshots, dtype=np.int64)
+        if len(snapshots) == 0:
+            return
+        if snapshots[0] >= self._end and np.all(np.diff(snapshots) > 0):
+            self.extend(snapshots, values)
+        else:
+            for snapshot, value in zip(snapshots, values):
+                self.append(int(snapshot), value)
+
+    def indices_from(self, position:int)->np.ndarray:
+        """Snapshot index of each value from position onwards"""
+        self._load()
+        pieces = []
+        for first, start, length in reversed(self._runs):
+            if start + length <= position:
+                break
+            skip = max(position - start, 0)
+            pieces.append(np.arange(first + skip, first + length))
+            if start <= position:
+                break
+        pieces.reverse()
+        return np.concatenate(pieces) if pieces else np.empty(0, dtype=np.int64)
+
+    def unflushed(self)->Tuple[np.ndarray, np.ndarray]:
+        """Snapshots and values that have not been written to a SnapshotLog yet"""
+        if self._pending is not None:
+            #Nothing can be added to a series before its values are read
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=self._values.dtype)
+        snapshots = self.indices_from(self._flushed)
+        values = self._values.view()[self._flushed:]
+        if len(self._rewritten) != 0:
+            rewritten = np.array(sorted(self._rewritten), dtype=np.int64)
+            rewritten_values = [self.get(snapshot) for snapshot in rewritten]
+            snapshots = np.concatenate((rewritten, snapshots))
+            values = np.concatenate((np.array(rewritten_values, dtype=values.dtype), values))
+        return snapshots, values
+
+    def mark_flushed(self):
+        """Record that every value has been written to a SnapshotLog"""
+        if self._pending is None:
+            self._flushed = len(self._values)
+        self._rewritten = set()
+
+    def discard_before(self, time:float)->Tuple[np.ndarray, np.ndarray]:
+        """Remove the oldest values, taken before time, that have already been written to a
+        SnapshotLog
+
+        Values are removed from the start of the series, in the order they were added, up to the
+        first value taken at or after time or not written yet. Nothing is removed from a series
+        whose values are still in a log file or that has rewritten values waiting to be written.
+
+        Returns:
+            The times and values removed
+        """
+        if self._pending is not None or len(self._rewritten) != 0:
+            return np.empty(0), np.empty(0, dtype=self._values.dtype)
+        times = self.times
+        later = np.flatnonzero(times >= time)
+        n = min(int(later[0]) if len(later) != 0 else len(times), self._flushed)
+        if n == 0:
+            return np.empty(0), np.empty(0, dtype=self._values.dtype)
+        removed = (times[:n].copy(), self._values.view()[:n].copy())
+        self._values.discard(n)
+        runs = []
+        for first, start, length in self._runs:
+            if start + length <= n:
+                continue
+            skip = max(n - start, 0)
+            runs.append([first + skip, start + skip - n, length - skip])
+        self._runs = runs
+        self._flushed = self._flushed - n
+        return removed
+
+    def blocks(self)->Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Iterate over the times and values of the series in blocks, without reading values still
+        in a log file into the series"""
+        if self._pending is None:
+            yield self.times, self.values
+            return
+        log_index, rows = self._pending
+        for row in rows:
+            yield self._axis.times[log_index.snapshots(row)], log_index.values(row)
+
+    def get(self, snapshot:int):
+        position = self.position(snapshot)
+        if position is None:
+            raise KeyError(snapshot)
+        return self._values[position]
+
+    @property
+    def values(self)->np.ndarray:
+        """Zero-copy view of the values, in the order they were added"""
+        self._load()
+        return self._values.view()
+
+    @property
+    def indices(self)->np.ndarray:
+        """Snapshot index of each value"""
+        self._load()
+        if len(self._runs) == 1:
+            first, _, length = self._runs[0]
+            return np.arange(first, first + length)
+        return np.concatenate([np.arange(first, first + length) for first, _, length in self._runs]
+                              or [np.empty(0, dtype=np.int64)])
+
+    @property
+    def times(self)->np.ndarray:
+        """Timestamp of each value, a zero-copy view of the axis when the values are one run"""
+        self._load()
+        if len(self._runs) == 1:
+            first, _, length = self._runs[0]
+            return self._axis.times[first:first + length]
+        return self._axis.times[self.indices]
+
+
+class DownsampledSeries:
+    """Minimum, maximum and mean of a series over fixed length time buckets
+
+    Buckets start at multiples of the bucket length, samples and buckets must be added in time
+    order.
+
+    Args:
+        bucket: Length of each bucket in seconds
+    """
+
+    def __init__(self, bucket:float):
+        self.bucket = bucket
+        self._starts = GrowableArray(np.float64)
+        self._mins = GrowableArray(np.float64)
+        self._maxs = GrowableArray(np.float64)
+        self._means = GrowableArray(np.float64)
+        self._counts = GrowableArray(np.int64)
+
+    def __len__(self):
+        return len(self._starts)
+
+    @property
+    def nbytes(self)->int:
+        return sum(column.nbytes for column in self.__columns())
+
+    def __columns(self)->Tuple[GrowableArray, ...]:
+        return (self._starts, self._mins, self._maxs, self._means, self._counts)
+
+    def add(self, times, mins, maxs=None, means=None, counts=None):
+        """Add samples, or the buckets of a finer DownsampledSeries, to the buckets they fall in
+
+        Args:
+            times: Time of each sample or start of each finer bucket
+            mins: Value of each sample or minimum of each finer bucket
+            maxs: Maximum of each finer bucket, default is None for samples
+            means: Mean of each finer bucket, default is None for samples
+            counts: Number of samples in each finer bucket, default is None for samples
+        """
+        times = np.asarray(times, dtype=np.float64)
+        if len(times) == 0:
+            return
+        mins = np.asarray(mins, dtype=np.float64)
+        maxs = mins if maxs is None else np.asarray(maxs, dtype=np.float64)
+        means = mins if means is None else np.asarray(means, dtype=np.float64)
+        counts = np.ones(len(times), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+        starts = np.floor(times / self.bucket) * self.bucket
+        first = np.concatenate(([0], np.flatnonzero(np.diff(starts) != 0) + 1))
+        starts = starts[first]
+        bucket_counts = np.add.reduceat(counts, first)
+        bucket_mins = np.minimum.reduceat(mins, first)
+        bucket_maxs = np.maximum.reduceat(maxs, first)
+        bucket_means = np.add.reduceat(means * counts, first) / bucket_counts
+        if len(self._starts) != 0 and self._starts[-1] == starts[0]:
+            #Continue the latest bucket
+            count = self._counts[-1] + bucket_counts[0]
+            self._means[-1] = (self._means[-1] * self._counts[-1] + bucket_means[0] * bucket_counts[0]) / count
+            self._mins[-1] = min(self._mins[-1], bucket_mins[0])
+            self._maxs[-1] = max(self._maxs[-1], bucket_maxs[0])
+            self._counts[-1] = count
+            starts, bucket_mins, bucket_maxs, bucket_means, bucket_counts = \
+                starts[1:], bucket_mins[1:], bucket_maxs[1:], bucket_means[1:], bucket_counts[1:]
+        for column, values in zip(self.__columns(), (starts, bucket_mins, bucket_maxs, bucket_means, bucket_counts)):
+            column.extend(values)
+
+    def discard_before(self, time:float)->Tuple[np.ndarray, ...]:
+        """Remove the buckets that end at or before time
+
+        Returns:
+            The starts, minimums, maximums, means and counts of the buckets removed
+        """
+        n = int(np.searchsorted(self._starts.view() + self.bucket, time, side="right"))
+        removed = tuple(column.view()[:n].copy() for column in self.__columns())
+        for column in self.__columns():
+            column.discard(n)
+        return removed
+
+    def between(self, start:float, end:float)->Tuple[np.ndarray, ...]:
+        """Starts, minimums, maximums, means and counts of the buckets overlapping start to end"""
+        starts = self._starts.view()
+        mask = (starts + self.bucket > start) & (starts <= end)
+        return tuple(column.view()[mask] for column in self.__columns())
+
+    @property
+    def starts(self)->np.ndarray:
+        """Start time of each bucket"""
+        return self._starts.view()
+
+    @property
+    def mins(self)->np.ndarray:
+        return self._mins.view()
+
+    @property
+    def maxs(self)->np.ndarray:
+        return self._maxs.view()
+
+    @property
+    def means(self)->np.ndarray:
+        return self._means.view()
+
+    @property
+    def counts(self)->np.ndarray:
+        """Number of samples in each bucket"""
+        return self._counts.view()
+
+
+class RetentionPolicy:
+    """How much data a MemorySnapper keeps in memory
+
+    Data is kept at full resolution for the most recent period, then moved into progressively
+    coarser DownsampledSeries tiers as it ages. Only data that has been written to the data file
+    is ever removed from memory, the file keeps the full resolution history. The snapshot times
+    themselves (8 bytes per snapshot, shared by every process) are always kept.
+
+    Example usage::
+        >>> # 1 hour at full resolution, 10s buckets for a day, then 5 minute buckets forever
+        >>> policy = RetentionPolicy(recent=3600, tiers=[(10, 86400), (300, None)],
+        ...                          max_bytes=256 * 2**20)
+
+    Args:
+        recent: Seconds of data kept at full resolution
+        tiers: (bucket length, age up to which buckets are kept) in seconds of each tier from the
+            finest to the coarsest, an age of None keeps the buckets forever
+        max_bytes: Memory cap of the data held, when exceeded the oldest data is moved down the
+            tiers early and then the oldest buckets of the coarsest tiers are dropped. Default is
+            None for no cap
+    """
+
+    def __init__(self, recent:float=3600.0, tiers:List[Tuple[float, float]]=((10.0, 86400.0), (300.0, None)),
+                 max_bytes:int=None):
+        self.recent = recent
+        self.tiers = [(float(bucket), None if keep is None else float(keep)) for bucket, keep in tiers]
+        self.max_bytes = max_bytes
+        ages = [recent] + [keep for _, keep in self.tiers]
+        if any(age is None for age in ages[:-1]):
+            raise ValueError("Only the coarsest tier can keep data forever")
+        if any(later is not None and later < earlier for earlier, later in zip(ages, ages[1:])):
+            raise ValueError("Each tier must keep data for at least as long as the one before it")
+
+
+class LogSeries:
+    """Values of one series (e.g. the memory of a process) held in a chunk of a SnapshotLog"""
+
+    def __init__(self, pid:int, metric:int, name:str, snapshots:np.ndarray, values:np.ndarray):
+        self.pid = pid
+        self.metric = metric
+        self.name = name
+        self.snapshots = snapshots
+        self.values = values
+
+
+class LogChunk:
+    """A batch of snapshots appended to a SnapshotLog in one write"""
+
+    def __init__(self, first_snapshot:int, times:np.ndarray, series:List[LogSeries]):
+        self.first_snapshot = first_snapshot
+        self.times = times
+        self.series = series
+
+
+class LogIndex:
+    """Lazily read view of a SnapshotLog, through a read-only memory map of the file
+
+    Only the snapshot times and the table of series in each chunk are read when the index is
+    built. The runs and values of a series are numpy arrays over the memory map, so the pages
+    holding them are only read from disk when they are used.
+    """
+
+    TABLE = np.dtype([("pid", "<i8"), ("metric", "<u4"), ("name_offset", "<u8"), ("name_length", "<u4"),
+                      ("runs_offset", "<u8"), ("runs", "<u8"), ("values_offset", "<u8"),
+                      ("values", "<u8")])
+
+    def __init__(self, mapping:np.memmap, times:np.ndarray, table:np.ndarray):
+        self._mapping = mapping
+        self.times = times
+        self.table = table
+
+    def name(self, row:int)->str:
+        entry = self.table[row]
+        offset = int(entry["name_offset"])
+        return bytes(self._mapping[offset:offset + int(entry["name_length"])]).decode()
+
+    def runs(self, row:int)->np.ndarray:
+        """(first snapshot, length) runs of the snapshots of a row"""
+        entry = self.table[row]
+        return np.ndarray((int(entry["runs"]), 2), dtype="<i8", buffer=self._mapping,
+                          offset=int(entry["runs_offset"]))
+
+    def snapshots(self, row:int)->np.ndarray:
+        runs = self.runs(row)
+        if len(runs) == 1:
+            return np.arange(runs[0, 0], runs[0, 0] + runs[0, 1])
+        return np.concatenate([np.arange(first, first + length) for first, length in runs]
+                              or [np.empty(0, dtype=np.int64)])
+
+    def values(self, row:int)->np.ndarray:
+        """Values of a row, backed by the memory map"""
+        entry = self.table[row]
+        return np.ndarray((int(entry["values"]),), dtype="<i8", buffer=self._mapping,
+                          offset=int(entry["values_offset"]))
+
+
+class SnapshotLog:
+    """Append-only, chunked binary file of memory snapshots
+
+    The file starts with a small header followed by chunks. Each chunk is written with a single
+    append and holds the snapshots taken since the previous chunk, so saving never rewrites old
+    data and a crash can only lose the chunk being written. The chunk headers double as an index:
+    each gives the size of its payload and the snapshots and times it covers, so the file can be
+    walked by seeking from header to header.
+
+    Chunk payloads are little-endian and 8-byte aligned:
+
+    * float64 time of each snapshot in the chunk
+    * table of series entries, (pid, metric, name length, number of runs, number of values)
+    * names of the series, padded to 8 bytes
+    * for each series, int64 (first snapshot, length) runs followed by its int64 values
+    """
+
+    MAGIC = b"MEMTLOG\x00"
+    VERSION = 1
+    HEADER = struct.Struct("<8sII") # magic, version, reserved
+    CHUNK_HEADER = struct.Struct("<4sIQQIIdd") # magic, crc32, payload bytes, first snapshot,
+                                               # snapshots, series, first time, last time
+    CHUNK_MAGIC = b"CHNK"
+    SERIES_ENTRY = struct.Struct("<qIIQQ") # pid, metric, name bytes, runs, values
+
+    METRIC_VMS = 0
+    METRIC_TOTAL = 1
+    #Metric of each series of processes by name, readers skip series of metrics they do not know
+    METRICS = {"vms": METRIC_VMS, "rss": 2, "shared": 3, "swap": 4, "uss": 5, "pss": 6}
+
+    def __init__(self, path:str):
+        self.path = path
+
+    @classmethod
+    def is_log(cls, path:str)->bool:
+        """Whether path is a SnapshotLog file"""
+        try:
+            with open(path, "rb") as f:
+                return f.read(len(cls.MAGIC)) == cls.MAGIC
+        except FileNotFoundError:
+            return False
+
+    def create(self):
+        """Create an empty log, replacing any existing file"""
+        with open(self.path, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0))
+
+    def append(self, chunk:LogChunk):
+        """Append a chunk to the end of the log"""
+        with open(self.path, "ab") as f:
+            f.write(self.encode_chunk(chunk))
+            f.flush()
+
+    @classmethod
+    def encode_chunk(cls, chunk:LogChunk)->bytes:
+        """A chunk as written to the log, its header followed by its payload
+
+        The same bytes are used to send chunks between processes, see memorytools.remote.
+        """
+        payload = cls._encode(chunk)
+        times = chunk.times
+        header = cls.CHUNK_HEADER.pack(cls.CHUNK_MAGIC, zlib.crc32(payload), len(payload),
+                                       chunk.first_snapshot, len(times), len(chunk.series),
+                                       times[0] if len(times) else 0.0,
+                                       times[-1] if len(times) else 0.0)
+        return header + payload
+
+    @classmethod
+    def decode_chunk(cls, header:bytes, payload:bytes)->LogChunk:
+        """Decode a chunk encoded by encode_chunk, given its header and payload
+
+        Raises:
+            ValueError: The header is not a chunk header or the payload does not match it
+        """
+        magic, crc, length, first_snapshot, n_snapshots, n_series, _, _ = cls.CHUNK_HEADER.unpack(header)
+        if magic != cls.CHUNK_MAGIC or length != len(payload) or zlib.crc32(payload) != crc:
+            raise ValueError("Corrupt snapshot chunk")
+        return cls._decode(payload, first_snapshot, n_snapshots, n_series)
+
+    @classmethod
+    def _encode(cls, chunk:LogChunk)->bytes:
+        names = []
+        entries = []
+        data = []
+        for series in chunk.series:
+            name = series.name.encode()
+            names.append(name)
+            snapshots = np.asarray(series.snapshots, dtype=np.int64)
+            breaks = np.flatnonzero(np.diff(snapshots) != 1) + 1
+            firsts = snapshots[np.concatenate(([0], breaks))] if len(snapshots) else snapshots
+            lengths = np.diff(np.concatenate(([0], breaks, [len(snapshots)]))) if len(snapshots) else snapshots
+            runs = np.column_stack((firsts, lengths)).astype("<i8")
+            entries.append(cls.SERIES_ENTRY.pack(series.pid, series.metric, len(name), len(runs),
+                                                  len(snapshots)))
+            data.append(runs.tobytes())
+            data.append(np.asarray(series.values, dtype="<i8").tobytes())
+        names = b"".join(names)
+        names = names + b"\x00" * (-len(names) % 8)
+        return b"".join([np.asarray(chunk.times, dtype="<f8").tobytes()] + entries + [names] + data)
+
+    def chunk_headers(self)->Iterator[Tuple[int, tuple]]:
+        """Walk the chunk headers, yielding the offset of each chunk's payload and its header
+
+        A trailing chunk that was only partially written is ignored.
+        """
+        size = os.path.getsize(self.path)
+        with open(self.path, "rb") as f:
+            header = f.read(self.HEADER.size)
+            magic, version, _ = self.HEADER.unpack(header)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError(f"{self.path} is not a version {self.VERSION} memory snapshot log")
+            offset = self.HEADER.size
+            while offset + self.CHUNK_HEADER.size <= size:
+                f.seek(offset)
+                fields = self.CHUNK_HEADER.unpack(f.read(self.CHUNK_HEADER.size))
+                payload_offset = offset + self.CHUNK_HEADER.size
+                if fields[0] != self.CHUNK_MAGIC or payload_offset + fields[2] > size:
+                    break
+                yield payload_offset, fields
+                offset = payload_offset + fields[2]
+
+    def repair(self):
+        """Truncate a trailing chunk left incomplete by a crash so new chunks can follow the last
+        complete one
+
+        Only the last chunk can have been torn by a crash, so only its checksum is verified. Only
+        the writer of a log may repair it, before its first append, as a chunk another process is
+        still writing looks incomplete too.
+        """
+        end = self.HEADER.size
+        last = None
+        for payload_offset, fields in self.chunk_headers():
+            last = (payload_offset, fields)
+            end = payload_offset + fields[2]
+        if last is not None:
+            payload_offset, fields = last
+            with open(self.path, "rb") as f:
+                f.seek(payload_offset)
+                if zlib.crc32(f.read(fields[2])) != fields[1]:
+                    end = payload_offset - self.CHUNK_HEADER.size
+        if os.path.getsize(self.path) != end:
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+
+    def index(self)->LogIndex:
+        """Index every complete chunk in the log without reading the values it holds
+
+        The file is only read, an incomplete trailing chunk is skipped rather than repaired.
+        """
+        entry_dtype = np.dtype([("pid", "<i8"), ("metric", "<u4"), ("name", "<u4"), ("runs", "<u8"),
+                                ("values", "<u8")])
+        mapping = np.memmap(self.path, dtype=np.uint8, mode="r")
+        times = []
+        tables = []
+        n_snapshots_read = 0
+        headers = list(self.chunk_headers())
+        if headers:
+            #The last chunk may be torn by a crash, or still being written by another process
+            payload_offset, fields = headers[-1]
+            if zlib.crc32(mapping[payload_offset:payload_offset + fields[2]]) != fields[1]:
+                headers.pop()
+        for payload_offset, fields in headers:
+            _, _, _, first_snapshot, n_snapshots, n_series, _, _ = fields
+            if first_snapshot != n_snapshots_read:
+                raise ValueError(f"{self.path} is missing snapshots {n_snapshots_read}-{first_snapshot}")
+            n_snapshots_read = n_snapshots_read + n_snapshots
+            times.append(np.ndarray((n_snapshots,), dtype="<f8", buffer=mapping, offset=payload_offset))
+            entries_offset = payload_offset + 8 * n_snapshots
+            entries = np.ndarray((n_series,), dtype=entry_dtype, buffer=mapping, offset=entries_offset)
+            names_offset = entries_offset + entry_dtype.itemsize * n_series
+            name_lengths = entries["name"].astype(np.uint64)
+            data_offset = names_offset + int(name_lengths.sum()) + (-int(name_lengths.sum()) % 8)
+            sizes = 16 * entries["runs"] + 8 * entries["values"]
+
+            table = np.empty(n_series, dtype=LogIndex.TABLE)
+            table["pid"] = entries["pid"]
+            table["metric"] = entries["metric"]
+            table["name_offset"] = names_offset + np.cumsum(name_lengths) - name_lengths
+            table["name_length"] = entries["name"]
+            table["runs_offset"] = data_offset + np.cumsum(sizes) - sizes
+            table["runs"] = entries["runs"]
+            table["values_offset"] = table["runs_offset"] + 16 * entries["runs"]
+            table["values"] = entries["values"]
+            tables.append(table)
+        times = np.concatenate(times) if times else np.empty(0)
+        table = np.concatenate(tables) if tables else np.empty(0, dtype=LogIndex.TABLE)
+        return LogIndex(mapping, times, table)
+
+    def chunks(self)->Iterator[LogChunk]:
+        """Read every complete chunk in the log, in the order they were written"""
+        with open(self.path, "rb") as f:
+            for payload_offset, fields in self.chunk_headers():
+                _, crc, length, first_snapshot, n_snapshots, n_series, _, _ = fields
+                f.seek(payload_offset)
+                payload = f.read(length)
+                if zlib.crc32(payload) != crc:
+                    break # Torn write, the rest of the log cannot be trusted
+                yield self._decode(payload, first_snapshot, n_snapshots, n_series)
+
+    @classmethod
+    def _decode(cls, payload:bytes, first_snapshot:int, n_snapshots:int, n_series:int)->LogChunk:
+        times = np.frombuffer(payload, dtype="<f8", count=n_snapshots)
+        offset = 8 * n_snapshots
+        entries = []
+        for _ in range(n_series):
+            entries.append(cls.SERIES_ENTRY.unpack_from(payload, offset))
+            offset = offset + cls.SERIES_ENTRY.size
+        name_bytes = sum(entry[2] for entry in entries)
+        names = payload[offset:offset + name_bytes]
+        offset = offset + name_bytes + (-name_bytes % 8)
+        series = []
+        name_offset = 0
+        for pid, metric, name_length, n_runs, n_values in entries:
+            name = names[name_offset:name_offset + name_length].decode()
+            name_offset = name_offset + name_length
+            runs = np.frombuffer(payload, dtype="<i8", count=2 * n_runs, offset=offset).reshape(-1, 2)
+            offset = offset + 16 * n_runs
+            values = np.frombuffer(payload, dtype="<i8", count=n_values, offset=offset)
+            offset = offset + 8 * n_values
+            snapshots = np.concatenate([np.arange(first, first + length) for first, length in runs]
+                                       or [np.empty(0, dtype=np.int64)])
+            series.append(LogSeries(pid, metric, name, snapshots, values))
+        return LogChunk(first_snapshot, times, series)
@@ -0,0 +1,246 @@
+import logging
+from typing import Callable, Iterable, List, Tuple
+
+import numpy as np
+
+from . import memoryanalysis
+
+try:
+    import ccs
+    CCSENV=True
+except ImportError:
+    CCSENV=False
+
+
+class LeakAlert:
+    """A process found to be leaking by an OnlineLeakDetector"""
+
+    def __init__(self, time:float, pid:int, name:str, window:int, gradient:float, r2:float,
+                 time_to_critical:float):
+        self.time = time # Time of the last sample of the window
+        self.pid = pid
+        self.name = name
+        self.window = window # Number of resampled points in the window
+        self.gradient = gradient # Bytes per second
+        self.r2 = r2
+        self.time_to_critical = time_to_critical
+
+    def __repr__(self):
+        return (f"LeakAlert(pid={self.pid}, name={self.name!r}, window={self.window}, "
+                f"gradient={self.gradient:.1f}, r2={self.r2:.3f})")
+
+
+class _OnlineSeries:
+    """Regression state of a single process
+
+    Samples are resampled onto a grid of RESAMPLE_MIN_WIN spacing as they arrive and kept in a
+    ring buffer. For each window size, running sums of y, y^2 and j*y (j being the number of
+    grid steps back from the newest point) are updated as points enter and leave the window.
+    Values are taken relative to the first value of the segment, and the sums are recomputed
+    from the ring buffer every time it wraps to stop rounding errors accumulating.
+    """
+
+    def __init__(self, sizes:np.ndarray, interval:float):
+        self.sizes = sizes
+        self.interval = interval
+        self.ring = np.zeros(sizes[-1])
+        self.sum_y = np.zeros(len(sizes))
+        self.sum_yy = np.zeros(len(sizes))
+        self.sum_jy = np.zeros(len(sizes))
+        self.last_time = None
+        self.reset()
+
+    def reset(self):
+        """Start a new segment, as after a gap in the samples"""
+        self.head = 0 # Index the next point is written to
+        self.points = 0 # Points pushed since the start of the segment
+        self.sum_y[:] = 0
+        self.sum_yy[:] = 0
+        self.sum_jy[:] = 0
+        self.reference = None
+        self.next_time = None
+        self.alerted = False
+
+    def add(self, time:float, value:float)->bool:
+        """Add a sample
+
+        Returns:
+            True when at least one resampled point was added
+        """
+        if self.last_time is not None and time - self.last_time > memoryanalysis.MAX_TIME_DIFF:
+            self.reset()
+        added = False
+        if self.next_time is None:
+            self.reference = value
+            self.next_time = time
+        if time >= self.next_time:
+            #Linearly interpolate every grid point up to this sample, as np.interp would
+            if self.points == 0:
+                previous_time, previous_value = time, value
+            else:
+                previous_time, previous_value = self.last_time, self.last_value
+            while self.next_time <= time:
+                if time == previous_time:
+                    point = value
+                else:
+                    point = previous_value + (value - previous_value) * \
+                            (self.next_time - previous_time) / (time - previous_time)
+                self.push(point - self.reference)
+                self.next_time = self.next_time + self.interval
+                added = True
+        self.last_time = time
+        self.last_value = value
+        return added
+
+    def push(self, y:float):
+        capacity = len(self.ring)
+        full = self.points >= self.sizes
+        old = self.ring[(self.head - self.sizes) % capacity]
+        self.sum_jy += self.sum_y
+        self.sum_jy -= np.where(full, self.sizes * old, 0)
+        self.sum_y -= np.where(full, old, 0)
+        self.sum_yy -= np.where(full, old * old, 0)
+        self.sum_y += y
+        self.sum_yy += y * y
+        self.ring[self.head] = y
+        self.head = (self.head + 1) % capacity
+        self.points = self.points + 1
+        if self.head == 0:
+            self.recompute()
+
+    def recompute(self):
+        """Recompute the running sums exactly from the ring buffer"""
+        capacity = len(self.ring)
+        newest_first = np.roll(self.ring, -self.head)[::-1][:min(self.points, capacity)]
+        for i, size in enumerate(self.sizes):
+            window = newest_first[:size]
+            self.sum_y[i] = window.sum()
+            self.sum_yy[i] = (window * window).sum()
+            self.sum_jy[i] = (np.arange(len(window)) * window).sum()
+
+    def regress(self)->Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Fit a line to each full window ending at the newest point
+
+        Returns:
+            Window sizes, gradients, R^2 and time to critical memory usage of each full window
+        """
+        full = self.points >= self.sizes
+        k = self.sizes[full].astype(float)
+        sum_y = self.sum_y[full]
+        #Times relative to the newest point are 0, -dt, -2dt, ...
+        dt = self.interval
+        sum_t = -dt * k * (k - 1) / 2
+        sum_tt = dt * dt * (k - 1) * k * (2 * k - 1) / 6
+        ss_tt = sum_tt - sum_t * sum_t / k
+        ss_ty = -dt * self.sum_jy[full] - sum_t * sum_y / k
+        ss_yy = np.maximum(self.sum_yy[full] - sum_y * sum_y / k, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ms = ss_ty / ss_tt
+            r_den = np.sqrt(ss_tt * ss_yy)
+            r_pcc = np.where(r_den == 0, 0.0, ss_ty / r_den)
+            r2s = np.minimum(r_pcc**2, 1.0)
+            t0 = self.next_time - self.interval # Time of the newest point
+            cs = (self.reference + sum_y / k) - ms * (t0 + sum_t / k)
+            t_crits = np.where(ms == 0, np.inf, (memoryanalysis.CRITICAL_MEMORY_USAGE - cs) / ms)
+        return self.sizes[full], ms, r2s, t_crits
+
+
+class OnlineLeakDetector:
+    """Detect memory leaks while snapshots are being taken
+
+    The streaming form of the linear backward regression (LBR) algorithm. Each process is
+    resampled online onto a grid of RESAMPLE_MIN_WIN spacing, splitting on gaps larger than
+    MAX_TIME_DIFF, and lines are fitted over backward windows ending at the newest point.
+    Rather than every window size, a geometric series of sizes from WIN_MIN_NUM_POINTS_DETECT
+    up to max_window is fitted, so each resampled point costs O(log(max_window)) and memory is
+    bounded by a ring buffer of max_window points per process. A process is reported once per
+    segment, as soon as a window meets the R_SQR_MIN and CRITICAL_TIME_MAX criteria.
+
+    The thresholds are read from memoryanalysis as each snapshot is added, so changes to them
+    apply to a running detector. The window sizes and interval are fixed when it is created.
+
+    Example usage::
+        >>> detector = OnlineLeakDetector(callback=print)
+        >>> mem_monitor = MemoryMonitor(detector=detector)
+        >>> mem_monitor.start_monitoring() #Leaks are printed as they are found
+
+    Args:
+        callback: Called with a LeakAlert for each leak found, from the thread taking the
+            snapshots. Default is None which logs a warning instead
+        max_window: Largest window, in resampled points
+        interval: Spacing of the resampled points in seconds, default is None which uses
+            memoryanalysis.RESAMPLE_MIN_WIN
+    """
+
+    def __init__(self, callback:Callable[[LeakAlert], None]=None, max_window:int=3600,
+                 interval:float=None):
+        max_window = max(int(max_window), memoryanalysis.WIN_MIN_NUM_POINTS_DETECT)
+        sizes = [memoryanalysis.WIN_MIN_NUM_POINTS_DETECT]
+        while sizes[-1] * 2 < max_window:
+            sizes.append(sizes[-1] * 2)
+        if sizes[-1] != max_window:
+            sizes.append(max_window)
+        self.sizes = np.array(sizes)
+        self.interval = memoryanalysis.RESAMPLE_MIN_WIN if interval is None else interval
+        self.callback = callback
+        self.alerts = [] # Every LeakAlert raised
+        self.__series = {} # pid -> _OnlineSeries
+
+    def logger(self):
+        if CCSENV:
+            return ccs.logger
+        else:
+            return logging.getLogger(__name__)
+
+    def update(self, time:float, samples:Iterable[Tuple[int, int]],
+               names:Callable[[int], str]=None)->List[LeakAlert]:
+        """Add the samples of a snapshot
+
+        Args:
+            time: Time of the snapshot as a POSIX timestamp
+            samples: (pid, memory usage) of each process in the snapshot
+            names: Returns the name of a process from its pid, used for alerts
+
+        Returns:
+            The alerts raised by this snapshot
+        """
+        alerts = []
+        seen = 0
+        for pid, value in samples:
+            seen = seen + 1
+            series = self.__series.get(pid)
+            if series is None:
+                series = self.__series[pid] = _OnlineSeries(self.sizes, self.interval)
+            if not series.add(time, float(value)) or series.alerted:
+                continue
+            windows, ms, r2s, t_crits = series.regress()
+            anomalous = np.flatnonzero((r2s >= memoryanalysis.R_SQR_MIN) & (t_crits > memoryanalysis.CRITICAL_TIME_MAX))
+            if len(anomalous) != 0:
+                series.alerted = True
+                i = anomalous[0]
+                name = names(pid) if names is not None else str(pid)
+                alerts.append(LeakAlert(time, pid, name, int(windows[i]), float(ms[i]),
+                                        float(r2s[i]), float(t_crits[i])))
+        if len(self.__series) > seen:
+            #Forget processes that have not been seen for longer than a gap
+            for pid in [pid for pid, series in self.__series.items()
+                        if time - series.last_time > memoryanalysis.MAX_TIME_DIFF]:
+                del self.__series[pid]
+        for alert in alerts:
+            self.alerts.append(alert)
+            if self.callback is not None:
+                self.callback(alert)
+            else:
+                self.logger().warning(f"Memory leak detected in process {alert.name} with pid "
+                                      f"{alert.pid}: {alert.gradient:.1f} B/s over "
+                                      f"{alert.window} points, R^2 {alert.r2:.3f}")
+        return alerts
+
+    def forget(self, pid:int):
+        """Drop the regression state of a process, as when its pid is reused by a new process"""
+        self.__series.pop(pid, None)
+
+    @property
+    def pids(self)->List[int]:
+        """Processes currently tracked"""
+        return list(self.__series)
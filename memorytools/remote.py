@@ -0,0 +1,300 @@
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import re
+import socket
+import socketserver
+import struct
+import threading
+from typing import Dict, List, Tuple
+
+from .memorymonitor import MemoryMonitor, MemorySnapper
+from .memorystore import LogChunk, RetentionPolicy, SnapshotLog
+
+try:
+    import ccs
+    CCSENV=True
+except ImportError:
+    CCSENV=False
+
+
+HELLO = struct.Struct("<4sI") # magic, host name bytes, sent once by an agent when it connects
+HELLO_MAGIC = b"HELO"
+
+
+def parse_address(address:str)->Tuple[int, object]:
+    """Socket family and address of "host:port" for TCP, or of the path of a Unix socket
+
+    Example usage::
+        >>> parse_address("localhost:8131")
+        (<AddressFamily.AF_INET: 2>, ('localhost', 8131))
+        >>> parse_address("/tmp/memorytools.sock")
+        (<AddressFamily.AF_UNIX: 1>, '/tmp/memorytools.sock')
+    """
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit() and "/" not in address:
+        return socket.AF_INET, (host or "0.0.0.0", int(port))
+    return socket.AF_UNIX, address
+
+
+def _recv_exactly(sock:socket.socket, size:int)->bytes:
+    """Read size bytes, or b"" if the connection was closed before the first byte"""
+    data = bytearray()
+    while len(data) < size:
+        received = sock.recv(size - len(data))
+        if not received:
+            if data:
+                raise ConnectionError("Connection closed part way through a message")
+            return b""
+        data.extend(received)
+    return bytes(data)
+
+
+class MemoryAgent(MemoryMonitor):
+    """Memory monitor streaming its snapshots to a SnapshotAggregator instead of a data file
+
+    Every flush_interval the snapshots taken since the last batch are sent as one chunk, encoded
+    as in the data file (see SnapshotLog.encode_chunk). Sent data is dropped from memory. When the
+    aggregator cannot be reached the data is kept and sent with the next batch, the connection is
+    retried on every flush.
+
+    Args:
+        address: Address of the aggregator, "host:port" or the path of a Unix socket
+        host: Name the aggregator stores the data under, default is the host name of this machine
+        time_interval: Time interval between snapshots in seconds
+        flush_interval: Time interval between batches sent to the aggregator in seconds
+        sampler: Sampler used to read process memory, see MemoryMonitor
+        cpu_budget: Fraction of each interval snapshots may use in CPU time, see MemoryMonitor
+
+    Example usage::
+        >>> agent = MemoryAgent("aggregator.example:8131", time_interval=1.0, flush_interval=10.0)
+        >>> agent.start_monitoring()
+    """
+
+    def __init__(self, address:str, host:str=None, time_interval:float=1.0, flush_interval:float=10.0,
+                 sampler=None, cpu_budget:float=None):
+        self.address = address
+        self.host = socket.gethostname() if host is None else host
+        self.__socket = None
+        #Nothing is read or written locally, flushed chunks are sent by _write_chunk
+        super().__init__(time_interval=time_interval, flush_interval=flush_interval, sampler=sampler,
+                         cpu_budget=cpu_budget, retention=RetentionPolicy(recent=0, tiers=()), persist=False)
+
+    def __connect(self)->socket.socket:
+        if self.__socket is None:
+            family, address = parse_address(self.address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+                host = self.host.encode()
+                sock.sendall(HELLO.pack(HELLO_MAGIC, len(host)) + host)
+            except OSError:
+                sock.close()
+                raise
+            self.__socket = sock
+        return self.__socket
+
+    def __disconnect(self):
+        if self.__socket is not None:
+            self.__socket.close()
+            self.__socket = None
+
+    def _writes_chunks(self)->bool:
+        return True # Chunks are written to the aggregator rather than a data file
+
+    def _write_chunk(self, chunk:LogChunk):
+        try:
+            self.__connect().sendall(SnapshotLog.encode_chunk(chunk))
+        except OSError:
+            self.__disconnect()
+            raise
+
+    def flush(self):
+        """Send the snapshots taken since the last batch to the aggregator"""
+        try:
+            super().flush()
+        except OSError as e:
+            self.logger().warning(f"Unable to send snapshots to {self.address}, keeping them: {e}")
+
+    def close(self):
+        super().close()
+        self.__disconnect()
+
+
+class _AgentHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.server.aggregator._serve(self.request)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class SnapshotAggregator:
+    """Receive snapshots from MemoryAgents and store them in one MemorySnapper per host
+
+    Each agent connection is served by its own thread. Chunks are merged into the snapper of the
+    agent's host and appended to its data file, <data_dir>/<host>.dat, as they arrive, so the
+    data of a host survives the aggregator restarting and can be opened with MemorySnapper.
+
+    Args:
+        address: Address to listen on, "host:port" or the path of a Unix socket. Port 0 picks a
+            free port, see address
+        data_dir: Directory of the data file of each host
+
+    Example usage::
+        >>> aggregator = SnapshotAggregator(":8131", "memorydata")
+        >>> aggregator.start()
+        >>> <Start agents and wait>
+        >>> aggregator.detect_leaks("LBR", workers=4)
+        {'host1': (['leaky'], [1234]), 'host2': ([], [])}
+    """
+
+    def __init__(self, address:str, data_dir:str):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self.__snappers = {} # host -> MemorySnapper
+        self.__locks = {} # host -> lock held while a chunk is merged or the data is analysed
+        self.__lock = threading.Lock()
+        family, address = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            os.remove(address)
+        server_class = _UnixServer if family == socket.AF_UNIX else _TCPServer
+        self.__server = server_class(address, _AgentHandler)
+        self.__server.aggregator = self
+        self.__thread = None
+
+    @property
+    def address(self)->str:
+        """Address the aggregator is listening on, in the form agents are given it"""
+        address = self.__server.server_address
+        if isinstance(address, tuple):
+            return f"{address[0]}:{address[1]}"
+        return address
+
+    def logger(self):
+        if CCSENV:
+            return ccs.logger
+        else:
+            return logging.getLogger(__name__)
+
+    def start(self):
+        """Start accepting agents in a background thread"""
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """Stop accepting agents and write any data received to the data files"""
+        self.__server.shutdown()
+        self.__server.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+        if isinstance(self.__server.server_address, str) and os.path.exists(self.__server.server_address):
+            os.remove(self.__server.server_address)
+        self.flush()
+
+    @property
+    def hosts(self)->List[str]:
+        """Hosts data has been received from"""
+        with self.__lock:
+            return sorted(self.__snappers)
+
+    def data_file(self, host:str)->str:
+        """Path of the data file of a host"""
+        return os.path.join(self.data_dir, re.sub(r"[^\w.-]", "_", host) + ".dat")
+
+    def __getitem__(self, host:str)->MemorySnapper:
+        with self.__lock:
+            return self.__snappers[host]
+
+    def __host(self, host:str)->Tuple[MemorySnapper, threading.Lock]:
+        with self.__lock:
+            if host not in self.__snappers:
+                self.__snappers[host] = MemorySnapper(existing_data_file=self.data_file(host))
+                self.__locks[host] = threading.Lock()
+            return self.__snappers[host], self.__locks[host]
+
+    def _serve(self, sock:socket.socket):
+        """Receive the chunks of one agent until it disconnects"""
+        header = _recv_exactly(sock, HELLO.size)
+        if not header:
+            return
+        magic, length = HELLO.unpack(header)
+        if magic != HELLO_MAGIC:
+            self.logger().warning("Closing connection that is not from a memory agent")
+            return
+        host = _recv_exactly(sock, length).decode()
+        self.logger().info(f"Agent connected from {host}")
+        mem_snap, lock = self.__host(host)
+        try:
+            while True:
+                header = _recv_exactly(sock, SnapshotLog.CHUNK_HEADER.size)
+                if not header:
+                    break
+                length = SnapshotLog.CHUNK_HEADER.unpack(header)[2]
+                chunk = SnapshotLog.decode_chunk(header, _recv_exactly(sock, length))
+                with lock:
+                    mem_snap.merge_chunk(chunk)
+                    mem_snap.flush()
+        except (ConnectionError, ValueError, struct.error) as e:
+            self.logger().warning(f"Dropping connection from {host}: {e}")
+        self.logger().info(f"Agent disconnected from {host}")
+
+    def flush(self):
+        """Append the data received from every host to its data file"""
+        for host in self.hosts:
+            mem_snap, lock = self.__host(host)
+            with lock:
+                mem_snap.flush()
+
+    def detect_leaks(self, algo:str="LBR", hosts:List[str]=None,
+                     workers:int=None)->Dict[str, Tuple[List[str], List[int]]]:
+        """Detect memory leaks in the data of every host, one host per worker process
+
+        The data of each host is flushed to its data file, then read from the file by a worker.
+        Data received while the workers run is merged once they have finished.
+
+        Args:
+            algo: Algorithm to use to detect memory leaks
+            hosts: Hosts to analyse, default is None which analyses every host
+            workers: Number of worker processes, default is None which analyses every host in
+                this process
+
+        Returns:
+            host -> names and pids of the processes of the host that are abnormally using memory
+        """
+        hosts = self.hosts if hosts is None else list(hosts)
+        if workers is not None and workers > 1 and len(hosts) > 1:
+            #Chunks are not merged while workers read the data files, so no file is being appended to
+            locks = [self.__host(host)[1] for host in hosts]
+            for lock in locks:
+                lock.acquire()
+            try:
+                for host in hosts:
+                    self.__host(host)[0].flush()
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    futures = {host: pool.submit(_detect_leaks_host, self.data_file(host), algo) for host in hosts}
+                    return {host: future.result() for host, future in futures.items()}
+            finally:
+                for lock in locks:
+                    lock.release()
+        results = {}
+        for host in hosts:
+            mem_snap, lock = self.__host(host)
+            with lock:
+                results[host] = mem_snap.detect_leaks(algo)
+        return results
+
+
+def _detect_leaks_host(data_file:str, algo:str)->Tuple[List[str], List[int]]:
+    """Detect memory leaks in the data file of a host, in a worker process"""
+    mem_snap = MemorySnapper(existing_data_file=data_file)
+    try:
+        return mem_snap.detect_leaks(algo)
+    finally:
+        mem_snap.sampler.close()
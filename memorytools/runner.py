@@ -1,9 +1,15 @@
+import os
+import tempfile
 import time
+from typing import List
 from typing_extensions import Annotated
 import typer
 
 import memorytools.memorymonitor as memorymonitor
 import memorytools.memoryanalysis as memoryanalysis
+from memorytools.filters import ProcessFilter
+from memorytools.memorystore import RetentionPolicy
+from memorytools.remote import MemoryAgent, SnapshotAggregator
 
 app = typer.Typer()
 
@@ -32,16 +38,20 @@ def export(
                              ] = None,
         output_file: Annotated[str,
                                typer.Option(help="Path to the output file for exporting data")
-                               ] = "memorymonitor_out.csv"):
+                               ] = "memorymonitor_out.csv",
+        name_table: Annotated[bool,
+                              typer.Option(help="Write process names once to a separate names file")
+                              ] = False):
     """
     Export memory data to a CSV file]
     
     Args:
         data_file: Path to the data file for persistence across instances
         output_file: Path to the output file for exporting data
+        name_table: Write process names once to a separate names file instead of on every row
     """
     mem_snap = memorymonitor.MemorySnapper(existing_data_file=data_file)
-    mem_snap.export_to_csv(output_file)
+    mem_snap.export_to_csv(output_file, name_table=name_table)
     print(f'Data exported to {output_file} successfully.')
 
 
@@ -50,7 +60,47 @@ def monitor(interval: Annotated[float,
                                 typer.Option(help="Time interval for monitoring in seconds")]= 1.0,
             data_file: Annotated[str, 
                                  typer.Option(help="Path to the data file for persistence across instances")
-                                 ]= None):
+                                 ]= None,
+            sampler: Annotated[str,
+                               typer.Option(help="Sampler used to read process memory, psutil or procfs")
+                               ]= "psutil",
+            cpu_budget: Annotated[float,
+                                  typer.Option(help="Fraction of the interval snapshots may use in CPU time")
+                                  ]= None,
+            retain: Annotated[float,
+                              typer.Option(help="Seconds of data kept in memory at full resolution")
+                              ]= None,
+            max_memory: Annotated[float,
+                                  typer.Option(help="Cap on the memory data held in MB")
+                                  ]= None,
+            pid: Annotated[List[int],
+                           typer.Option(help="Pid of a process to monitor, can be repeated")
+                           ]= None,
+            name: Annotated[List[str],
+                            typer.Option(help="Glob of the names of processes to monitor, can be repeated")
+                            ]= None,
+            tree: Annotated[List[int],
+                            typer.Option(help="Pid of a process to monitor with its descendants, can be repeated")
+                            ]= None,
+            cgroup: Annotated[List[str],
+                              typer.Option(help="cgroup whose processes are monitored, can be repeated")
+                              ]= None,
+            exclude_pid: Annotated[List[int],
+                                   typer.Option(help="Pid of a process not to monitor, can be repeated")
+                                   ]= None,
+            exclude_name: Annotated[List[str],
+                                    typer.Option(help="Glob of the names of processes not to monitor, can be repeated")
+                                    ]= None,
+            exclude_tree: Annotated[List[int],
+                                    typer.Option(help="Pid of a process not to monitor with its descendants, can be repeated")
+                                    ]= None,
+            exclude_cgroup: Annotated[List[str],
+                                      typer.Option(help="cgroup whose processes are not monitored, can be repeated")
+                                      ]= None,
+            metric: Annotated[List[str],
+                              typer.Option(help="Metric sampled besides vms, NAME or NAME=SECONDS between samples, "
+                                                "can be repeated")
+                              ]= None):
     """
     Start monitoring memory usage in the background, this can be stopped by pressing Ctrl+C in the 
     terminal
@@ -58,8 +108,34 @@ def monitor(interval: Annotated[float,
     Args:
         interval: Time interval for monitoring in seconds
         data_file: Path to the data file for persistence across instances
+        sampler: Sampler used to read process memory, psutil or procfs
+        cpu_budget: Fraction of the interval snapshots may use in CPU time before the interval is
+            lengthened, default is a fixed interval
+        retain: Seconds of data kept in memory at full resolution before being downsampled,
+            default keeps everything
+        max_memory: Cap on the memory data held in MB
+        pid, name, tree, cgroup: Processes to monitor, default is every process, see ProcessFilter
+        exclude_pid, exclude_name, exclude_tree, exclude_cgroup: Processes not to monitor
+        metric: Metrics sampled besides vms (rss, shared, swap, uss, pss), as NAME to sample it in
+            every snapshot or NAME=SECONDS to sample it every SECONDS
     """
-    mem_monitor = memorymonitor.MemoryMonitor(data_file=data_file, time_interval=interval)
+    metrics = {}
+    for item in metric or ():
+        metric_name, _, seconds = item.partition("=")
+        metrics[metric_name] = float(seconds) if seconds else 0.0
+    process_filter = ProcessFilter(pids=pid or (), names=name or (), trees=tree or (), cgroups=cgroup or (),
+                                   exclude_pids=exclude_pid or (), exclude_names=exclude_name or (),
+                                   exclude_trees=exclude_tree or (), exclude_cgroups=exclude_cgroup or ())
+    if not process_filter.includes and not process_filter.excludes:
+        process_filter = None
+    retention = None
+    if retain is not None or max_memory is not None:
+        retention = RetentionPolicy(recent=3600.0 if retain is None else retain,
+                                    max_bytes=None if max_memory is None else int(max_memory * 2**20))
+    mem_monitor = memorymonitor.MemoryMonitor(data_file=data_file, time_interval=interval,
+                                              sampler=sampler, cpu_budget=cpu_budget,
+                                              retention=retention, process_filter=process_filter,
+                                              metrics=metrics)
     mem_monitor.start_monitoring()
     print('Memory monitoring started. Press Ctrl+C to stop.')
     try:
@@ -70,5 +146,121 @@ def monitor(interval: Annotated[float,
             mem_monitor.stop_monitoring()
         print('Memory monitoring stopped.')
 
+@app.command()
+def stats(interval: Annotated[float,
+                              typer.Option(help="Time interval for monitoring in seconds")]= 0.005,
+          duration: Annotated[float,
+                              typer.Option(help="Time to monitor for in seconds")]= 10.0,
+          sampler: Annotated[str,
+                             typer.Option(help="Sampler used to read process memory, psutil or procfs")
+                             ]= "psutil",
+          cpu_budget: Annotated[float,
+                                typer.Option(help="Fraction of the interval snapshots may use in CPU time")
+                                ]= None):
+    """
+    Monitor memory usage for a while and report the overhead of the monitor itself, the data
+    collected is discarded
+    
+    Args:
+        interval: Time interval for monitoring in seconds
+        duration: Time to monitor for in seconds
+        sampler: Sampler used to read process memory, psutil or procfs
+        cpu_budget: Fraction of the interval snapshots may use in CPU time before the interval is
+            lengthened, default is a fixed interval
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        mem_monitor = memorymonitor.MemoryMonitor(data_file=os.path.join(directory, "stats.dat"),
+                                                  time_interval=interval, sampler=sampler,
+                                                  cpu_budget=cpu_budget)
+        mem_monitor.stats.reset()
+        mem_monitor.start_monitoring()
+        try:
+            time.sleep(duration)
+        except KeyboardInterrupt:
+            pass
+        mem_monitor.stop_monitoring()
+        print(mem_monitor.stats)
+        mem_monitor.close()
+
+@app.command()
+def agent(address: Annotated[str,
+                             typer.Option(help="Address of the aggregator, host:port or the path of a Unix socket")
+                             ]= "localhost:8131",
+          host: Annotated[str,
+                          typer.Option(help="Name the aggregator stores the data under")]= None,
+          interval: Annotated[float,
+                              typer.Option(help="Time interval for monitoring in seconds")]= 1.0,
+          batch_interval: Annotated[float,
+                                    typer.Option(help="Time interval between batches sent in seconds")]= 10.0,
+          sampler: Annotated[str,
+                             typer.Option(help="Sampler used to read process memory, psutil or procfs")
+                             ]= "psutil",
+          cpu_budget: Annotated[float,
+                                typer.Option(help="Fraction of the interval snapshots may use in CPU time")
+                                ]= None):
+    """
+    Monitor memory usage and stream the snapshots to an aggregator rather than a data file, this
+    can be stopped by pressing Ctrl+C in the terminal
+
+    Args:
+        address: Address of the aggregator, host:port or the path of a Unix socket
+        host: Name the aggregator stores the data under, default is the host name
+        interval: Time interval for monitoring in seconds
+        batch_interval: Time interval between batches of snapshots sent in seconds
+        sampler: Sampler used to read process memory, psutil or procfs
+        cpu_budget: Fraction of the interval snapshots may use in CPU time before the interval is
+            lengthened, default is a fixed interval
+    """
+    mem_agent = MemoryAgent(address, host=host, time_interval=interval, flush_interval=batch_interval,
+                            sampler=sampler, cpu_budget=cpu_budget)
+    mem_agent.start_monitoring()
+    print(f'Sending memory snapshots of {mem_agent.host} to {address}. Press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        mem_agent.close()
+        print('Memory monitoring stopped.')
+
+@app.command()
+def aggregate(address: Annotated[str,
+                                 typer.Option(help="Address to listen on, host:port or the path of a Unix socket")
+                                 ]= ":8131",
+              data_dir: Annotated[str,
+                                  typer.Option(help="Directory of the data file of each host")
+                                  ]= "memorydata",
+              detect_interval: Annotated[float,
+                                         typer.Option(help="Time interval between leak detections in seconds")
+                                         ]= 60.0,
+              algo: Annotated[str,
+                              typer.Option(help="Leak detection algorithm")]= "LBR",
+              workers: Annotated[int,
+                                 typer.Option(help="Worker processes analysing hosts in parallel")]= None):
+    """
+    Receive memory snapshots from agents into a data file per host and periodically detect leaks
+    on every host, this can be stopped by pressing Ctrl+C in the terminal
+
+    Args:
+        address: Address to listen on, host:port or the path of a Unix socket
+        data_dir: Directory of the data file of each host
+        detect_interval: Time interval between leak detections in seconds
+        algo: Leak detection algorithm
+        workers: Number of worker processes analysing hosts in parallel, default analyses every
+            host in this process
+    """
+    aggregator = SnapshotAggregator(address, data_dir)
+    aggregator.start()
+    print(f'Receiving memory snapshots on {aggregator.address}. Press Ctrl+C to stop.')
+    try:
+        while True:
+            time.sleep(detect_interval)
+            for host, (names, pids) in aggregator.detect_leaks(algo, workers=workers).items():
+                if pids:
+                    procs = ", ".join(f"{aggregator[host][pid].name} ({pid})" for pid in pids)
+                    print(f'{host}: abnormal memory usage in {procs}')
+    except KeyboardInterrupt:
+        aggregator.stop()
+        print('Aggregator stopped.')
+
 if __name__ == "__main__":
     app()
\ No newline at end of file
@@ -0,0 +1,259 @@
+import os
+import time
+from multiprocessing import shared_memory
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .filters import ProcessFilter
+from .memorystore import LogChunk, LogSeries, SnapshotLog
+from .samplers import make_sampler
+
+try:
+    import ccs
+    CCSENV=True
+except ImportError:
+    CCSENV=False
+
+
+class SampleRing:
+    """Ring buffers of memory samples in shared memory, written by one sampler process and read by one monitor
+
+    The shared memory holds three rings: snapshots (time and overhead of each snapshot), samples
+    (snapshot number, pid and memory usage) and identities (snapshot number, pid, creation time
+    and name of each process the first time it is sampled). Each ring has a write position, only advanced by the
+    writer once the records before it are written, and a read position, only advanced by the
+    reader once it no longer needs them, so neither side ever locks or waits for the other. A
+    snapshot that does not fit in the space the reader has not released yet is dropped whole and
+    counted in dropped.
+
+    The reader reads the records in place, as numpy arrays over the shared memory.
+
+    Args:
+        capacity: Number of samples the ring holds, the rings of snapshots and identities hold
+            capacity // 16 records
+        name: Name of existing shared memory to attach to, default is None which creates it
+    """
+
+    HEADER = np.dtype([("snapshots_write", "<u8"), ("snapshots_read", "<u8"), ("samples_write", "<u8"),
+                       ("samples_read", "<u8"), ("identities_write", "<u8"), ("identities_read", "<u8"),
+                       ("dropped", "<u8"), ("missed", "<u8")])
+    SNAPSHOT = np.dtype([("time", "<f8"), ("start", "<f8"), ("latency", "<f8"), ("processes", "<i8")])
+    SAMPLE = np.dtype([("snapshot", "<u8"), ("pid", "<i8"), ("vms", "<i8")])
+    IDENTITY = np.dtype([("snapshot", "<u8"), ("pid", "<i8"), ("create_time", "<f8"), ("name", "S128")])
+
+    def __init__(self, capacity:int=2**20, name:str=None):
+        self.capacity = capacity
+        self.small_capacity = max(capacity // 16, 1)
+        size = self.HEADER.itemsize + capacity * self.SAMPLE.itemsize + \
+            self.small_capacity * (self.SNAPSHOT.itemsize + self.IDENTITY.itemsize)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        offset = 0
+        def view(dtype, count):
+            nonlocal offset
+            array = np.ndarray((count,), dtype=dtype, buffer=self.shm.buf, offset=offset)
+            offset = offset + dtype.itemsize * count
+            return array
+        self.header = view(self.HEADER, 1)[0]
+        self.snapshots = view(self.SNAPSHOT, self.small_capacity)
+        self.samples = view(self.SAMPLE, capacity)
+        self.identities = view(self.IDENTITY, self.small_capacity)
+        self.__identities = {} # pid -> (name, creation time) of the processes identified, kept by the reader
+
+    def __getstate__(self):
+        #Sent to a spawned sampler process by name, the process attaches to the same memory
+        return {"capacity": self.capacity, "name": self.shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["capacity"], name=state["name"])
+
+    @property
+    def dropped(self)->int:
+        """Number of snapshots dropped because the ring was full"""
+        return int(self.header["dropped"])
+
+    @property
+    def missed(self)->int:
+        """Number of scheduled snapshots the sampler process skipped because the previous one overran"""
+        return int(self.header["missed"])
+
+    def __free(self, ring:str, capacity:int)->int:
+        return capacity - int(self.header[ring + "_write"] - self.header[ring + "_read"])
+
+    @staticmethod
+    def __put(array:np.ndarray, position:int, records:np.ndarray):
+        """Copy records into a ring starting at a write position, wrapping around its end"""
+        start = position % len(array)
+        first = min(len(records), len(array) - start)
+        array[start:start + first] = records[:first]
+        array[:len(records) - first] = records[first:]
+
+    def write(self, timestamp:float, start:float, latency:float, samples:List[Tuple[int, int]],
+              identities:List[Tuple[int, float, str]])->bool:
+        """Write a snapshot, by the sampler process
+
+        Args:
+            timestamp: POSIX timestamp of the snapshot
+            start: time.monotonic() at the start of the snapshot
+            latency: Time taken by the snapshot in seconds
+            samples: (pid, memory usage) of each process sampled
+            identities: (pid, creation time, name) of the processes sampled for the first time
+
+        Returns:
+            False if the snapshot was dropped because the ring is full
+        """
+        if self.__free("snapshots", self.small_capacity) < 1 or \
+                self.__free("samples", self.capacity) < len(samples) or \
+                self.__free("identities", self.small_capacity) < len(identities):
+            self.header["dropped"] = self.header["dropped"] + 1
+            return False
+        snapshot = int(self.header["snapshots_write"])
+        if identities:
+            records = np.array([(snapshot, pid, create_time, name.encode()[:self.IDENTITY["name"].itemsize])
+                                for pid, create_time, name in identities], dtype=self.IDENTITY)
+            self.__put(self.identities, int(self.header["identities_write"]), records)
+            self.header["identities_write"] = self.header["identities_write"] + len(records)
+        if samples:
+            records = np.empty(len(samples), dtype=self.SAMPLE)
+            records["snapshot"] = snapshot
+            records["pid"], records["vms"] = zip(*samples)
+            self.__put(self.samples, int(self.header["samples_write"]), records)
+            self.header["samples_write"] = self.header["samples_write"] + len(records)
+        self.snapshots[snapshot % self.small_capacity] = (timestamp, start, latency, len(samples))
+        self.header["snapshots_write"] = snapshot + 1
+        return True
+
+    @staticmethod
+    def __unread(array:np.ndarray, read:int, write:int)->np.ndarray:
+        """Records between the read and write positions of a ring, a view unless they wrap around its end"""
+        start, end = read % len(array), write % len(array)
+        if write - read == 0:
+            return array[:0]
+        if start < end:
+            return array[start:end]
+        return np.concatenate([array[start:], array[:end]])
+
+    def read_chunk(self)->Tuple[LogChunk, np.ndarray, List[Tuple[str, float]]]:
+        """Read the snapshots written since the last read, by the monitor, and release their space
+
+        The samples of a pid reused by a new process are split into one series per process, in
+        snapshot order.
+
+        Returns:
+            The snapshots as a chunk MemorySnapper.merge_chunk adds, numbered by the sampler
+            process, the snapshot records (time, start, latency, processes) for the overhead
+            statistics and the (name, creation time) of the process of each series of the chunk,
+            None for series of processes that were not identified
+        """
+        positions = {ring: (int(self.header[ring + "_read"]), int(self.header[ring + "_write"]))
+                     for ring in ("snapshots", "samples", "identities")}
+        first_snapshot, last_snapshot = positions["snapshots"]
+        changes = {} # pid -> (first snapshot, identity) of each process with the pid in the chunk
+        for record in self.__unread(self.identities, *positions["identities"]):
+            pid = int(record["pid"])
+            identity = (record["name"].decode(errors="replace"), float(record["create_time"]))
+            previous = self.__identities.get(pid)
+            if identity != previous:
+                changes.setdefault(pid, [(first_snapshot, previous)]).append((int(record["snapshot"]), identity))
+                self.__identities[pid] = identity
+        snapshots = self.__unread(self.snapshots, first_snapshot, last_snapshot)
+        samples = self.__unread(self.samples, *positions["samples"])
+
+        series = []
+        identities = []
+        rows = samples["snapshot"].astype(np.int64)
+        order = np.argsort(samples["pid"], kind="stable")
+        pids = samples["pid"][order]
+        bounds = np.flatnonzero(np.diff(pids)) + 1
+        for run in np.split(order, bounds) if len(order) else []:
+            pid = int(samples["pid"][run[0]])
+            processes = changes.get(pid, [(first_snapshot, self.__identities.get(pid))])
+            #Samples are in snapshot order, cut the run where each process starts
+            cuts = np.searchsorted(rows[run], [snapshot for snapshot, _ in processes[1:]])
+            for part, (_, identity) in zip(np.split(run, cuts), processes):
+                if len(part) == 0:
+                    continue
+                series.append(LogSeries(pid, SnapshotLog.METRIC_VMS, str(pid) if identity is None else identity[0],
+                                        rows[part], samples["vms"][part].astype(np.int64)))
+                identities.append(identity)
+        totals = np.bincount(rows - first_snapshot, weights=samples["vms"],
+                             minlength=last_snapshot - first_snapshot).astype(np.int64)
+        if len(snapshots):
+            series.append(LogSeries(-1, SnapshotLog.METRIC_TOTAL, "",
+                                    np.arange(first_snapshot, last_snapshot), totals))
+            identities.append(None)
+        chunk = LogChunk(first_snapshot, snapshots["time"].copy(), series)
+        snapshots = snapshots.copy()
+
+        for ring, (_, write) in positions.items():
+            self.header[ring + "_read"] = write
+        return chunk, snapshots, identities
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        """Free the shared memory, by the process that created it, once every process has closed it"""
+        self.shm.unlink()
+
+
+def sample_into_ring(ring:SampleRing, sampler, time_interval:float, env_refresh_interval:float, stop,
+                     process_filter:ProcessFilter=None):
+    """Take snapshots into a SampleRing until stop is set, run in the sampler process of a MemoryMonitor
+
+    Args:
+        ring: Ring to write the snapshots to
+        sampler: Sampler used to read process memory, see MemoryMonitor
+        time_interval: Time interval between snapshots in seconds
+        env_refresh_interval: Time interval between refreshing the list of CCS environment
+            processes in seconds
+        stop: multiprocessing.Event set by the monitor to stop the sampler process
+        process_filter: ProcessFilter selecting the processes sampled, see MemoryMonitor
+    """
+    sampler = make_sampler(sampler)
+    own_pid = os.getpid()
+    identified = set() # Pids sampled in the last snapshot written
+    env_pids = None
+    env_refreshed = None
+    deadline = time.monotonic()
+    try:
+        while not stop.is_set():
+            start = time.monotonic()
+            if CCSENV and (env_pids is None or start - env_refreshed >= env_refresh_interval):
+                env_procs = ccs.GetEnvProcs(full_report=True)
+                env_pids = {v["pid"]: k for k, v in env_procs.items() if k != ccs.procName}
+                env_refreshed = start
+            pids = env_pids
+            selected = None if process_filter is None else process_filter.resolve()
+            if selected is not None:
+                pids = selected if env_pids is None else {pid for pid in selected if pid in env_pids}
+            timestamp = time.time()
+            samples = []
+            identities = []
+            for pid, vms in sampler.sample(pids):
+                if pid == own_pid:
+                    continue
+                if pid in sampler.started or pid not in identified:
+                    try:
+                        name = env_pids[pid] if CCSENV else sampler.name(pid)
+                        identities.append((pid, sampler.create_time(pid), name))
+                    except Exception:
+                        continue # The process has exited
+                samples.append((pid, vms))
+            if process_filter is not None:
+                process_filter.forget(pid for pid, _ in sampler.errors)
+            if ring.write(timestamp, start, time.monotonic() - start, samples, identities):
+                identified = {pid for pid, _ in samples}
+            deadline = deadline + time_interval
+            now = time.monotonic()
+            if now >= deadline:
+                missed = int((now - deadline) // time_interval) + 1
+                ring.header["missed"] = ring.header["missed"] + missed
+                deadline = deadline + missed * time_interval
+            stop.wait(deadline - now)
+    finally:
+        sampler.close()
+        ring.close()
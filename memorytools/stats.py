@@ -0,0 +1,159 @@
+import bisect
+import collections
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import psutil as ps
+
+
+class SnapshotStats:
+    """Overhead statistics of taking memory snapshots
+
+    Records the latency of every snapshot in a histogram with 4 logarithmic bins per decade from
+    1 us to 10 s, the number of processes scanned, the errors swallowed while sampling by
+    exception type and the rate snapshots are actually taken at. The resource usage (RSS and
+    CPU) reported is that of the whole process running the snapper. Monitors also record the
+    scheduled snapshots they missed and the interval currently in use.
+
+    Args:
+        requested_interval: Time interval between snapshots that was asked for in seconds, None
+            when snapshots are not taken on a schedule
+    """
+    LATENCY_EDGES = [float(edge) for edge in 10 ** np.arange(-6, 1.01, 0.25)]
+
+    def __init__(self, requested_interval:float=None):
+        self.requested_interval = requested_interval
+        self.interval = requested_interval # Interval in use, longer when backed off to save CPU
+        self.reset()
+
+    def reset(self):
+        """Discard every statistic recorded so far"""
+        self.ticks = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.processes_scanned = 0 # Total over every snapshot
+        self.last_processes_scanned = 0
+        self.errors = collections.Counter() # Exception type name -> count
+        self.missed_ticks = 0 # Scheduled snapshots skipped because the previous one overran
+        self.__latency_counts = [0] * (len(self.LATENCY_EDGES) + 1)
+        self.__first_tick = None
+        self.__last_tick = None
+        self.__process = ps.Process()
+        self.__start_cpu = self.__cpu_time()
+        self.__start_wall = time.monotonic()
+
+    def __cpu_time(self)->float:
+        cpu_times = self.__process.cpu_times()
+        return cpu_times.user + cpu_times.system
+
+    def record(self, start:float, latency:float, processes:int):
+        """Record a snapshot
+
+        Args:
+            start: time.monotonic() at the start of the snapshot
+            latency: Time taken by the snapshot in seconds
+            processes: Number of processes scanned
+        """
+        self.ticks = self.ticks + 1
+        self.total_latency = self.total_latency + latency
+        self.max_latency = max(self.max_latency, latency)
+        self.__latency_counts[bisect.bisect_right(self.LATENCY_EDGES, latency)] += 1
+        self.processes_scanned = self.processes_scanned + processes
+        self.last_processes_scanned = processes
+        if self.__first_tick is None:
+            self.__first_tick = start
+        self.__last_tick = start
+
+    def record_error(self, error:BaseException):
+        """Count an error swallowed while taking a snapshot"""
+        self.errors[type(error).__name__] += 1
+
+    def latency_histogram(self)->Tuple[List[float], List[int]]:
+        """Histogram of snapshot latencies
+
+        Returns:
+            The bin edges in seconds and the counts of each bin, counts[0] is below the first
+            edge and counts[-1] is above the last edge
+        """
+        return list(self.LATENCY_EDGES), list(self.__latency_counts)
+
+    def latency_percentile(self, q:float)->float:
+        """Upper edge of the histogram bin holding the q-th percentile of snapshot latency"""
+        if self.ticks == 0:
+            return float("nan")
+        target = q / 100 * self.ticks
+        cumulative = 0
+        for i, count in enumerate(self.__latency_counts):
+            cumulative = cumulative + count
+            if count and cumulative >= target:
+                return self.LATENCY_EDGES[i] if i < len(self.LATENCY_EDGES) else self.max_latency
+        return self.max_latency
+
+    @property
+    def mean_latency(self)->float:
+        return self.total_latency / self.ticks if self.ticks else float("nan")
+
+    @property
+    def achieved_rate(self)->float:
+        """Snapshots taken per second, measured between the starts of the first and last snapshots"""
+        if self.ticks < 2 or self.__last_tick == self.__first_tick:
+            return float("nan")
+        return (self.ticks - 1) / (self.__last_tick - self.__first_tick)
+
+    @property
+    def requested_rate(self)->float:
+        """Snapshots per second asked for, ignoring the time taken by each snapshot"""
+        if not self.requested_interval:
+            return float("nan")
+        return 1 / self.requested_interval
+
+    @property
+    def rss(self)->int:
+        """Resident set size of the process running the snapper in bytes"""
+        return self.__process.memory_info().rss
+
+    @property
+    def cpu_percent(self)->float:
+        """CPU time used by the process running the snapper as a percentage of the wall time
+        since the statistics were reset"""
+        wall = time.monotonic() - self.__start_wall
+        if wall <= 0:
+            return float("nan")
+        return 100 * (self.__cpu_time() - self.__start_cpu) / wall
+
+    def summary(self)->Dict:
+        """Statistics as a dictionary"""
+        return {
+            "ticks": self.ticks,
+            "mean_latency": self.mean_latency,
+            "p50_latency": self.latency_percentile(50),
+            "p99_latency": self.latency_percentile(99),
+            "max_latency": self.max_latency,
+            "processes_scanned": self.processes_scanned,
+            "last_processes_scanned": self.last_processes_scanned,
+            "errors": dict(self.errors),
+            "requested_rate": self.requested_rate,
+            "achieved_rate": self.achieved_rate,
+            "interval": self.interval,
+            "missed_ticks": self.missed_ticks,
+            "rss": self.rss,
+            "cpu_percent": self.cpu_percent,
+        }
+
+    def __str__(self)->str:
+        summary = self.summary()
+        lines = [
+            f"Snapshots:          {summary['ticks']}",
+            f"Latency mean:       {summary['mean_latency'] * 1e3:.3f} ms",
+            f"Latency p50/p99:    <= {summary['p50_latency'] * 1e3:.3f} ms / <= {summary['p99_latency'] * 1e3:.3f} ms",
+            f"Latency max:        {summary['max_latency'] * 1e3:.3f} ms",
+            f"Processes scanned:  {summary['last_processes_scanned']} last, {summary['processes_scanned']} total",
+            f"Errors:             {summary['errors'] or 'none'}",
+            f"Rate:               {summary['achieved_rate']:.1f}/s achieved, {summary['requested_rate']:.1f}/s requested",
+            f"Interval:           {(summary['interval'] or float('nan')) * 1e3:.3f} ms",
+            f"Missed snapshots:   {summary['missed_ticks']}",
+            f"Monitor RSS:        {summary['rss'] / 2**20:.1f} MiB",
+            f"Monitor CPU:        {summary['cpu_percent']:.1f} %",
+        ]
+        return "\n".join(lines)
@@ -0,0 +1,277 @@
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+import logging
+import sys
+import time
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+from . import memoryanalysis
+from .memoryanalysis import DETECTORS, MemoryAnalysis, _SharedMemoryData, _SharedProcData
+
+try:
+    import ccs
+    CCSENV=True
+except ImportError:
+    CCSENV=False
+
+
+#Parameters changing how the data is split and resampled, configurations sharing them share the
+#prepared series
+PREPARATION_PARAMETERS = ["RESAMPLE_MIN_WIN", "MAX_TIME_DIFF", "WIN_MIN_NUM_POINTS_RESAMPLE"]
+#Parameters only read by the detectors
+DETECTION_PARAMETERS = ["WIN_MIN_NUM_POINTS_DETECT", "R_SQR_MIN", "CRITICAL_TIME_MAX", "CRITICAL_MEMORY_USAGE",
+                        "CPD_THRESHOLD", "CPD_METHOD", "CPD_MODEL", "CPD_TIME_BUDGET"]
+
+
+class LabeledDataset:
+    """Memory data of a set of processes with the processes known to leak
+
+    Args:
+        name: Name of the dataset, used in the results
+        procs: pid -> (name, times, memory usage) of every process
+        leaking: Pids of the processes that leak
+    """
+
+    def __init__(self, name:str, procs:Dict[int, Tuple[str, np.ndarray, np.ndarray]], leaking:Iterable[int]):
+        self.name = name
+        self.procs = {pid: (proc_name, np.asarray(times, dtype=float), np.asarray(vmss, dtype=float))
+                      for pid, (proc_name, times, vmss) in procs.items()}
+        self.leaking = set(leaking)
+
+    @classmethod
+    def from_memory_data(cls, name:str, memory_data, leaking:Iterable[int]=(),
+                         leaking_names:Iterable[str]=())->"LabeledDataset":
+        """Label a MemorySnapper, or other mapping of pids to memory data
+
+        Args:
+            name: Name of the dataset
+            memory_data: MemorySnapper to copy the data of every process from
+            leaking: Pids of the processes that leak
+            leaking_names: Names of the processes that leak, every process with one of the names
+        """
+        leaking_names = set(leaking_names)
+        procs = {}
+        leaking = set(leaking)
+        for pid in memory_data.pids:
+            proc = memory_data[pid]
+            procs[pid] = (proc.name, proc.times, proc.vmss)
+            if proc.name in leaking_names:
+                leaking.add(pid)
+        return cls(name, procs, leaking)
+
+    def memory_data(self)->_SharedMemoryData:
+        """The processes in the form MemoryAnalysis reads"""
+        return _SharedMemoryData({pid: _SharedProcData(pid, proc_name, times, vmss)
+                                  for pid, (proc_name, times, vmss) in self.procs.items()})
+
+
+@contextlib.contextmanager
+def analysis_parameters(parameters:Dict[str, object]):
+    """Set module globals of memoryanalysis for the duration of a with block
+
+    Example usage::
+        >>> with analysis_parameters({"R_SQR_MIN": 0.8}):
+        ...     mem_snap.detect_leaks("LBR")
+    """
+    _check_parameters(parameters)
+    previous = {name: getattr(memoryanalysis, name) for name in parameters}
+    try:
+        for name, value in parameters.items():
+            setattr(memoryanalysis, name, value)
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(memoryanalysis, name, value)
+
+
+def _check_parameters(parameters:Dict[str, object]):
+    unknown = set(parameters) - set(PREPARATION_PARAMETERS) - set(DETECTION_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {sorted(unknown)}")
+
+
+def parameter_grid(grid:Dict[str, Iterable])->List[Dict[str, object]]:
+    """Every combination of the values of a set of parameters
+
+    Example usage::
+        >>> parameter_grid({"R_SQR_MIN": [0.8, 0.9], "CRITICAL_TIME_MAX": [3600]})
+        [{'R_SQR_MIN': 0.8, 'CRITICAL_TIME_MAX': 3600}, {'R_SQR_MIN': 0.9, 'CRITICAL_TIME_MAX': 3600}]
+    """
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*(list(grid[name]) for name in names))]
+
+
+class ParameterSweep:
+    """Evaluate leak detectors over labeled datasets for every configuration of a parameter grid
+
+    Configurations are grouped by their PREPARATION_PARAMETERS. For each dataset and group the
+    data is split and resampled once, and every detector is then run with every configuration of
+    the group over the same prepared series. The change points LBRCPD searches for are also
+    found once per segment for each setting of the change point parameters, so the grid costs
+    little more than the regressions themselves. Groups of each dataset are run in parallel when workers is above 1.
+
+    Args:
+        datasets: Labeled datasets to evaluate over
+        algorithms: Names of the detectors in DETECTORS to evaluate, default is every detector
+        workers: Number of worker processes, default is None which runs in this process
+    """
+
+    def __init__(self, datasets:List[LabeledDataset], algorithms:List[str]=None, workers:int=None):
+        self.datasets = datasets
+        self.algorithms = sorted(DETECTORS) if algorithms is None else list(algorithms)
+        for algo in self.algorithms:
+            if algo not in DETECTORS:
+                raise NotImplementedError(algo)
+        self.workers = workers
+
+    def logger(self):
+        if CCSENV:
+            return ccs.logger
+        else:
+            return logging.getLogger(__name__)
+
+    def run(self, configurations:List[Dict[str, object]])->List[dict]:
+        """Run every detector with every configuration over every dataset
+
+        Args:
+            configurations: Parameter values of each configuration, as from parameter_grid
+
+        Returns:
+            One result per dataset, configuration and algorithm, with the keys "dataset",
+            "configuration", "algorithm", "tp", "fp", "fn", "tn", "prepare_seconds" (the time to
+            prepare the dataset with the configuration's parameters, shared with the other
+            configurations of its group) and "detect_seconds"
+        """
+        groups = {}
+        for configuration in configurations:
+            _check_parameters(configuration)
+            preparation = tuple((name, configuration[name]) for name in PREPARATION_PARAMETERS
+                                if name in configuration)
+            groups.setdefault(preparation, []).append(configuration)
+        parallel = self.workers is not None and self.workers > 1
+        #With fewer groups than workers, groups are split so every worker is used, each part
+        #preparing the data again
+        splits = max(1, -(-self.workers // (len(groups) * len(self.datasets)))) if parallel and groups else 1
+        tasks = [(index, dict(preparation), list(part)) for index in range(len(self.datasets))
+                 for preparation, group in groups.items()
+                 for part in np.array_split(np.array(group, dtype=object), min(splits, len(group)))]
+        self.logger().info(f"Sweeping {len(configurations)} configurations of {len(self.algorithms)} "
+                           f"algorithms over {len(self.datasets)} datasets in {len(tasks)} tasks")
+
+        if parallel and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=_sweep_worker_init,
+                                     initargs=(self.datasets, self.logger().getEffectiveLevel())) as pool:
+                futures = [pool.submit(_sweep_worker, index, preparation, group, self.algorithms)
+                           for index, preparation, group in tasks]
+                chunks = [future.result() for future in futures]
+        else:
+            chunks = [_sweep_dataset(self.datasets[index], preparation, group, self.algorithms)
+                      for index, preparation, group in tasks]
+        return [result for chunk in chunks for result in chunk]
+
+
+def summarise(results:List[dict])->List[dict]:
+    """Combine the results of every dataset for each configuration and algorithm
+
+    Returns:
+        One summary per configuration and algorithm, in the order of the results, with the summed
+        counts and times and the "precision", "recall" and "f1" over every dataset. Precision is
+        NaN when nothing was detected and recall is NaN when nothing leaks
+    """
+    summaries = {}
+    for result in results:
+        key = (tuple(sorted(result["configuration"].items(), key=lambda item: item[0])), result["algorithm"])
+        summary = summaries.setdefault(key, {"configuration": result["configuration"], "algorithm": result["algorithm"],
+                                             "tp": 0, "fp": 0, "fn": 0, "tn": 0,
+                                             "prepare_seconds": 0.0, "detect_seconds": 0.0})
+        for field in ("tp", "fp", "fn", "tn", "prepare_seconds", "detect_seconds"):
+            summary[field] = summary[field] + result[field]
+    for summary in summaries.values():
+        tp, fp, fn = summary["tp"], summary["fp"], summary["fn"]
+        summary["precision"] = tp / (tp + fp) if tp + fp else float("nan")
+        summary["recall"] = tp / (tp + fn) if tp + fn else float("nan")
+        summary["f1"] = 2 * tp / (2 * tp + fp + fn) if tp + fp + fn else float("nan")
+    return list(summaries.values())
+
+
+class _SweepAnalysis(MemoryAnalysis):
+    """MemoryAnalysis keeping the change points found in each resampled segment
+
+    Change points only depend on the segment and the change point parameters, so configurations
+    differing in any other parameter share them. Every prepared series is kept for the whole
+    task, so the addresses of the arrays of a segment identify it.
+    """
+
+    def __init__(self, memory_data):
+        super().__init__(memory_data, cache_max_bytes=sys.maxsize)
+        self.__change_points = {}
+        self.change_points_seconds = {} # Change point settings -> seconds spent finding change points with them
+        self.settings_used = set() # Change point settings looked up since last cleared
+
+    def change_points_detection(self, times, values, model="l2", method="pelt", time_budget:float=None)->List[int]:
+        settings = (model, method, time_budget, memoryanalysis.CPD_THRESHOLD)
+        self.settings_used.add(settings)
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        key = (times.__array_interface__["data"][0], values.__array_interface__["data"][0], len(values), settings)
+        if key not in self.__change_points:
+            start = time.perf_counter()
+            self.__change_points[key] = super().change_points_detection(times, values, model=model, method=method,
+                                                                        time_budget=time_budget)
+            self.change_points_seconds[settings] = self.change_points_seconds.get(settings, 0.0) + \
+                time.perf_counter() - start
+        return self.__change_points[key]
+
+
+def _sweep_dataset(dataset:LabeledDataset, preparation:Dict[str, object], configurations:List[Dict[str, object]],
+                   algorithms:List[str])->List[dict]:
+    """Prepare a dataset once then run every algorithm with every configuration over it
+
+    The time spent finding change points is counted as preparation, with the settings they were
+    found with, so prepare_seconds + detect_seconds is the time a configuration takes alone.
+    """
+    analysis = _SweepAnalysis(dataset.memory_data())
+    pids = list(dataset.procs)
+    with analysis_parameters(preparation):
+        start = time.perf_counter()
+        for pid in pids:
+            analysis.prepare(pid).segments
+        prepare_seconds = time.perf_counter() - start
+
+    results = []
+    for configuration in configurations:
+        with analysis_parameters(configuration):
+            for algo in algorithms:
+                analysis.settings_used.clear()
+                searching = sum(analysis.change_points_seconds.values())
+                start = time.perf_counter()
+                _, detected = analysis.run_detector(algo, pids)
+                detect_seconds = time.perf_counter() - start
+                detect_seconds = detect_seconds - (sum(analysis.change_points_seconds.values()) - searching)
+                change_points_seconds = sum(analysis.change_points_seconds[settings]
+                                            for settings in analysis.settings_used)
+                detected = set(detected)
+                results.append({"dataset": dataset.name, "configuration": configuration, "algorithm": algo,
+                                "tp": len(detected & dataset.leaking), "fp": len(detected - dataset.leaking),
+                                "fn": len(dataset.leaking - detected),
+                                "tn": len(dataset.procs) - len(detected | dataset.leaking),
+                                "prepare_seconds": prepare_seconds + change_points_seconds,
+                                "detect_seconds": detect_seconds})
+    return results
+
+
+_worker_datasets = None # Datasets of a sweep worker process, sent once when the worker starts
+
+
+def _sweep_worker_init(datasets:List[LabeledDataset], level:int):
+    global _worker_datasets
+    _worker_datasets = datasets
+    logging.getLogger(memoryanalysis.__name__).setLevel(level)
+
+
+def _sweep_worker(index:int, preparation:Dict[str, object], configurations:List[Dict[str, object]],
+                  algorithms:List[str])->List[dict]:
+    return _sweep_dataset(_worker_datasets[index], preparation, configurations, algorithms)
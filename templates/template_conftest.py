@@ -5,7 +5,8 @@ from memorytools.memorymonitor import MemoryMonitor
 def mem_monitor(config):
 
     if(config.getoption('--memoryleaks')):
-        mem_monitor = MemoryMonitor(data_file="memory_data.csv")
+        #Sample in a separate process so the monitor does not slow down the tests it measures
+        mem_monitor = MemoryMonitor(data_file="memory_data.csv", out_of_process=True)
         mem_monitor.start_monitoring()
 
     yield mem_monitor
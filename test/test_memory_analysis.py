@@ -1,6 +1,8 @@
 import numpy as np
 import pytest
+import scipy.stats
 
+from memorytools import memoryanalysis
 from memorytools.memoryanalysis import MemoryAnalysis
 
 
@@ -84,3 +86,334 @@ def test_change_points_detection_dataset_with_random_values():
     ys = np.random.randint(0, 100, size=1000)
     expected_result = []
     assert list(memory_analysis.change_points_detection(ts, ys)) == expected_result
+
+@pytest.mark.parametrize("method", ["binseg", "decimate"])
+def test_change_points_detection_values_only(method):
+    memory_analysis = MemoryAnalysis()
+    assert memory_analysis.change_points_detection([], [], method=method) == []
+    assert memory_analysis.change_points_detection(range(5), [10] * 5, model="linear", method=method) == []
+    ys = [10, 20, 30, 40, 50, 11, 19, 31, 39, 50]
+    assert memory_analysis.change_points_detection(range(10), ys, model="linear", method=method) == [5]
+    # Flat then leaking, long enough to be decimated
+    rng = np.random.default_rng(0)
+    n = 5 * memoryanalysis.CPD_MAX_POINTS
+    ys = 1e8 + rng.normal(0, 1e5, n)
+    ys[12000:] += np.arange(n - 12000) * 2e3
+    change_points = memory_analysis.change_points_detection(np.arange(n) * 0.5, ys, model="linear", method=method)
+    assert len(change_points) == 1
+    assert abs(change_points[0] - 12000) < 50
+    steps = np.where(np.arange(n) < 10000, 1e8, 2e8) + rng.normal(0, 1e5, n)
+    assert memory_analysis.change_points_detection(np.arange(n), steps, model="l2", method=method) == [10000]
+
+def test_change_points_detection_time_budget():
+    memory_analysis = MemoryAnalysis()
+    ys = np.repeat(np.arange(50) * 1e6, 100) # 49 steps
+    assert len(memory_analysis.change_points_detection(np.arange(len(ys)), ys, method="binseg")) == 49
+    # Stops after the first change point, which is the largest reduction in cost
+    assert memory_analysis.change_points_detection(np.arange(len(ys)), ys, method="binseg", time_budget=0) == [2500]
+
+@pytest.mark.parametrize("method", ["binseg", "decimate"])
+def test_detect_leaks_lbrcpd_values_only(method, monkeypatch):
+    monkeypatch.setattr(memoryanalysis, "CPD_METHOD", method)
+    monkeypatch.setattr(memoryanalysis, "CPD_MODEL", "linear")
+    memory_analysis = MemoryAnalysis(_synthetic_memory_data())
+    names, pids = memory_analysis.detect_leaks("LBRCPD")
+    assert sorted(pids) == [102, 105, 108, 111]
+
+@pytest.mark.parametrize("ys", [np.arange(100) * 4096.0 + np.random.default_rng(0).normal(0, 1e4, 100),
+                                np.random.default_rng(1).integers(1e6, 2e6, 100).astype(float),
+                                np.where(np.arange(100) > 50, 9e6, 8e6)])
+def test_backward_regression_matches_linregress(ys):
+    memory_analysis = MemoryAnalysis()
+    ts = 1.7e9 + np.arange(len(ys)) * 0.5
+    windows, ms, cs, r2s = memory_analysis.backward_regression(ts, ys)
+    assert windows[0] == memoryanalysis.WIN_MIN_NUM_POINTS_DETECT
+    assert windows[-1] == len(ys)
+    for window, m, c, r2 in zip(windows, ms, cs, r2s):
+        expected = scipy.stats.linregress(ts[-window:], ys[-window:])
+        assert m == pytest.approx(expected.slope, rel=1e-6, abs=1e-6)
+        assert c == pytest.approx(expected.intercept, rel=1e-6)
+        assert r2 == pytest.approx(np.nan_to_num(expected.rvalue**2), abs=1e-6)
+
+def test_backward_regression_constant_dataset():
+    memory_analysis = MemoryAnalysis()
+    ts = np.arange(50) * 0.5
+    ys = np.full(50, 10.0)
+    windows, ms, cs, r2s = memory_analysis.backward_regression(ts, ys)
+    assert np.all(ms == 0)
+    assert np.all(r2s == 0)
+    assert np.all(memory_analysis.time_to_critical(ms, cs) == np.inf)
+
+def test_backward_regression_short_dataset():
+    memory_analysis = MemoryAnalysis()
+    windows, ms, cs, r2s = memory_analysis.backward_regression([0, 1, 2], [1, 2, 3])
+    assert len(windows) == len(ms) == len(cs) == len(r2s) == 0
+
+class _ProcData:
+    def __init__(self, pid, name, times, vmss):
+        self.pid = pid
+        self.name = name
+        self.times = times
+        self.vmss = vmss
+
+class _MemoryData:
+    def __init__(self, procs):
+        self.procs = {proc.pid: proc for proc in procs}
+
+    @property
+    def pids(self):
+        return list(self.procs)
+
+    def __getitem__(self, pid):
+        return self.procs[pid]
+
+def _synthetic_memory_data(n_procs=12, n_points=200):
+    rng = np.random.default_rng(2)
+    ts = 1.7e9 + np.arange(n_points) * 0.1
+    procs = []
+    for pid in range(100, 100 + n_procs):
+        if pid % 3 == 0:
+            vmss = 1e8 + np.arange(n_points) * 1e5 + rng.normal(0, 1e3, n_points) # Leaking
+        else:
+            vmss = 1e8 + rng.normal(0, 1e5, n_points)
+        procs.append(_ProcData(pid, f"proc{pid % 4}", ts, vmss))
+    return _MemoryData(procs)
+
+@pytest.mark.parametrize("algo", ["linefit", "LBR"])
+def test_detect_leaks_parallel_matches_serial(algo, caplog):
+    memory_analysis = MemoryAnalysis(_synthetic_memory_data())
+    names, pids = memory_analysis.detect_leaks(algo)
+    with caplog.at_level("INFO", logger=memoryanalysis.__name__):
+        parallel_names, parallel_pids = memory_analysis.detect_leaks(algo, workers=2)
+    assert (parallel_names, parallel_pids) == (names, pids)
+    assert pids == sorted(pids) and names == sorted(names)
+    if algo == "LBR":
+        assert set(pids) == {102, 105, 108, 111}
+        # Log records of the workers are replayed in pid order
+        processing = [r.getMessage() for r in caplog.records if r.getMessage().startswith("Processing")]
+        assert processing == [f"Processing proc{pid % 4}-{pid}" for pid in range(100, 112)]
+
+def test_backward_regression_matrix_matches_backward_regression():
+    memory_analysis = MemoryAnalysis()
+    rng = np.random.default_rng(3)
+    grid = 1.7e9 + np.arange(200) * 0.5
+    matrix = np.vstack([np.arange(200) * 1e4 + rng.normal(0, 1e5, 200),
+                        rng.normal(0, 1e5, 200),
+                        np.full(200, np.nan)])
+    matrix[0, :5] = np.nan
+    matrix[1, 50:60] = np.nan # Gap, the runs either side are separate series
+    windows, ms, cs, r2s = memory_analysis.backward_regression_matrix(grid, matrix)
+    assert windows.shape == ms.shape == cs.shape == r2s.shape == matrix.shape
+    assert not np.any(windows[2])
+    for row, start, end in [(0, 5, 200), (1, 0, 50), (1, 60, 200)]:
+        expected = memory_analysis.backward_regression(grid[start:end], matrix[row, start:end])
+        n = len(expected[0])
+        for actual, values in zip((windows, ms, cs, r2s), expected):
+            assert np.allclose(actual[row, start:start + n][::-1], values, rtol=1e-7, atol=1e-9)
+        assert np.all(windows[row, start + n:end] == 0)
+
+def test_detect_leaks_batched_matches_lbr():
+    memory_analysis = MemoryAnalysis(_synthetic_memory_data())
+    names, pids = memory_analysis.detect_leaks("LBR")
+    batched_names, batched_pids = memory_analysis.detect_leaks("LBRBATCH")
+    assert sorted(batched_pids) == sorted(pids)
+    assert sorted(batched_names) == sorted(names)
+
+def test_resample_matrix_keeps_segment_grids():
+    # Processes starting at times off each other's grid, one with a gap, have the windows of LBR
+    rng = np.random.default_rng(5)
+    procs = []
+    for pid, offset in [(100, 0.0), (101, 0.13), (102, 7.31)]:
+        ts = 1.7e9 + offset + np.cumsum(rng.uniform(0.05, 0.15, 300))
+        ts[150:] += 5.0 # Gap
+        vmss = 1e8 + np.arange(300) * 1e4 + rng.normal(0, 1e5, 300)
+        procs.append(_ProcData(pid, "proc", ts, vmss))
+    memory_analysis = MemoryAnalysis(_MemoryData(procs))
+    times, matrix = memory_analysis.resample_matrix([100, 101, 102])
+    windows, ms, cs, r2s = memory_analysis.backward_regression_matrix(times, matrix)
+    for row, pid in enumerate([100, 101, 102]):
+        column = 0
+        for ts, ys in memory_analysis.prepare(pid).segments:
+            assert np.array_equal(times[row, column:column + len(ts)], ts)
+            expected = memory_analysis.backward_regression(ts, ys)
+            n = len(expected[0])
+            for actual, values in zip((windows, ms, cs, r2s), expected):
+                assert np.allclose(actual[row, column:column + n][::-1], values, rtol=1e-7, atol=1e-9)
+            column = column + len(ts) + 1
+    assert memory_analysis.detect_leaks("LBRBATCH") == memory_analysis.detect_leaks("LBR")
+
+def test_backward_regression_windows_matches_backward_regression():
+    memory_analysis = MemoryAnalysis()
+    rng = np.random.default_rng(7)
+    ts = 1.7e9 + np.arange(300) * 0.5
+    ys = 1e8 + np.arange(300) * 1e3 + rng.normal(0, 1e5, 300)
+    windows, ms, cs, r2s = memory_analysis.backward_regression(ts, ys)
+    candidates = [300, 20, 157, 21, 157]
+    actual = memory_analysis.backward_regression_windows(ts, ys, candidates)
+    selected = np.array(candidates) - windows[0]
+    for values, expected in zip(actual, (ms, cs, r2s)):
+        assert np.allclose(values, expected[selected], rtol=1e-9)
+
+def test_lbrcpd_detects_growth_starting_at_a_late_change_point():
+    # Memory drops then grows over the last 20 resampled points only, as in a sawtooth
+    rng = np.random.default_rng(0)
+    ts = 1.7e9 + np.arange(208) * 0.1
+    vmss = 1.5e8 + rng.normal(0, 1e4, 208)
+    vmss[106:] = 1e8 + np.arange(102) * 1e6 + rng.normal(0, 1e4, 102)
+    memory_analysis = MemoryAnalysis(_MemoryData([_ProcData(100, "proc", ts, vmss)]))
+    assert memory_analysis.detect_leaks("LBR")[1] == [100]
+    assert memory_analysis.detect_leaks("LBRCPD")[1] == [100]
+
+def test_online_leak_detector():
+    from memorytools.online import OnlineLeakDetector
+    memory_data = _synthetic_memory_data(n_points=400)
+    alerts = []
+    detector = OnlineLeakDetector(callback=alerts.append, max_window=100)
+    ts = memory_data[100].times
+    for i, t in enumerate(ts):
+        detector.update(t, [(pid, memory_data[pid].vmss[i]) for pid in memory_data.pids],
+                        lambda pid: memory_data[pid].name)
+    # Each leaking process is reported once, as soon as the smallest window is full
+    assert sorted(alert.pid for alert in alerts) == [102, 105, 108, 111]
+    assert detector.alerts == alerts
+    first = alerts[0]
+    assert first.name == memory_data[first.pid].name
+    assert first.window == memoryanalysis.WIN_MIN_NUM_POINTS_DETECT
+    assert first.gradient == pytest.approx(1e6, rel=0.01) # 1e5 per 0.1s sample
+    assert first.time - ts[0] < (memoryanalysis.WIN_MIN_NUM_POINTS_DETECT + 1) * memoryanalysis.RESAMPLE_MIN_WIN
+
+def test_online_leak_detector_reads_thresholds(monkeypatch):
+    from memorytools.online import OnlineLeakDetector
+    memory_data = _synthetic_memory_data(n_points=400)
+    monkeypatch.setattr(memoryanalysis, "R_SQR_MIN", 1.01) # No fit can meet it
+    detector = OnlineLeakDetector(max_window=100)
+    for i, t in enumerate(memory_data[100].times):
+        detector.update(t, [(pid, memory_data[pid].vmss[i]) for pid in memory_data.pids])
+    assert detector.alerts == []
+
+def test_online_leak_detector_matches_backward_regression():
+    from memorytools.online import _OnlineSeries
+    rng = np.random.default_rng(4)
+    sizes = np.array([20, 40, 80, 100])
+    series = _OnlineSeries(sizes, 0.5)
+    ts = 1.7e9 + np.cumsum(rng.uniform(0.05, 0.15, 3000))
+    ys = 1e8 + np.arange(3000) * 1e3 + rng.normal(0, 1e5, 3000)
+    for t, y in zip(ts, ys):
+        series.add(t, y)
+    grid = ts[0] + np.arange(series.points) * 0.5
+    resampled = np.interp(grid, ts, ys)
+    windows, ms, r2s, t_crits = series.regress()
+    assert list(windows) == list(sizes)
+    memory_analysis = MemoryAnalysis()
+    for window, m, r2 in zip(windows, ms, r2s):
+        _, expected_ms, _, expected_r2s = memory_analysis.backward_regression(grid[-window:], resampled[-window:])
+        assert m == pytest.approx(expected_ms[-1], rel=1e-6)
+        assert r2 == pytest.approx(expected_r2s[-1], abs=1e-6)
+
+def test_prepared_series_shared_between_detectors(monkeypatch):
+    memory_data = _synthetic_memory_data()
+    memory_analysis = MemoryAnalysis(memory_data)
+    resampled = []
+    resample_data = memory_analysis.resample_data
+    monkeypatch.setattr(memory_analysis, "resample_data",
+                        lambda ts, ys: resampled.append(len(ts)) or resample_data(ts, ys))
+    memory_analysis.prepare(100).segments # Resampling is deferred until a detector needs it
+    _, pids = memory_analysis.detect_leaks("LBR")
+    _, cpd_pids = memory_analysis.detect_leaks("LBRCPD")
+    assert sorted(pids) == sorted(cpd_pids) == [102, 105, 108, 111]
+    assert len(resampled) == len(memory_data.pids)
+    assert memory_analysis.prepare(100) is memory_analysis.prepare(100)
+    # New samples invalidate the prepared series of the process
+    proc = memory_data[100]
+    proc.times = np.append(proc.times, proc.times[-1] + np.arange(1, 11) * 0.1)
+    proc.vmss = np.append(proc.vmss, np.full(10, proc.vmss[-1]))
+    series = memory_analysis.prepare(100)
+    assert len(series.times) == len(proc.times)
+    assert len(series.segments[0][0]) > len(memory_analysis.prepare(101).segments[0][0])
+
+def test_register_detector(monkeypatch):
+    monkeypatch.setattr(memoryanalysis, "DETECTORS", dict(memoryanalysis.DETECTORS))
+
+    @memoryanalysis.register_detector("growth")
+    class GrowthDetector(memoryanalysis.LeakDetector):
+        def detect_series(self, series):
+            if len(series.segments) == 0:
+                return None
+            return series.vmss[-1] - series.vmss[0] > 1e7
+
+    memory_analysis = MemoryAnalysis(_synthetic_memory_data())
+    names, pids = memory_analysis.detect_leaks("growth")
+    assert sorted(pids) == [102, 105, 108, 111]
+    assert sorted(memory_analysis.detect_leaks("growth", workers=2)[1]) == sorted(pids)
+    with pytest.raises(NotImplementedError):
+        memory_analysis.detect_leaks("unknown")
+
+def test_prepared_series_extend_matches_prepare():
+    from memorytools.memoryanalysis import PreparedSeries
+    memory_analysis = MemoryAnalysis()
+    rng = np.random.default_rng(5)
+    steps = rng.uniform(0.05, 0.15, 2000)
+    steps[[300, 305, 1200]] = 2.0 # Gaps, one leaving a part too short to resample
+    ts = 1.7e9 + np.cumsum(steps)
+    ys = 1e8 + np.cumsum(rng.normal(0, 1e4, 2000))
+    expected = PreparedSeries(1, "proc", ts, ys, memory_analysis.resample_data)
+    series = PreparedSeries(1, "proc", ts[:3], ys[:3], memory_analysis.resample_data)
+    series.segments
+    for start, end in [(3, 12), (12, 300), (300, 302), (302, 700), (700, 1200), (1200, 1201), (1201, 2000)]:
+        series.extend(ts[start:end], ys[start:end])
+    assert list(series.bounds) == list(expected.bounds) == [0, 300, 305, 1200, 2000]
+    assert len(series.segments) == len(expected.segments) == 3
+    assert series.unable_to_resample == expected.unable_to_resample == 1
+    for (actual_ts, actual_ys), (expected_ts, expected_ys) in zip(series.segments, expected.segments):
+        assert np.array_equal(actual_ts, expected_ts)
+        assert np.array_equal(actual_ys, expected_ys)
+
+def test_prepared_series_cache():
+    memory_data = _synthetic_memory_data()
+    memory_analysis = MemoryAnalysis(memory_data)
+    memory_analysis.detect_leaks("LBR")
+    series = memory_analysis.prepare(100)
+    proc = memory_data[100]
+    proc.times = np.append(proc.times, proc.times[-1] + np.arange(1, 11) * 0.1)
+    proc.vmss = np.append(proc.vmss, np.full(10, proc.vmss[-1]))
+    assert memory_analysis.prepare(100) is series # Extended in place
+    assert len(series.times) == 210
+    # Samples discarded from the start, as by a retention policy
+    proc.times = proc.times[20:]
+    proc.vmss = proc.vmss[20:]
+    assert memory_analysis.prepare(100) is not series
+    assert len(memory_analysis.prepare(100).times) == 190
+    # The least recently used series are discarded first
+    memory_analysis.cache_max_bytes = 4 * series.nbytes
+    memory_analysis.detect_leaks("LBR", pids=[111, 110, 109, 108, 107, 106])
+    assert memory_analysis.cache_nbytes <= memory_analysis.cache_max_bytes
+    assert memory_analysis.prepare(106) is memory_analysis.prepare(106)
+    memory_analysis.cache_max_bytes = 0
+    memory_analysis.detect_leaks("LBR", pids=[100])
+    assert memory_analysis.cache_nbytes == 0
+
+def test_parameter_sweep():
+    from memorytools.sweep import LabeledDataset, ParameterSweep, analysis_parameters, parameter_grid, summarise
+    memory_data = _synthetic_memory_data()
+    dataset = LabeledDataset.from_memory_data("synthetic", memory_data, leaking=[102, 105, 108, 111])
+    configurations = parameter_grid({"RESAMPLE_MIN_WIN": [0.5, 1.0], "R_SQR_MIN": [0.9, 1.1]})
+    assert len(configurations) == 4
+    results = ParameterSweep([dataset], ["LBR", "LBRCPD"]).run(configurations)
+    assert len(results) == 8
+    for summary in summarise(results):
+        # No window has an R^2 above 1
+        expected = (4, 0, 0) if summary["configuration"]["R_SQR_MIN"] < 1 else (0, 0, 4)
+        assert (summary["tp"], summary["fp"], summary["fn"]) == expected
+        assert summary["tn"] == 8
+    # Every configuration gives the same result as setting the parameters by hand
+    for result in results:
+        with analysis_parameters(result["configuration"]):
+            _, pids = MemoryAnalysis(memory_data).detect_leaks(result["algorithm"])
+        assert result["tp"] == len(set(pids) & dataset.leaking)
+    assert memoryanalysis.R_SQR_MIN == 0.9 and memoryanalysis.RESAMPLE_MIN_WIN == 0.5
+    def counts(results):
+        return [(str(result["configuration"]), result["algorithm"], result["tp"], result["fp"]) for result in results]
+    parallel = ParameterSweep([dataset], ["LBR", "LBRCPD"], workers=2).run(configurations)
+    assert counts(parallel) == counts(results)
+    with pytest.raises(ValueError):
+        ParameterSweep([dataset]).run([{"UNKNOWN": 1}])
@@ -1,17 +1,29 @@
 from ast import Tuple
+import asyncio
 import csv
 import datetime
 import os
+import pickle
 import sys
+import threading
 import time
 from matplotlib import pyplot as plt
 import numpy as np
+import psutil as ps
 import pytest
 
 from memorytools import memoryanalysis
 sys.path.append("..")
 import requests
+from memorytools.asyncmonitor import AsyncMemoryMonitor
+from memorytools import filters
+from memorytools.filters import ProcessFilter
 from memorytools.memorymonitor import MemorySnapper, MemoryMonitor
+from memorytools.memorystore import LogChunk, RetentionPolicy, SnapshotLog
+from memorytools.online import OnlineLeakDetector
+from memorytools.remote import MemoryAgent, SnapshotAggregator
+from memorytools.samplers import ProcfsSampler, PsutilSampler
+from memorytools.shmring import SampleRing
 import subprocess
 
 
@@ -174,13 +186,666 @@ class TestMemoryRecording():
         assert mem_snap[1001001001][datetime.datetime(2022, 1, 1, 0, 1)] == 150
         assert mem_snap[2002002002][datetime.datetime(2022, 1, 1, 0, 2)] == 200
 
+
+    def test_proc_mem_data_columns(self):
+        proc = MemorySnapper.ProcMemData(1001001001, name="Process 1")
+        start = datetime.datetime(2022, 1, 1, 0, 0)
+        for i in range(100):
+            proc[start + datetime.timedelta(seconds=i)] = 100 + i
+
+        # Columns are numpy views onto the stored samples
+        assert isinstance(proc.times, np.ndarray) and proc.times.dtype == np.float64
+        assert isinstance(proc.vmss, np.ndarray) and proc.vmss.dtype == np.int64
+        assert len(proc.times) == len(proc.vmss) == 100
+        assert proc.datetimes[0] == start
+        assert proc[start + datetime.timedelta(seconds=5)] == 105
+
+        # Writing to an existing time overwrites the sample rather than adding one
+        proc[start + datetime.timedelta(seconds=5)] = 1
+        assert proc[start + datetime.timedelta(seconds=5)] == 1
+        assert len(proc.vmss) == 100
+        with pytest.raises(KeyError):
+            proc[start - datetime.timedelta(seconds=1)]
+
+    def test_shared_snapshot_axis(self):
+        mem_snap = MemorySnapper()
+        mem_snap.take_memory_snapshot()
+        mem_snap.take_memory_snapshot()
+
+        # Each snapshot time is recorded once and shared by every process sampled in it
+        assert len(mem_snap.snapshot_times) == 2
+        assert len(mem_snap.totals) == 2
+        for pid in mem_snap.pids:
+            assert np.all(np.isin(mem_snap[pid].times, mem_snap.snapshot_times))
+
+        times, pids, matrix = mem_snap.memory_matrix()
+        assert matrix.shape == (len(pids), 2)
+        for row, pid in enumerate(pids):
+            assert np.array_equal(matrix[row][~np.isnan(matrix[row])], mem_snap[pid].vmss)
+
+        # Saving and loading keeps the processes on a single axis
+        mem_snap.close()
+        mem_snap = MemorySnapper()
+        mem_snap.take_memory_snapshot()
+        assert len(mem_snap.snapshot_times) == 3
+
+    @pytest.mark.skipif(not os.path.isdir("/proc"), reason="procfs sampler requires /proc")
+    def test_procfs_sampler(self):
+        child = subprocess.Popen([sys.executable, "-c", "import time; print(flush=True); time.sleep(30)"],
+                                 stdout=subprocess.PIPE)
+        try:
+            child.stdout.readline() # Wait until the interpreter is running
+            procfs_samples = dict(ProcfsSampler().sample())
+            psutil_samples = dict(PsutilSampler().sample())
+            assert procfs_samples[child.pid] == psutil_samples[child.pid]
+            assert ProcfsSampler().name(child.pid) == ps.Process(child.pid).name()
+
+            mem_snap = MemorySnapper(sampler="procfs")
+            mem_snap.take_memory_snapshot()
+            assert mem_snap[child.pid].vmss[0] == procfs_samples[child.pid]
+        finally:
+            child.kill()
+            child.wait()
+            child.stdout.close()
+
+        # The descriptor of an exited process is dropped rather than reporting stale memory
+        mem_snap.take_memory_snapshot()
+        assert len(mem_snap[child.pid]) == 1
+        mem_snap.close()
+
+    def test_process_identities_cached(self, monkeypatch):
+        mem_snap = MemorySnapper()
+        mem_snap.take_memory_snapshot()
+        pids = set(mem_snap.pids)
+
+        # Steady state ticks only read memory, names are not looked up again
+        identified = []
+        def fail(pid):
+            identified.append(pid)
+            raise ps.NoSuchProcess(pid)
+        monkeypatch.setattr(mem_snap.sampler, "name", fail)
+        monkeypatch.setattr(mem_snap.sampler, "create_time", fail)
+        child = subprocess.Popen([sys.executable, "-c", "import time; print(flush=True); time.sleep(30)"],
+                                 stdout=subprocess.PIPE)
+        try:
+            child.stdout.readline()
+            mem_snap.take_memory_snapshot()
+            assert child.pid in identified and not pids & set(identified)
+            assert child.pid not in mem_snap.pids # The new process could not be identified
+            monkeypatch.undo()
+            mem_snap.take_memory_snapshot()
+            assert child.pid in mem_snap.pids
+            assert mem_snap[child.pid].name == ps.Process(child.pid).name()
+        finally:
+            child.kill()
+            child.wait()
+            child.stdout.close()
+        assert pids <= set(mem_snap.pids)
+        mem_snap.close()
+
+    def test_reused_pid_starts_new_series(self, tmp_path, monkeypatch):
+        data_file = str(tmp_path / "reused.dat")
+        mem_snap = MemorySnapper(existing_data_file=data_file)
+        child = subprocess.Popen([sys.executable, "-c", "import time; print(flush=True); time.sleep(30)"],
+                                 stdout=subprocess.PIPE)
+        try:
+            child.stdout.readline()
+            mem_snap.take_memory_snapshot()
+            mem_snap.take_memory_snapshot()
+            previous = mem_snap[child.pid]
+            assert len(previous) == 2
+
+            # The pid is reported as started again, by a process with a new creation time and name
+            sampler = mem_snap.sampler
+            sample, name, create_time = sampler.sample, sampler.name, sampler.create_time
+            def reused(pids=None, metrics=()):
+                samples = sample(pids, metrics=metrics)
+                sampler.started.add(child.pid)
+                return samples
+            monkeypatch.setattr(sampler, "sample", reused)
+            monkeypatch.setattr(sampler, "name", lambda pid: "reused" if pid == child.pid else name(pid))
+            monkeypatch.setattr(sampler, "create_time",
+                                lambda pid: create_time(pid) + (1.0 if pid == child.pid else 0.0))
+            mem_snap.take_memory_snapshot()
+        finally:
+            child.kill()
+            child.wait()
+            child.stdout.close()
+
+        # The new process has a series of its own, the previous one is still written to the data file
+        assert mem_snap[child.pid] is not previous
+        assert len(mem_snap[child.pid]) == 1
+        assert mem_snap.procs_by_name("reused") == [mem_snap[child.pid]]
+        mem_snap.close()
+        reloaded = MemorySnapper(existing_data_file=data_file)
+        assert len(reloaded[child.pid]) == 3
+        assert reloaded[child.pid].name == "reused"
+
+    def test_snapshot_stats(self):
+        mem_monitor = MemoryMonitor(time_interval=0.01)
+        mem_monitor.start_monitoring()
+        time.sleep(0.5)
+        mem_monitor.stop_monitoring()
+        stats = mem_monitor.stats
+
+        assert stats.ticks == len(mem_monitor.snapshot_times)
+        assert stats.last_processes_scanned > 0
+        assert stats.processes_scanned >= stats.last_processes_scanned
+        edges, counts = stats.latency_histogram()
+        assert sum(counts) == stats.ticks and len(counts) == len(edges) + 1
+        assert 0 < stats.mean_latency <= stats.max_latency
+        assert stats.latency_percentile(50) <= stats.latency_percentile(99)
+        assert stats.requested_rate == pytest.approx(100)
+        assert 0 < stats.achieved_rate <= stats.requested_rate
+        assert stats.rss > 0 and stats.cpu_percent >= 0
+        summary = stats.summary()
+        assert summary["ticks"] == stats.ticks and summary["errors"] == dict(stats.errors)
+        mem_monitor.close()
+
+    def test_memory_monitor_fixed_deadlines(self):
+        interval = 0.02
+        mem_monitor = MemoryMonitor(time_interval=interval)
+        mem_monitor.start_monitoring()
+        time.sleep(1)
+        mem_monitor.stop_monitoring()
+
+        # Snapshots are taken on the deadlines, the time taken by each does not add up
+        times = mem_monitor.snapshot_times
+        span = times[-1] - times[0]
+        expected = (len(times) - 1 + mem_monitor.stats.missed_ticks) * interval
+        assert abs(span - expected) < 2 * interval
+        mem_monitor.close()
+
+    def test_memory_monitor_cpu_budget(self):
+        interval = 0.001
+        mem_monitor = MemoryMonitor(time_interval=interval, cpu_budget=0.01)
+        mem_monitor.start_monitoring()
+        time.sleep(0.5)
+        mem_monitor.stop_monitoring()
+
+        # A snapshot takes far more than 1% of 1 ms of CPU, so the interval backs off
+        assert mem_monitor.interval > interval
+        assert mem_monitor.stats.interval == mem_monitor.interval
+        # Far fewer snapshots than 1 per interval, possibly too few to measure a rate from
+        assert mem_monitor.stats.ticks < 0.5 / interval / 2
+        mem_monitor.close()
+
+    def test_memory_monitor_online_detector(self):
+        alerts = []
+        detector = OnlineLeakDetector(callback=alerts.append, interval=0.01)
+        mem_monitor = MemoryMonitor(time_interval=0.005, detector=detector)
+        mem_monitor.start_monitoring()
+        time.sleep(0.5)
+        mem_monitor.stop_monitoring()
+
+        # Every process sampled is tracked while monitoring
+        assert set(mem_monitor.pids) <= set(detector.pids)
+        for alert in alerts:
+            assert alert.name == mem_monitor[alert.pid].name
+        mem_monitor.close()
+
+    def _write_hours_csv(self, filename, hours=2):
+        start = datetime.datetime(2022, 1, 1, 0, 0)
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=['Process ID', 'Process Name', 'Time', 'Memory Usage'])
+            writer.writeheader()
+            for i in range(hours * 3600):
+                for pid in [1001, 1002]:
+                    writer.writerow({'Process ID': pid, 'Process Name': f'Process {pid}',
+                                     'Time': (start + datetime.timedelta(seconds=i)).isoformat(),
+                                     'Memory Usage': pid * 1000 + i})
+
+    def test_retention_tiers(self, tmp_path):
+        filename = str(tmp_path / "retention_source.csv")
+        self._write_hours_csv(filename)
+        unretained = MemorySnapper(str(tmp_path / "unretained.dat"))
+        unretained.import_from_csv(filename)
+        retention = RetentionPolicy(recent=600, tiers=[(60, 3600), (600, None)])
+        mem_snap = MemorySnapper(str(tmp_path / "retained.dat"), retention=retention)
+        mem_snap.import_from_csv(filename, chunk_rows=1000) # Retention is applied as each chunk is flushed
+
+        latest = mem_snap.snapshot_times.max()
+        assert mem_snap.nbytes < unretained.nbytes
+        for pid in [1001, 1002]:
+            proc = mem_snap[pid]
+            assert proc.times.min() >= latest - 600
+            fine, coarse = proc.tiers
+            assert fine.bucket == 60 and coarse.bucket == 600
+            assert fine.starts.min() + 60 > latest - 3600
+            assert coarse.starts.max() + 600 <= fine.starts.min() + 600
+            # Every sample is accounted for exactly once across the tiers
+            assert len(proc) + fine.counts.sum() + coarse.counts.sum() == 2 * 3600
+            # Each bucket summarises the samples that fell in it
+            first = coarse.starts[0]
+            expected = pid * 1000 + np.arange(600) + (first - mem_snap.snapshot_times.min())
+            assert coarse.mins[0] == expected.min() and coarse.maxs[0] == expected.max()
+            assert coarse.means[0] == pytest.approx(expected.mean())
+            starts, mins, maxs, means, counts = fine.between(latest - 1200, latest)
+            assert np.all(starts + 60 > latest - 1200)
+            assert np.all(counts[:-1] == 60) # The latest bucket is completed at full resolution
+
+        # The data file still holds the full resolution history
+        mem_snap.close()
+        reloaded = MemorySnapper(str(tmp_path / "retained.dat"))
+        assert len(reloaded[1001]) == 2 * 3600
+
+    def test_retention_memory_cap(self, tmp_path):
+        filename = str(tmp_path / "retention_source.csv")
+        self._write_hours_csv(filename, hours=1)
+        unretained = MemorySnapper(str(tmp_path / "unretained.dat"))
+        unretained.import_from_csv(filename)
+        retention = RetentionPolicy(recent=3600, tiers=[(60, 86400), (600, None)], max_bytes=48 * 1024)
+        assert unretained.nbytes > retention.max_bytes
+        mem_snap = MemorySnapper(str(tmp_path / "retained.dat"), retention=retention)
+        mem_snap.import_from_csv(filename)
+        assert mem_snap.nbytes <= retention.max_bytes
+        # The newest data is kept at full resolution, the oldest is downsampled
+        assert mem_snap[1001].times.max() == mem_snap.snapshot_times.max()
+        assert len(mem_snap[1001]) + mem_snap[1001].tiers[0].counts.sum() + \
+            mem_snap[1001].tiers[1].counts.sum() <= 3600
+        mem_snap.close()
+
+    def test_memory_snapper_appends_to_data_file(self):
+        mem_snap = MemorySnapper()
+        mem_snap.take_memory_snapshot()
+        mem_snap.close()
+        with open("memory_data_tmp.dat", "rb") as f:
+            first_save = f.read()
+
+        mem_snap = MemorySnapper()
+        mem_snap.take_memory_snapshot()
+        mem_snap.close()
+        with open("memory_data_tmp.dat", "rb") as f:
+            second_save = f.read()
+
+        # Saving only appends the new snapshot, earlier data is left untouched
+        assert second_save.startswith(first_save)
+        assert len(second_save) > len(first_save)
+
+        # A chunk torn by a crash, or still being written, is skipped by readers without
+        # touching the file. The writer drops it and new chunks follow the last complete one
+        with open("memory_data_tmp.dat", "ab") as f:
+            torn = SnapshotLog.encode_chunk(LogChunk(2, np.array([time.time()]), []))
+            f.write(torn[:-1] + bytes([torn[-1] ^ 0xff]))
+        torn_size = os.path.getsize("memory_data_tmp.dat")
+        mem_snap = MemorySnapper()
+        assert len(mem_snap.snapshot_times) == 2
+        assert os.path.getsize("memory_data_tmp.dat") == torn_size
+        mem_snap.take_memory_snapshot()
+        mem_snap.close()
+        assert len(MemorySnapper().snapshot_times) == 3
+
+    def test_memory_monitor_flushes_periodically(self):
+        mem_mon = MemoryMonitor(time_interval=0.05, flush_interval=0.2)
+        mem_mon.start_monitoring()
+        time.sleep(1)
+        # Data reaches the file without the monitor being stopped or closed
+        assert len(MemorySnapper().snapshot_times) > 0
+        mem_mon.close()
+
+    def test_memory_snapper_migrates_pickle(self):
+        proc = MemorySnapper.ProcMemData.__new__(MemorySnapper.ProcMemData)
+        proc.__dict__.update({"pid": 1001001001, "name": "Process 1",
+                              "_vmss": {datetime.datetime(2022, 1, 1, 0, 0): 100,
+                                        datetime.datetime(2022, 1, 1, 0, 1): 150}})
+        with open("memory_data_tmp.dat", "wb") as f:
+            pickle.dump({"_MemorySnapper__data": {1001001001: proc},
+                         "_MemorySnapper__proc_names": {"Process 1"},
+                         "totals": {datetime.datetime(2022, 1, 1, 0, 0): 100,
+                                    datetime.datetime(2022, 1, 1, 0, 1): 150}}, f)
+
+        mem_snap = MemorySnapper()
+        assert mem_snap[1001001001][datetime.datetime(2022, 1, 1, 0, 1)] == 150
+        assert "Process 1" in mem_snap.processes
+
+        # The pickle is replaced by the converted data
+        mem_snap = MemorySnapper()
+        assert list(mem_snap[1001001001].vmss) == [100, 150]
+        assert len(mem_snap.totals) == 2
+
+    def test_memory_snapper_loads_lazily(self):
+        mem_snap = MemorySnapper()
+        for _ in range(3):
+            mem_snap.take_memory_snapshot()
+            mem_snap.close() # One chunk per snapshot
+        pid = next(iter(mem_snap.pids))
+        name = mem_snap[pid].name
+        times = mem_snap[pid].times.copy()
+        vmss = mem_snap[pid].vmss.copy()
+
+        mem_snap = MemorySnapper()
+        # Nothing but the process table is read until a process is accessed
+        assert pid in [proc.pid for proc in mem_snap.procs_by_name(name)]
+        assert not mem_snap[pid]._vmss.loaded
+
+        # Time range queries only read the data they cover
+        window_times, window_vmss = mem_snap[pid].between(times[1], times[2])
+        assert list(window_times) == list(times[1:])
+        assert list(window_vmss) == list(vmss[1:])
+        assert not mem_snap[pid]._vmss.loaded
+
+        assert list(mem_snap[pid].vmss) == list(vmss)
+        assert mem_snap[pid]._vmss.loaded
+
+    @pytest.mark.parametrize("name_table", [False, True])
+    def test_export_import_round_trip(self, name_table, tmp_path):
+        filename = str(tmp_path / "round_trip_source.csv")
+        start = datetime.datetime(2022, 1, 1, 0, 0)
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=['Process ID', 'Process Name', 'Time', 'Memory Usage'])
+            writer.writeheader()
+            for i in range(50):
+                writer.writerow({'Process ID': 1001001001, 'Process Name': 'Process 1',
+                                 'Time': (start + datetime.timedelta(seconds=i)).isoformat(), 'Memory Usage': 100 + i})
+                writer.writerow({'Process ID': 2002002002, 'Process Name': 'Process, "2"',
+                                 'Time': (start + datetime.timedelta(seconds=i + 0.25)).isoformat(), 'Memory Usage': 200 + i})
+        mem_snap = MemorySnapper(str(tmp_path / "source.dat"))
+        mem_snap.import_from_csv(filename)
+
+        exported = str(tmp_path / "round_trip.csv")
+        mem_snap.export_to_csv(exported, name_table=name_table)
+        assert os.path.exists(MemorySnapper.names_file_for(exported)) == name_table
+
+        imported = MemorySnapper(str(tmp_path / "imported.dat"))
+        imported.import_from_csv(exported, chunk_rows=7) # Several chunks per process
+        for pid in mem_snap.pids:
+            assert imported[pid].name == mem_snap[pid].name
+            assert np.allclose(imported[pid].times, mem_snap[pid].times, rtol=0, atol=1e-6)
+            assert list(imported[pid].vmss) == list(mem_snap[pid].vmss)
+        assert imported[2002002002][start + datetime.timedelta(seconds=3.25)] == 203
+        # Every chunk was written to the data file as it was imported
+        reloaded = MemorySnapper(str(tmp_path / "imported.dat"))
+        assert sorted(reloaded.pids) == sorted(mem_snap.pids)
+        assert list(reloaded[2002002002].vmss) == list(mem_snap[2002002002].vmss)
+
+    def test_agents_feed_aggregator(self, tmp_path):
+        aggregator = SnapshotAggregator("127.0.0.1:0", str(tmp_path / "hosts"))
+        aggregator.start()
+        agents = [MemoryAgent(aggregator.address, host=f"host{i}", time_interval=0.05, flush_interval=0.2)
+                  for i in range(3)]
+        for agent in agents:
+            agent.start_monitoring()
+        time.sleep(1)
+        for agent in agents:
+            agent.close()
+        time.sleep(0.2)
+
+        # Each agent's snapshots are merged into the store of its host, and dropped by the agent
+        assert aggregator.hosts == ["host0", "host1", "host2"]
+        for agent in agents:
+            mem_snap = aggregator[agent.host]
+            assert list(mem_snap.snapshot_times) == list(agent.snapshot_times)
+            pid = os.getpid()
+            assert mem_snap[pid].name == ps.Process(pid).name()
+            assert len(mem_snap[pid]) == len(agent.snapshot_times)
+            assert len(agent[pid]) <= 1
+        results = aggregator.detect_leaks("LBR", workers=2)
+        assert results == aggregator.detect_leaks("LBR")
+        assert sorted(results) == aggregator.hosts
+        aggregator.stop()
+
+        # The data of each host is in its data file
+        reloaded = MemorySnapper(existing_data_file=aggregator.data_file("host1"))
+        assert list(reloaded.snapshot_times) == list(agents[1].snapshot_times)
+
+    def test_agent_keeps_data_until_sent(self, tmp_path):
+        address = str(tmp_path / "aggregator.sock")
+        agent = MemoryAgent(address, host="local")
+        agent.take_memory_snapshot()
+        agent.flush() # No aggregator is listening yet
+        aggregator = SnapshotAggregator(address, str(tmp_path / "hosts"))
+        aggregator.start()
+        agent.take_memory_snapshot()
+        agent.close()
+        time.sleep(0.2)
+        assert len(aggregator["local"].snapshot_times) == 2
+        assert len(aggregator["local"][os.getpid()]) == 2
+        aggregator.stop()
+
+    def test_snapper_without_persistence(self, tmp_path, caplog):
+        data_file = str(tmp_path / "persisted.dat")
+        mem_snap = MemorySnapper(existing_data_file=data_file)
+        mem_snap.take_memory_snapshot()
+        mem_snap.close()
+        size = os.path.getsize(data_file)
+
+        # The existing data file is neither loaded nor appended to, and no missing file is reported
+        mem_snap = MemorySnapper(existing_data_file=data_file, persist=False)
+        assert len(mem_snap.snapshot_times) == 0
+        mem_snap.take_memory_snapshot()
+        mem_snap.close()
+        assert os.path.getsize(data_file) == size
+        caplog.clear()
+        with caplog.at_level("ERROR"):
+            MemorySnapper(existing_data_file=str(tmp_path / "missing.dat"), persist=False).close()
+        assert not os.path.exists(tmp_path / "missing.dat")
+        assert "NO MEMORY DATA FILE FOUND" not in caplog.text
+
+        # Nothing is written, so the retention policy has nothing it may drop
+        mem_snap = MemorySnapper(existing_data_file=data_file, persist=False,
+                                 retention=RetentionPolicy(recent=0, tiers=()))
+        mem_snap.take_memory_snapshot()
+        mem_snap.take_memory_snapshot()
+        mem_snap.flush()
+        assert len(mem_snap[os.getpid()]) == 2
+
+    def test_async_monitor_streams_snapshots(self, tmp_path):
+        data_file = str(tmp_path / "async.dat")
+
+        async def monitor():
+            ticks = 0
+            async def service():
+                # Another task of the loop keeps running while snapshots are taken
+                nonlocal ticks
+                while True:
+                    ticks = ticks + 1
+                    await asyncio.sleep(0.001)
+            service_task = asyncio.create_task(service())
+            async with AsyncMemoryMonitor(data_file=data_file, time_interval=0.02, batch_size=8) as mem_monitor:
+                assert mem_monitor.is_monitoring()
+                streamed = []
+                async for snapshot in mem_monitor.snapshots():
+                    streamed.append(snapshot)
+                    if len(streamed) == 5:
+                        break
+            service_task.cancel()
+            return mem_monitor, streamed, ticks
+
+        mem_monitor, streamed, ticks = asyncio.run(monitor())
+        assert not mem_monitor.is_monitoring()
+        assert ticks > 5
+        assert len(mem_monitor.snapshot_times) >= 5
+        assert [snapshot.time for snapshot in streamed] == list(mem_monitor.snapshot_times[:5])
+        pid = os.getpid()
+        assert pid in dict(streamed[0].samples)
+        assert streamed[0].total == mem_monitor.totals.values[0]
+        mem_monitor.close()
+
+        # Snapshots are written to the data file when the monitor stops
+        reloaded = MemorySnapper(existing_data_file=data_file)
+        assert list(reloaded.snapshot_times) == list(mem_monitor.snapshot_times)
+        assert reloaded[pid].name == ps.Process(pid).name()
+
+        # A stream receives the snapshots taken from its creation, before it is first iterated
+        async def stream_before_iterating():
+            mem_monitor = AsyncMemoryMonitor(data_file=str(tmp_path / "eager.dat"))
+            stream = mem_monitor.snapshots()
+            taken = await mem_monitor.take_memory_snapshot_async()
+            first = await stream.__anext__()
+            stream.close()
+            await mem_monitor.take_memory_snapshot_async()
+            return mem_monitor, taken, first, [snapshot async for snapshot in stream]
+
+        mem_monitor, taken, first, rest = asyncio.run(stream_before_iterating())
+        assert first is taken
+        assert rest == [] # Nothing is received once the stream is closed
+        mem_monitor.close()
+
+    def test_out_of_process_monitor(self, tmp_path):
+        data_file = str(tmp_path / "out_of_process.dat")
+        mem_monitor = MemoryMonitor(data_file=data_file, time_interval=0.02, flush_interval=0.2,
+                                    out_of_process=True)
+        mem_monitor.start_monitoring()
+        time.sleep(0.5)
+        sampler_pid = mem_monitor._MemoryMonitor__sampler_process.pid
+        mem_monitor.detect_leaks("LBR") # Moves the snapshots taken so far into the store
+        assert len(mem_monitor.snapshot_times) > 5
+        time.sleep(0.2)
+        mem_monitor.stop_monitoring()
+
+        pid = os.getpid()
+        assert mem_monitor[pid].name == ps.Process(pid).name()
+        assert len(mem_monitor[pid]) == len(mem_monitor.snapshot_times)
+        assert mem_monitor.stats.ticks == len(mem_monitor.snapshot_times)
+        assert len(mem_monitor.totals.values) == len(mem_monitor.snapshot_times)
+        # The sampler process does not sample itself
+        assert sampler_pid not in mem_monitor.pids
+        mem_monitor.close()
+        reloaded = MemorySnapper(existing_data_file=data_file)
+        assert list(reloaded.snapshot_times) == list(mem_monitor.snapshot_times)
+
+    @pytest.mark.parametrize("sampler", ["psutil", "procfs"])
+    def test_process_filter_tracks_subtree(self, tmp_path, sampler):
+        pid = os.getpid()
+        process_filter = ProcessFilter(trees=[pid], exclude_names=["sleep"], refresh_interval=3600)
+        mem_snap = MemorySnapper(existing_data_file=str(tmp_path / "filtered.dat"), sampler=sampler,
+                                 process_filter=process_filter)
+        mem_snap.take_memory_snapshot()
+        assert pid in mem_snap.pids
+        assert set(mem_snap.pids) <= {pid} | {child.pid for child in ps.Process().children(recursive=True)}
+        # Children started after the process table was walked are picked up on the next tick
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+        sleeper = subprocess.Popen(["sleep", "30"])
+        # Children of a thread other than the main thread are only listed under that thread
+        threaded = []
+        done = threading.Event()
+        def spawn():
+            threaded.append(subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"]))
+            done.wait()
+        spawner = threading.Thread(target=spawn)
+        spawner.start()
+        try:
+            time.sleep(0.2)
+            mem_snap.take_memory_snapshot()
+            assert child.pid in mem_snap.pids
+            assert threaded[0].pid in mem_snap.pids
+            assert sleeper.pid not in mem_snap.pids
+            assert 1 not in mem_snap.pids
+        finally:
+            done.set()
+            spawner.join()
+            for proc in [child, sleeper] + threaded:
+                proc.kill()
+                proc.wait()
+        # Exited processes are no longer read
+        mem_snap.take_memory_snapshot()
+        assert child.pid not in process_filter.resolve()
+
+        name = ps.Process(pid).name()
+        assert pid in ProcessFilter(names=[name[:3] + "*"]).resolve()
+        assert pid not in ProcessFilter(names=[name[:3] + "*"], exclude_pids=[pid]).resolve()
+        assert pid not in ProcessFilter(exclude_names=[name]).resolve()
+
+    def test_process_filter_excludes_cgroup_joined_between_refreshes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(filters, "CGROUP_ROOT", str(tmp_path))
+        (tmp_path / "excluded").mkdir()
+        procs = tmp_path / "excluded" / "cgroup.procs"
+        procs.write_text("")
+        pid = os.getpid()
+        process_filter = ProcessFilter(exclude_cgroups=["excluded"], refresh_interval=3600)
+        assert pid in process_filter.resolve()
+        # A process moved into an excluded cgroup is dropped on the next tick, not the next refresh
+        procs.write_text(f"{pid}\n")
+        assert pid not in process_filter.resolve()
+
+    @pytest.mark.parametrize("sampler", ["psutil", "procfs"])
+    def test_multiple_metrics(self, tmp_path, sampler):
+        data_file = str(tmp_path / "metrics.dat")
+        pid = os.getpid()
+        mem_snap = MemorySnapper(existing_data_file=data_file, sampler=sampler,
+                                 process_filter=ProcessFilter(pids=[pid]), metrics={"rss": 0, "pss": 3600})
+        for _ in range(3):
+            mem_snap.take_memory_snapshot()
+        proc = mem_snap[pid]
+        assert proc.metrics == ["vms", "rss", "pss"]
+        assert len(proc.values("rss")) == 3
+        assert len(proc.values("pss")) == 1 # Sampled at its own, longer interval
+        assert list(proc.metric_times("pss")) == [mem_snap.snapshot_times[0]]
+        assert 0 < proc.values("pss")[0] <= proc.values("rss")[0] < proc.vmss[0]
+        _, leaking = mem_snap.detect_leaks("linefit", metric="rss")
+        assert set(leaking) <= {pid}
+        mem_snap.close()
+
+        reloaded = MemorySnapper(existing_data_file=data_file)
+        assert reloaded[pid].metrics == ["vms", "rss", "pss"]
+        assert list(reloaded[pid].values("rss")) == list(proc.values("rss"))
+        assert list(reloaded[pid].values("pss")) == list(proc.values("pss"))
+        with pytest.raises(ValueError):
+            MemorySnapper(existing_data_file=data_file, metrics={"heap": 0})
+
+    def test_sample_ring_wraps_and_drops(self):
+        ring = SampleRing(capacity=32)
+        try:
+            assert ring.write(1000.0, 0.0, 0.001, [(1, 10), (2, 20)], [(1, 1.0, "one"), (2, 2.0, "two")])
+            assert ring.write(1001.0, 0.0, 0.001, [(1, 11), (2, 21)], [])
+            assert not ring.write(1002.0, 0.0, 0.001, [(3, 30)] * 31, []) # Not enough free space
+            assert ring.dropped == 1
+            chunk, snapshots, identities = ring.read_chunk()
+            assert list(chunk.times) == [1000.0, 1001.0]
+            assert [(series.pid, series.name, list(series.values)) for series in chunk.series] == \
+                [(1, "one", [10, 11]), (2, "two", [20, 21]), (-1, "", [30, 32])]
+            assert list(snapshots["processes"]) == [2, 2]
+            assert identities == [("one", 1.0), ("two", 2.0), None]
+            # Space released by the read is reused, the samples wrap around the end of the ring
+            assert ring.write(1002.0, 0.0, 0.001, [(pid, pid) for pid in range(3, 33)], [])
+            chunk, _, _ = ring.read_chunk()
+            assert chunk.first_snapshot == 2
+            assert [series.pid for series in chunk.series] == list(range(3, 33)) + [-1]
+            assert list(chunk.series[-1].values) == [sum(range(3, 33))]
+        finally:
+            ring.close()
+            ring.unlink()
+
+    def test_sample_ring_reused_pid(self, tmp_path):
+        data_file = str(tmp_path / "ring_reused.dat")
+        mem_snap = MemorySnapper(existing_data_file=data_file)
+        ring = SampleRing(capacity=64)
+        try:
+            ring.write(1000.0, 0.0, 0.001, [(1, 10)], [(1, 1.0, "one")])
+            chunk, _, identities = ring.read_chunk()
+            mem_snap.merge_chunk(chunk, identities)
+            previous = mem_snap[1]
+            # The pid is reused within the next chunk, after one more sample of the first process
+            ring.write(1001.0, 0.0, 0.001, [(1, 11)], [])
+            ring.write(1002.0, 0.0, 0.001, [(1, 50)], [(1, 5.0, "uno")])
+            chunk, _, identities = ring.read_chunk()
+            assert [(series.name, list(series.values)) for series in chunk.series[:-1]] == \
+                [("one", [11]), ("uno", [50])]
+            assert identities[:-1] == [("one", 1.0), ("uno", 5.0)]
+            mem_snap.merge_chunk(chunk, identities)
+            ring.write(1003.0, 0.0, 0.001, [(1, 51)], [])
+            chunk, _, identities = ring.read_chunk()
+            mem_snap.merge_chunk(chunk, identities)
+        finally:
+            ring.close()
+            ring.unlink()
+
+        # The new process has a series of its own, the previous one is still written to the data file
+        assert list(previous.vmss) == [10, 11]
+        assert mem_snap[1] is not previous
+        assert mem_snap[1].name == "uno"
+        assert list(mem_snap[1].vmss) == [50, 51]
+        mem_snap.close()
+        reloaded = MemorySnapper(existing_data_file=data_file)
+        assert list(reloaded[1].vmss) == [10, 11, 50, 51]
+        assert reloaded[1].name == "uno"
         
 @pytest.mark.parametrize("leak_detection_algo", 
                         [pytest.param("linefit", marks=pytest.mark.skip(
                                                     "Linefit cannot detect issues in sawtooth")),
                         "LBR",
-                        pytest.param("LBRCPD", marks=pytest.mark.skip(
-                                                            "LBRCPD is unfinished at the moment"))
+                        "LBRBATCH",
+                        "LBRCPD"
                         ])
 class TestLeakDetection():
     def test_memory_monitor_sawtooth_memory_leak(self, server, leak_detection_algo):